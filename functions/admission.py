@@ -0,0 +1,242 @@
+"""
+Admission control for model calls: per-user token buckets, an in-instance concurrency limit and a bounded wait queue
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from fanout import requested_count
+from instrumentation import log_event, span
+from resilience import remaining_s
+
+# Per-user budget in estimated completion tokens: refill rate and bucket size
+RATE_TOKENS_PER_MINUTE = float(os.environ.get('AI_RATE_TOKENS_PER_MINUTE', '60000'))
+RATE_BURST_TOKENS = float(os.environ.get('AI_RATE_BURST_TOKENS', '40000'))
+# Model calls running at once in this instance, and callers allowed to wait for a slot
+MAX_CONCURRENT_CALLS = int(os.environ.get('AI_MAX_CONCURRENT_CALLS', '4'))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('AI_ADMISSION_QUEUE_SIZE', '8'))
+# Requests Cloud Run sends to one instance at once; above 1 the endpoints share the instance's slots
+FUNCTION_CONCURRENCY = int(os.environ.get('AI_FUNCTION_CONCURRENCY', '1'))
+# Longest a request may wait for a slot (or be told to retry after) before it is shed
+ADMISSION_MAX_WAIT_S = float(os.environ.get('AI_ADMISSION_MAX_WAIT_S', '10'))
+# "memory" (per instance) or "firestore" (shared across instances, including the emulator)
+ADMISSION_STORE = os.environ.get('AI_ADMISSION_STORE', 'memory')
+ADMISSION_FIRESTORE_COLLECTION = os.environ.get('AI_ADMISSION_FIRESTORE_COLLECTION', 'ai_rate_limits')
+# Buckets kept in memory per instance; the least recently used are dropped beyond this
+ADMISSION_MAX_BUCKETS = int(os.environ.get('AI_ADMISSION_MAX_BUCKETS', '10000'))
+
+# Completion tokens assumed for one request plus each requested shape; capped at max_completion_tokens
+BASE_COMPLETION_TOKENS = 300
+TOKENS_PER_SHAPE = 40
+MAX_COMPLETION_TOKENS = 16000
+
+def estimate_completion_tokens(prompt: str) -> int:
+    """Estimates how many completion tokens a prompt will cost from the shape count it asks for."""
+    count = requested_count(prompt) or 1
+    return min(MAX_COMPLETION_TOKENS, BASE_COMPLETION_TOKENS + TOKENS_PER_SHAPE * count)
+
+def client_key(req, uid: str | None = None) -> str:
+    """Identifies the caller for rate limiting: the auth uid, else the client IP."""
+    if uid:
+        return f"uid:{uid}"
+    # Earlier X-Forwarded-For entries come from the client and can be anything; the last one
+    # is the address Google's front end saw the request come from
+    forwarded = req.headers.get('X-Forwarded-For', '')
+    ip = forwarded.split(',')[-1].strip() or req.remote_addr or 'unknown'
+    return f"ip:{ip}"
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; `retry_after` is in whole seconds."""
+
+    def __init__(self, message: str, retry_after: int, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+def _refill(tokens: float, updated_at: float, now: float, rate_per_s: float, burst: float) -> float:
+    return min(burst, tokens + (now - updated_at) * rate_per_s)
+
+class MemoryBucketStore:
+    """Token buckets kept in this instance's memory, at most `max_buckets` of them in LRU order."""
+
+    def __init__(self, rate_per_minute: float = RATE_TOKENS_PER_MINUTE, burst: float = RATE_BURST_TOKENS,
+                 max_buckets: int = ADMISSION_MAX_BUCKETS):
+        self.rate_per_s = rate_per_minute / 60
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float) -> float:
+        """Takes `cost` tokens and returns 0, or returns the seconds until they would be available."""
+        cost = min(cost, self.burst)
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = _refill(tokens, updated_at, now, self.rate_per_s, self.burst)
+            if tokens >= cost:
+                tokens, wait_s = tokens - cost, 0.0
+            else:
+                wait_s = (cost - tokens) / self.rate_per_s
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait_s
+
+    def refund(self, key: str, cost: float):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated_at = self._buckets[key]
+                self._buckets[key] = (min(self.burst, tokens + cost), updated_at)
+
+class FirestoreBucketStore:
+    """Token buckets shared across instances in a Firestore collection.
+
+    Each bucket is one document updated in a transaction. `db` may be any
+    Firestore client, including one pointed at the emulator.
+    """
+
+    def __init__(self, db=None, collection_name: str = ADMISSION_FIRESTORE_COLLECTION,
+                 rate_per_minute: float = RATE_TOKENS_PER_MINUTE, burst: float = RATE_BURST_TOKENS):
+        self._db = db
+        self.collection_name = collection_name
+        self.rate_per_s = rate_per_minute / 60
+        self.burst = burst
+
+    @property
+    def db(self):
+        if self._db is None:
+            from firebase_admin import firestore
+            self._db = firestore.client()
+        return self._db
+
+    def _update(self, key: str, change):
+        from firebase_admin import firestore
+        ref = self.db.collection(self.collection_name).document(key.replace('/', '_'))
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            now = time.time()
+            data = snapshot.to_dict() if snapshot.exists else {"tokens": self.burst, "updated_at": now}
+            tokens = _refill(data["tokens"], data["updated_at"], now, self.rate_per_s, self.burst)
+            tokens, result = change(tokens)
+            transaction.set(ref, {"tokens": tokens, "updated_at": now})
+            return result
+
+        return run(self.db.transaction())
+
+    def take(self, key: str, cost: float) -> float:
+        cost = min(cost, self.burst)
+
+        def change(tokens):
+            if tokens >= cost:
+                return tokens - cost, 0.0
+            return tokens, (cost - tokens) / self.rate_per_s
+
+        return self._update(key, change)
+
+    def refund(self, key: str, cost: float):
+        self._update(key, lambda tokens: (min(self.burst, tokens + cost), None))
+
+class AdmissionController:
+    """Admits model calls per caller and per instance.
+
+    A caller first pays the estimated completion tokens from its bucket; an empty
+    bucket is rejected at once with the time until it refills. An admitted call
+    then needs one of `max_concurrent` slots. Up to `queue_size` callers wait for a
+    slot in FIFO order; callers beyond that, or still waiting after `max_wait_s`,
+    are shed and their tokens refunded.
+    """
+
+    def __init__(self, store=None, max_concurrent: int = MAX_CONCURRENT_CALLS, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 max_wait_s: float = ADMISSION_MAX_WAIT_S):
+        self.store = store or MemoryBucketStore()
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.max_wait_s = max_wait_s
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+        self.admitted = 0
+        self.shed = {"rate_limited": 0, "queue_full": 0, "wait_timeout": 0}
+
+    def _reject(self, reason: str, message: str, retry_after: float):
+        with self._lock:
+            self.shed[reason] += 1
+        log_event("Admission", "Shed request", severity="WARNING", reason=reason, retry_after_s=round(retry_after, 1))
+        raise AdmissionRejected(message, max(1, math.ceil(retry_after)), reason)
+
+    def _acquire_slot(self) -> str | None:
+        """Takes a slot, waiting in the queue if needed; returns the shed reason on failure."""
+        with self._lock:
+            if self._in_flight < self.max_concurrent and not self._waiters:
+                self._in_flight += 1
+                return None
+            if len(self._waiters) >= self.queue_size:
+                return "queue_full"
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        # Waiting past the request deadline is pointless, so the deadline also bounds the wait
+        remaining = remaining_s()
+        if waiter.wait(self.max_wait_s if remaining is None else max(0.0, min(self.max_wait_s, remaining))):
+            return None
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return "wait_timeout"
+        # The slot was handed over just as the wait timed out
+        return None
+
+    def _release_slot(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter
+                self._waiters.popleft().set()
+            else:
+                self._in_flight -= 1
+
+    def acquire(self, key: str, cost: float):
+        """Admits one call, or raises AdmissionRejected; every acquire needs a matching release()."""
+        with span("admission"):
+            wait_s = self.store.take(key, cost)
+            if wait_s > 0:
+                self._reject("rate_limited", "Rate limit exceeded; try again later", wait_s)
+
+            reason = self._acquire_slot()
+            if reason is not None:
+                self.store.refund(key, cost)
+                self._reject(reason, "Server is busy; try again shortly", self.max_wait_s)
+
+        with self._lock:
+            self.admitted += 1
+
+    def release(self):
+        self._release_slot()
+
+    @contextmanager
+    def admit(self, key: str, cost: float):
+        """Holds an admission for the duration of the block, or raises AdmissionRejected."""
+        self.acquire(key, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "max_concurrent": self.max_concurrent,
+                "admitted": self.admitted,
+                "shed": dict(self.shed),
+            }
+
+admission = AdmissionController(
+    store=FirestoreBucketStore() if ADMISSION_STORE == 'firestore' else MemoryBucketStore(),
+)
@@ -0,0 +1,123 @@
+"""
+Cold-start benchmark for the AI functions.
+
+Each sample runs in a fresh interpreter and measures:
+  - import time of main.py (what every cold instance pays before serving)
+  - first-request latency of ai_text_to_canvas on a fast-path prompt (no network)
+  - import time of each provider SDK (paid lazily on the first model request)
+  - peak RSS after import and after the first request
+
+Usage (from the functions directory):
+    python benchmarks/cold_start.py --runs 5 --output cold_start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the fresh interpreter and prints one JSON line of measurements
+SAMPLE_SCRIPT = r'''
+import json, resource, sys, time
+
+def rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+start = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - start) * 1000
+rss_after_import = rss_kb()
+# Provider SDKs should only load on the first model request
+sdks_loaded_at_startup = [m for m in ("openai", "replicate") if m in sys.modules]
+
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+environ = EnvironBuilder(method="POST", json={"prompt": "create a 10x10 grid of red squares"}).get_environ()
+start = time.perf_counter()
+response = main.ai_text_to_canvas(Request(environ))
+first_request_ms = (time.perf_counter() - start) * 1000
+
+sdk_import_ms = {}
+for module in ("openai", "replicate"):
+    start = time.perf_counter()
+    try:
+        __import__(module)
+        sdk_import_ms[module] = (time.perf_counter() - start) * 1000
+    except ImportError:
+        sdk_import_ms[module] = None
+
+print(json.dumps({
+    "import_ms": import_ms,
+    "first_request_ms": first_request_ms,
+    "first_request_status": response.status_code,
+    "sdk_import_ms": sdk_import_ms,
+    "rss_after_import_kb": rss_after_import,
+    "rss_after_first_request_kb": rss_kb(),
+    "sdks_loaded_at_startup": sdks_loaded_at_startup,
+}))
+'''
+
+def run_sample() -> dict:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    completed = subprocess.run(
+        [sys.executable, "-c", SAMPLE_SCRIPT],
+        cwd=FUNCTIONS_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Function logs also go to stdout; the measurements are the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def summarize(samples: list[dict]) -> dict:
+    def stats(values):
+        values = [v for v in values if v is not None]
+        if not values:
+            return None
+        return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+    return {
+        "runs": len(samples),
+        "python": sys.version.split()[0],
+        "import_ms": stats([s["import_ms"] for s in samples]),
+        "first_request_ms": stats([s["first_request_ms"] for s in samples]),
+        "sdk_import_ms": {
+            module: stats([s["sdk_import_ms"][module] for s in samples])
+            for module in ("openai", "replicate")
+        },
+        "rss_after_import_kb": stats([s["rss_after_import_kb"] for s in samples]),
+        "rss_after_first_request_kb": stats([s["rss_after_first_request_kb"] for s in samples]),
+        "sdks_loaded_at_startup": sorted({m for s in samples for m in s["sdks_loaded_at_startup"]}),
+        "samples": samples,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start cost of the AI functions")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to sample")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    samples = [run_sample() for _ in range(args.runs)]
+    report = summarize(samples)
+
+    print(f"import main:      {report['import_ms']['median']:.1f} ms (median of {args.runs})")
+    print(f"first request:    {report['first_request_ms']['median']:.1f} ms")
+    for module, module_stats in report["sdk_import_ms"].items():
+        if module_stats:
+            print(f"import {module + ':':<10} {module_stats['median']:.1f} ms (deferred to first use)")
+    print(f"peak RSS:         {report['rss_after_first_request_kb']['median'] / 1024:.1f} MB")
+    if report["sdks_loaded_at_startup"]:
+        print(f"WARNING: provider SDKs imported at startup: {', '.join(report['sdks_loaded_at_startup'])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
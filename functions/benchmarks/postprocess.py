@@ -0,0 +1,87 @@
+"""
+Micro-benchmark for the command post-processor.
+
+Generates synthetic model output (jittered grid cells, out-of-bounds coordinates,
+mixed color formats and a share of stacked duplicates) and times
+postprocess_commands with and without overlap resolution at each size, so the
+overlap pass can be checked for linear scaling.
+
+Usage (from the functions directory):
+    python benchmarks/postprocess.py --sizes 1000 10000 --runs 5
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postprocess import postprocess_commands  # noqa: E402
+
+COLORS = ["red", "#00f", "#00FF00", "rgb(255, 165, 0)", "purple", "not-a-color", "#ffffff"]
+
+def synthetic_commands(count: int, seed: int = 0) -> list[dict]:
+    """Returns model-like commands laid out on a grid with deliberate defects."""
+    rng = random.Random(seed)
+    cols = int(count ** 0.5) + 1
+    step = 4400 / cols
+    size = step * 0.6
+    commands = []
+    x = y = 0.0
+    for i in range(count):
+        row, col = divmod(i, cols)
+        # Jitter pushes some neighbours into each other and the outer cells off the canvas;
+        # a few shapes are stacked exactly on the previous one
+        if rng.random() >= 0.05 or not commands:
+            x = -2200 + col * step + rng.uniform(-0.25, 0.25) * step
+            y = -2200 + row * step + rng.uniform(-0.25, 0.25) * step
+        if i % 2:
+            commands.append({"action": "create", "type": "circle", "x": x, "y": y, "radius": size / 2,
+                             "fill": rng.choice(COLORS)})
+        else:
+            commands.append({"action": "create", "type": "rectangle", "x": str(round(x, 1)), "y": y,
+                             "width": size, "height": size, "fill": rng.choice(COLORS)})
+    return commands
+
+def time_runs(commands: list[dict], runs: int, fix_overlaps: bool) -> tuple[list[float], dict]:
+    samples = []
+    stats = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        _, stats = postprocess_commands(commands, fix_overlaps=fix_overlaps)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    report = {}
+    for size in args.sizes:
+        commands = synthetic_commands(size)
+        validate_ms, _ = time_runs(commands, args.runs, fix_overlaps=False)
+        full_ms, stats = time_runs(commands, args.runs, fix_overlaps=True)
+        median_full = statistics.median(full_ms)
+        report[size] = {
+            "validate_clamp_ms": round(statistics.median(validate_ms), 3),
+            "with_overlaps_ms": round(median_full, 3),
+            "overlap_pass_ms": round(median_full - statistics.median(validate_ms), 3),
+            "us_per_command": round(median_full * 1000 / size, 3),
+            "stats": stats,
+        }
+        print(f"{size:>7} commands: validate+clamp {report[size]['validate_clamp_ms']:.1f}ms, "
+              f"with overlaps {median_full:.1f}ms ({report[size]['us_per_command']:.1f}us/command), "
+              f"moved {stats['moved']}, clamped {stats['clamped']}, colors fixed {stats['colors_fixed']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
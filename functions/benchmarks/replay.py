@@ -0,0 +1,441 @@
+"""
+Offline replay benchmark for the AI pipeline.
+
+Drives the real HTTP handlers in main.py end to end, with the OpenAI client and
+the Replicate SDK replaced by fakes that replay recorded responses at a
+simulated latency. No network calls are made. For each fixture it reports:
+  - throughput and p50/p99 request latency
+  - CPU time per trace stage (prompt_build, upstream, parse, postprocess, serialize, ...)
+  - peak and retained Python allocations for one request (tracemalloc)
+  - peak RSS of the process
+
+Built-in fixtures cover OpenAI tool-call responses of 1 to 2,000 shapes (plain,
+streamed and batch edits) and well-formed, malformed and unparseable Replicate
+text. Recorded responses can be added as JSON files in the same format; use
+--write-fixtures to see it.
+
+Usage (from the functions directory):
+    python benchmarks/replay.py --requests 50 --output replay.json
+    python benchmarks/replay.py --latency-ms 800 --concurrency 4 --compare replay.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTIONS_DIR)
+
+# Fakes need no real credentials, and admission limits must not shed benchmark traffic
+BENCHMARK_ENV = {
+    "OPENAI_API_KEY": "replay",
+    "REPLICATE_API_TOKEN": "replay",
+    "AI_RATE_TOKENS_PER_MINUTE": "1e12",
+    "AI_RATE_BURST_TOKENS": "1e12",
+    "AI_ADMISSION_QUEUE_SIZE": "1000",
+}
+
+# Characters per streamed chunk; roughly what providers send per server-sent event
+STREAM_CHUNK_CHARS = 64
+
+COLORS = ["#FF0000", "#0000FF", "#00FF00", "#FFA500", "#800080", "#FFFF00"]
+
+def openai_create_fixture(count: int) -> dict:
+    """Tool calls for `count` new shapes: separate createShape calls for a few, one columnar createShapes beyond."""
+    rng = random.Random(count)
+    xs = [round(rng.uniform(-2000, 2000), 1) for _ in range(count)]
+    ys = [round(rng.uniform(-2000, 2000), 1) for _ in range(count)]
+    if count <= 10:
+        tool_calls = [
+            {"name": "createShape", "arguments": json.dumps({
+                "shapeType": "rectangle", "x": x, "y": y, "width": 80, "height": 60, "fill": COLORS[i % len(COLORS)],
+            })}
+            for i, (x, y) in enumerate(zip(xs, ys))
+        ]
+    else:
+        tool_calls = [{"name": "createShapes", "arguments": json.dumps({
+            "shapeType": "rectangle",
+            "width": 40,
+            "height": 40,
+            "columns": {
+                "shapeType": ["circle" if i % 3 == 0 else "rectangle" for i in range(count)],
+                "x": xs,
+                "y": ys,
+                "fill": [COLORS[i % len(COLORS)] for i in range(count)],
+            },
+        })}]
+    return {
+        "name": f"openai_create_{count}",
+        "provider": "openai",
+        "endpoint": "ai_text_to_canvas",
+        "request": {"prompt": f"scatter {count} rectangles and circles across the canvas"},
+        "tool_calls": tool_calls,
+        "usage": {"prompt_tokens": 2400, "completion_tokens": 30 + 25 * count, "cached_tokens": 2048},
+    }
+
+def openai_edit_fixture(count: int) -> dict:
+    """An editShapes call recoloring and moving a selection of `count` shapes."""
+    selection = [
+        {"id": f"shape-{i}", "type": "rectangle", "x": i * 50 - 2000, "y": 0, "width": 40, "height": 40, "fill": "#000000"}
+        for i in range(count)
+    ]
+    arguments = {
+        "offset": {"x": 0, "y": 120},
+        "perShape": [{"id": shape["id"], "fill": COLORS[i % len(COLORS)]} for i, shape in enumerate(selection)],
+    }
+    return {
+        "name": f"openai_edit_{count}",
+        "provider": "openai",
+        "endpoint": "ai_text_to_canvas",
+        "request": {"prompt": "move these down and give each a different color", "selectedContent": selection},
+        "tool_calls": [{"name": "editShapes", "arguments": json.dumps(arguments)}],
+        "usage": {"prompt_tokens": 4000 + 30 * count, "completion_tokens": 20 * count, "cached_tokens": 2048},
+    }
+
+def replicate_fixture(name: str, text: str, prompt: str) -> dict:
+    chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+    return {"name": name, "provider": "replicate", "endpoint": "ai_text_to_canvas_replicate",
+            "request": {"prompt": prompt}, "chunks": chunks}
+
+def builtin_fixtures() -> list[dict]:
+    fixtures = [openai_create_fixture(count) for count in (1, 10, 100, 500, 2000)]
+    streamed = openai_create_fixture(500)
+    fixtures.append({**streamed, "name": "openai_stream_500", "endpoint": "ai_text_to_canvas_stream"})
+    fixtures.append(openai_edit_fixture(100))
+
+    commands = [
+        {"action": "create", "type": "circle", "x": i * 30 - 1500, "y": 200, "radius": 12, "fill": COLORS[i % len(COLORS)]}
+        for i in range(100)
+    ]
+    fixtures.append(replicate_fixture(
+        "replicate_json_100", "```json\n" + json.dumps(commands, indent=2) + "\n```", "a row of 100 circles"))
+
+    # Prose around the objects, a few broken objects and a truncated tail, as weaker models produce
+    pieces = ["Sure! Here are the shapes you asked for:\n"]
+    for i, command in enumerate(commands[:60]):
+        text = json.dumps(command)
+        pieces.append(text.replace('"fill"', 'fill') if i % 10 == 9 else text)
+        pieces.append(",\n" if i % 7 else "\n\nAnd some more:\n")
+    pieces.append('{"action": "create", "type": "rect')
+    fixtures.append(replicate_fixture("replicate_malformed_60", "".join(pieces), "a row of 60 circles"))
+
+    fixtures.append(replicate_fixture(
+        "replicate_unparseable", "I'm sorry, I can only describe shapes in words: a big red circle. " * 20,
+        "a big red circle"))
+    return fixtures
+
+def load_fixtures(directory: str) -> list[dict]:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            fixtures.append(json.load(f))
+    return fixtures
+
+class SimulatedLatency:
+    """Sleeps for a seeded, jittered time to first byte and per streamed chunk."""
+
+    def __init__(self, first_byte_ms: float, chunk_ms: float, jitter: float, seed: int = 0):
+        self.first_byte_ms = first_byte_ms
+        self.chunk_ms = chunk_ms
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sleep(self, ms: float):
+        if ms <= 0:
+            return
+        with self._lock:
+            factor = 1 + self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(ms * factor / 1000)
+
+    def first_byte(self):
+        self._sleep(self.first_byte_ms)
+
+    def chunk(self):
+        self._sleep(self.chunk_ms)
+
+def ns(**fields):
+    return types.SimpleNamespace(**fields)
+
+class FakeOpenAIStream:
+    """Replays tool calls as chat-completion chunks, splitting arguments like token deltas."""
+
+    def __init__(self, fixture: dict, latency: SimulatedLatency):
+        self.fixture = fixture
+        self.latency = latency
+
+    def __iter__(self):
+        for index, call in enumerate(self.fixture["tool_calls"]):
+            arguments = call["arguments"]
+            for start in range(0, len(arguments), STREAM_CHUNK_CHARS):
+                self.latency.chunk()
+                function = ns(name=call["name"] if start == 0 else None,
+                              arguments=arguments[start:start + STREAM_CHUNK_CHARS])
+                delta = ns(tool_calls=[ns(index=index, function=function)])
+                yield ns(usage=None, choices=[ns(delta=delta, finish_reason=None)])
+        yield ns(usage=None, choices=[ns(delta=ns(tool_calls=None), finish_reason="tool_calls")])
+        yield ns(usage=fake_usage(self.fixture), choices=[])
+
+    def close(self):
+        pass
+
+def fake_usage(fixture: dict):
+    usage = fixture.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    return ns(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+              total_tokens=prompt_tokens + completion_tokens,
+              prompt_tokens_details=ns(cached_tokens=usage.get("cached_tokens")))
+
+class FakeOpenAI:
+    """Stands in for openai.OpenAI; `fixture` is the recorded response every call replays."""
+
+    def __init__(self, latency: SimulatedLatency):
+        self.latency = latency
+        self.fixture = None
+        self.chat = ns(completions=ns(create=self.create))
+
+    def create(self, stream: bool = False, **_):
+        self.latency.first_byte()
+        if stream:
+            return FakeOpenAIStream(self.fixture, self.latency)
+        tool_calls = [
+            ns(id=f"call_{i}", function=ns(name=call["name"], arguments=call["arguments"]))
+            for i, call in enumerate(self.fixture["tool_calls"])
+        ]
+        message = ns(tool_calls=tool_calls or None, content=None)
+        return ns(choices=[ns(message=message, finish_reason="tool_calls")], usage=fake_usage(self.fixture))
+
+def fake_replicate_module(provider: dict) -> types.ModuleType:
+    """Builds a stand-in `replicate` module whose Client streams the current fixture's chunks."""
+    module = types.ModuleType("replicate")
+
+    class Client:
+        def __init__(self, api_token=None, timeout=None, **_):
+            pass
+
+        def stream(self, model, input=None):
+            provider["latency"].first_byte()
+            for chunk in provider["fixture"]["chunks"]:
+                provider["latency"].chunk()
+                yield chunk
+
+    module.Client = Client
+    return module
+
+def install_fakes(latency: SimulatedLatency) -> tuple[FakeOpenAI, dict]:
+    """Points the services at the fake providers; returns the handles used to switch fixtures."""
+    import openai_service
+
+    openai_fake = FakeOpenAI(latency)
+    openai_service.client = openai_fake
+    replicate_state = {"fixture": None, "latency": latency}
+    sys.modules["replicate"] = fake_replicate_module(replicate_state)
+    return openai_fake, replicate_state
+
+def request_body(fixture: dict) -> dict:
+    # Every request must reach the fake provider, so the fast path, cache and fan-out are off
+    return {"model": "gpt-5-mini", "fastPath": False, "cache": False, "fanOut": False, **fixture["request"]}
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class TraceRecorder:
+    """Collects finished request traces by wrapping instrumentation.finish_trace."""
+
+    def __init__(self):
+        import instrumentation
+
+        self.traces = []
+        self._lock = threading.Lock()
+        original = instrumentation.finish_trace
+
+        def finish_trace(trace, status=None):
+            with self._lock:
+                self.traces.append(trace)
+            return original(trace, status)
+
+        instrumentation.finish_trace = finish_trace
+
+    def take(self) -> list:
+        with self._lock:
+            traces, self.traces = self.traces, []
+        return traces
+
+def run_request(handler, body: dict) -> tuple[float, int, int]:
+    """Calls a handler like the Functions runtime would and returns (latency_ms, status, body_bytes)."""
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    environ = EnvironBuilder(method="POST", json=body).get_environ()
+    start = time.perf_counter()
+    response = handler(Request(environ))
+    # Streamed bodies only run when consumed, as the server would
+    payload = b"".join(response.iter_encoded()) if response.is_streamed else response.get_data()
+    response.close()
+    return (time.perf_counter() - start) * 1000, response.status_code, len(payload)
+
+def stage_cpu(traces: list) -> dict:
+    """Mean CPU milliseconds per request for each span name."""
+    totals = {}
+    for trace in traces:
+        for item in trace.spans:
+            totals[item["name"]] = totals.get(item["name"], 0.0) + item["cpu_ms"]
+    return {name: round(total / len(traces), 3) for name, total in totals.items()} if traces else {}
+
+def bench_fixture(main_module, fixture: dict, args, fakes, recorder: TraceRecorder) -> dict:
+    openai_fake, replicate_state = fakes
+    openai_fake.fixture = fixture
+    replicate_state["fixture"] = fixture
+    handler = getattr(main_module, fixture["endpoint"])
+    body = request_body(fixture)
+
+    for _ in range(args.warmup):
+        run_request(handler, body)
+    recorder.take()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda _: run_request(handler, body), range(args.requests)))
+    wall_s = time.perf_counter() - start
+    traces = recorder.take()
+
+    # One extra request under tracemalloc, which is too slow to leave on while timing
+    tracemalloc.start()
+    run_request(handler, body)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    recorder.take()
+
+    latencies = [latency for latency, _, _ in results]
+    statuses = sorted({status for _, status, _ in results})
+    return {
+        "endpoint": fixture["endpoint"],
+        "requests": args.requests,
+        "statuses": statuses,
+        "response_bytes": results[0][2],
+        "throughput_rps": round(args.requests / wall_s, 2),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "stage_cpu_ms": stage_cpu(traces),
+        "alloc_peak_kb": round(peak / 1024, 1),
+        "alloc_retained_kb": round(retained / 1024, 1),
+        "peak_rss_kb": rss_kb(),
+    }
+
+def git_revision() -> str | None:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=FUNCTIONS_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=FUNCTIONS_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+def print_comparison(report: dict, baseline: dict):
+    print(f"\nCompared with {baseline['meta'].get('revision') or 'baseline'}:")
+    for name, result in report["fixtures"].items():
+        before = baseline["fixtures"].get(name)
+        if not before:
+            continue
+        changes = [
+            f"{metric} {(result[metric] - before[metric]) / before[metric] * 100:+.1f}%"
+            for metric in ("p50_ms", "p99_ms", "throughput_rps", "alloc_peak_kb")
+            if before.get(metric)
+        ]
+        print(f"  {name:<26} " + ", ".join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30, help="Timed requests per fixture")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests per fixture")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Simulated provider time to first byte")
+    parser.add_argument("--chunk-latency-ms", type=float, default=0, help="Simulated delay per streamed chunk")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction, e.g. 0.2 = +/-20%%")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", help="Directory of recorded fixture JSON files to replay as well")
+    parser.add_argument("--only", nargs="+", help="Only run fixtures whose name contains one of these")
+    parser.add_argument("--write-fixtures", help="Write the built-in fixtures to this directory and exit")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Previous JSON report to compare against")
+    args = parser.parse_args()
+
+    fixtures = builtin_fixtures()
+    if args.write_fixtures:
+        os.makedirs(args.write_fixtures, exist_ok=True)
+        for fixture in fixtures:
+            with open(os.path.join(args.write_fixtures, fixture["name"] + ".json"), "w") as f:
+                json.dump(fixture, f, indent=2)
+        print(f"Wrote {len(fixtures)} fixtures to {args.write_fixtures}")
+        return
+    if args.fixtures:
+        recorded = load_fixtures(args.fixtures)
+        names = {fixture["name"] for fixture in recorded}
+        fixtures = [fixture for fixture in fixtures if fixture["name"] not in names] + recorded
+    if args.only:
+        fixtures = [fixture for fixture in fixtures if any(part in fixture["name"] for part in args.only)]
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("AI_MAX_CONCURRENT_CALLS", str(args.concurrency))
+
+    # Function logs go to stdout; keep them out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import main as main_module
+
+        fakes = install_fakes(SimulatedLatency(args.latency_ms, args.chunk_latency_ms, args.jitter, args.seed))
+        recorder = TraceRecorder()
+        results = {}
+        for fixture in fixtures:
+            results[fixture["name"]] = bench_fixture(main_module, fixture, args, fakes, recorder)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency_ms": args.latency_ms,
+            "chunk_latency_ms": args.chunk_latency_ms,
+            "jitter": args.jitter,
+        },
+        "fixtures": results,
+    }
+
+    for name, result in results.items():
+        top = sorted(result["stage_cpu_ms"].items(), key=lambda item: -item[1])[:3]
+        print(f"{name:<26} {result['throughput_rps']:>8.1f} req/s  p50 {result['p50_ms']:>8.2f}ms  "
+              f"p99 {result['p99_ms']:>8.2f}ms  alloc peak {result['alloc_peak_kb']:>8.1f}KB  "
+              f"cpu " + ", ".join(f"{stage} {ms:.2f}ms" for stage, ms in top))
+    print(f"peak RSS: {rss_kb() / 1024:.1f} MB")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Response cache for AI canvas requests with an in-process LRU tier and an optional Firestore tier
+"""
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from instrumentation import log_event
+
+CACHE_TTL_SECONDS = float(os.environ.get('AI_CACHE_TTL_SECONDS', '3600'))
+CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '256'))
+# Set to a collection name (e.g. "ai_response_cache") to enable the persistent tier
+CACHE_FIRESTORE_COLLECTION = os.environ.get('AI_CACHE_FIRESTORE_COLLECTION')
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapses whitespace so prompts differing only in spacing share a cache entry.
+
+    Case and punctuation are kept: they can be part of the requested content
+    ("add text saying WELCOME!").
+    """
+    return re.sub(r'\s+', ' ', prompt.strip())
+
+def content_hash(selected_content) -> str | None:
+    """Returns a canonical hash of the selected content, or None if nothing is selected."""
+    if selected_content is None:
+        return None
+    canonical = json.dumps(selected_content, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def make_cache_key(provider: str, prompt: str, model: str, selected_content=None, **options) -> str:
+    """Builds a cache key from the normalized prompt, model, selected content and options."""
+    parts = {
+        "provider": provider,
+        "prompt": normalize_prompt(prompt),
+        "model": model,
+        "content": content_hash(selected_content),
+        "options": {k: v for k, v in sorted(options.items()) if v is not None},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with per-entry TTL."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[dict, float] | None:
+        """Returns (value, age_seconds) for a fresh entry, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            age = time.time() - created_at
+            if age > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(value), age
+
+    def set(self, key: str, value: dict, created_at: float | None = None):
+        with self._lock:
+            self._entries[key] = (copy.deepcopy(value), created_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class FirestoreCacheTier:
+    """Persistent cache tier backed by a Firestore collection.
+
+    `collection` may be any object with the Firestore CollectionReference
+    document(id).get()/set() interface, which lets the tier run against the
+    emulator or a local stub.
+    """
+
+    def __init__(self, collection=None, collection_name: str | None = CACHE_FIRESTORE_COLLECTION,
+                 ttl_seconds: float = CACHE_TTL_SECONDS):
+        self._collection = collection
+        self.collection_name = collection_name
+        self.ttl_seconds = ttl_seconds
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            from firebase_admin import firestore
+            self._collection = firestore.client().collection(self.collection_name)
+        return self._collection
+
+    def get(self, key: str) -> tuple[dict, float, float] | None:
+        """Returns (value, age_seconds, created_at) for a fresh entry, or None."""
+        snapshot = self.collection.document(key).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        age = time.time() - data['created_at']
+        if age > self.ttl_seconds:
+            return None
+        return json.loads(data['result']), age, data['created_at']
+
+    def set(self, key: str, value: dict):
+        self.collection.document(key).set({
+            'result': json.dumps(value),
+            'created_at': time.time(),
+        })
+
+class ResponseCache:
+    """Two-tier response cache: in-process LRU in front of an optional persistent tier."""
+
+    def __init__(self, memory: LRUCache | None = None, persistent: FirestoreCacheTier | None = None):
+        self.memory = memory or LRUCache()
+        self.persistent = persistent
+
+    def get(self, key: str) -> tuple[dict, dict] | None:
+        """Returns (result, cache_info) on a hit, or None on a miss."""
+        hit = self.memory.get(key)
+        if hit is not None:
+            value, age = hit
+            return value, {"hit": True, "tier": "memory", "age_s": round(age, 3)}
+
+        if self.persistent is not None:
+            try:
+                hit = self.persistent.get(key)
+            except Exception as e:
+                log_event("Cache", "Persistent tier read failed", severity="WARNING", error=str(e))
+                hit = None
+            if hit is not None:
+                value, age, created_at = hit
+                self.memory.set(key, value, created_at)
+                return value, {"hit": True, "tier": "persistent", "age_s": round(age, 3)}
+
+        return None
+
+    def set(self, key: str, value: dict):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, value)
+            except Exception as e:
+                log_event("Cache", "Persistent tier write failed", severity="WARNING", error=str(e))
+
+response_cache = ResponseCache(
+    persistent=FirestoreCacheTier() if CACHE_FIRESTORE_COLLECTION else None,
+)
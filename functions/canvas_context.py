@@ -0,0 +1,249 @@
+"""
+Token-budgeted canvas summaries: occupancy map, free regions, type/color counts and the selection's neighbours
+"""
+import hashlib
+import heapq
+import json
+import math
+import os
+from collections import Counter
+from cache import LRUCache
+from instrumentation import log_event
+from layout import CANVAS_MIN, CANVAS_MAX
+from prompt_budget import estimate_tokens
+
+# Upper bound on the estimated size of a summary added to a prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '400'))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CONTEXT_CACHE_MAX_ENTRIES', '128'))
+
+# Cells per side of the occupancy map; a power of two so the free-region quadtree divides evenly
+OCCUPANCY_GRID_SIZE = 16
+MAX_FREE_REGIONS = 8
+MAX_NEIGHBOURS = 5
+MAX_COLORS = 6
+
+# Largest snapshot accepted in a request body
+SNAPSHOT_MAX_SHAPES = 20000
+
+# Fields read from Firestore; everything else in a content document is irrelevant to placement
+SNAPSHOT_FIELDS = ["type", "x", "y", "width", "height", "radius", "fill", "text", "fontSize"]
+# Snapshot fields the summary does arithmetic on, and fields it counts or looks up by value
+SNAPSHOT_NUMBER_FIELDS = ("x", "y", "width", "height", "radius", "fontSize")
+SNAPSHOT_LABEL_FIELDS = ("id", "type", "fill")
+
+def valid_snapshot_shape(shape) -> bool:
+    """True if a client-sent shape has finite numbers and string labels wherever the summary reads them."""
+    if not isinstance(shape, dict):
+        return False
+    for field in SNAPSHOT_NUMBER_FIELDS:
+        value = shape.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)):
+            return False
+    return all(shape.get(field) is None or isinstance(shape[field], str) for field in SNAPSHOT_LABEL_FIELDS)
+
+def shape_bounds(shape: dict) -> tuple[float, float, float, float] | None:
+    """Returns a shape's (x0, y0, x1, y1) box, or None if it has no usable position."""
+    x, y = shape.get("x"), shape.get("y")
+    if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+        return None
+    if shape.get("type") == "circle":
+        radius = shape.get("radius") or 0
+        return x - radius, y - radius, x + radius, y + radius
+    if shape.get("type") == "text":
+        font_size = shape.get("fontSize") or 16
+        width = shape.get("width") or font_size * 0.6 * len(str(shape.get("text") or ""))
+        return x, y, x + width, y + (shape.get("height") or font_size * 1.2)
+    return x, y, x + (shape.get("width") or 0), y + (shape.get("height") or 0)
+
+def occupancy_grid(boxes: list, size: int = OCCUPANCY_GRID_SIZE) -> list[list[bool]]:
+    """Marks each canvas cell that any box overlaps; rows run top (CANVAS_MIN) to bottom."""
+    cell = (CANVAS_MAX - CANVAS_MIN) / size
+    grid = [[False] * size for _ in range(size)]
+
+    def cell_index(value):
+        return max(0, min(size - 1, int((value - CANVAS_MIN) // cell)))
+
+    for x0, y0, x1, y1 in boxes:
+        if x1 < CANVAS_MIN or y1 < CANVAS_MIN or x0 > CANVAS_MAX or y0 > CANVAS_MAX:
+            continue
+        for row in range(cell_index(y0), cell_index(y1) + 1):
+            for col in range(cell_index(x0), cell_index(x1) + 1):
+                grid[row][col] = True
+    return grid
+
+def free_regions(grid: list[list[bool]], limit: int = MAX_FREE_REGIONS) -> list[tuple[int, int, int, int]]:
+    """Returns the largest empty quadtree nodes of an occupancy grid as canvas boxes, biggest first.
+
+    A summed-area table makes each node's emptiness check O(1), so the quadtree
+    walk is linear in the number of cells.
+    """
+    size = len(grid)
+    sums = [[0] * (size + 1) for _ in range(size + 1)]
+    for row in range(size):
+        for col in range(size):
+            sums[row + 1][col + 1] = grid[row][col] + sums[row][col + 1] + sums[row + 1][col] - sums[row][col]
+
+    def occupied(row, col, span):
+        return sums[row + span][col + span] - sums[row][col + span] - sums[row + span][col] + sums[row][col]
+
+    regions = []
+    stack = [(0, 0, size)]
+    while stack:
+        row, col, span = stack.pop()
+        if not occupied(row, col, span):
+            regions.append((row, col, span))
+        elif span > 1:
+            half = span // 2
+            stack.extend([(row, col, half), (row, col + half, half), (row + half, col, half), (row + half, col + half, half)])
+
+    cell = (CANVAS_MAX - CANVAS_MIN) / size
+    regions.sort(key=lambda region: (-region[2], region[0], region[1]))
+    return [
+        (round(CANVAS_MIN + col * cell), round(CANVAS_MIN + row * cell),
+         round(CANVAS_MIN + (col + span) * cell), round(CANVAS_MIN + (row + span) * cell))
+        for row, col, span in regions[:limit]
+    ]
+
+def nearest_neighbours(shapes: list[dict], selected: list[dict], k: int = MAX_NEIGHBOURS) -> list[dict]:
+    """Returns the k shapes closest to the selection's centre, excluding the selection itself."""
+    selected_boxes = [box for box in map(shape_bounds, selected) if box]
+    if not selected_boxes:
+        return []
+    cx = sum((box[0] + box[2]) / 2 for box in selected_boxes) / len(selected_boxes)
+    cy = sum((box[1] + box[3]) / 2 for box in selected_boxes) / len(selected_boxes)
+    selected_ids = {shape.get("id") for shape in selected}
+
+    def distance(shape):
+        box = shape_bounds(shape)
+        return math.hypot((box[0] + box[2]) / 2 - cx, (box[1] + box[3]) / 2 - cy)
+
+    candidates = (shape for shape in shapes if shape.get("id") not in selected_ids and shape_bounds(shape))
+    return heapq.nsmallest(k, candidates, key=distance)
+
+def _describe(shape: dict) -> str:
+    box = shape_bounds(shape)
+    return (f"{shape.get('id', '?')} {shape.get('type')} at ({round(box[0])},{round(box[1])}) "
+            f"{round(box[2] - box[0])}x{round(box[3] - box[1])} {shape.get('fill', '')}").strip()
+
+def render_summary(shapes: list[dict], selected: list[dict], colors: int = MAX_COLORS, regions: int = MAX_FREE_REGIONS,
+                   neighbours: int = MAX_NEIGHBOURS, include_map: bool = True) -> str:
+    """Renders a canvas summary with the given section sizes."""
+    boxes = [box for box in map(shape_bounds, shapes) if box]
+    types = Counter(shape.get("type", "unknown") for shape in shapes)
+    lines = [f"CANVAS CONTEXT: {len(shapes)} existing shapes (" +
+             ", ".join(f"{count} {shape_type}" for shape_type, count in types.most_common()) + ")."]
+    if boxes:
+        lines.append(f"Occupied extent: x {round(min(b[0] for b in boxes))}..{round(max(b[2] for b in boxes))}, "
+                     f"y {round(min(b[1] for b in boxes))}..{round(max(b[3] for b in boxes))}.")
+    fills = Counter(shape.get("fill") for shape in shapes if shape.get("fill"))
+    if fills and colors:
+        lines.append("Colors: " + ", ".join(f"{fill} x{count}" for fill, count in fills.most_common(colors)) + ".")
+
+    grid = occupancy_grid(boxes)
+    if include_map and boxes:
+        cell = (CANVAS_MAX - CANVAS_MIN) // OCCUPANCY_GRID_SIZE
+        lines.append(f"Occupancy map ({cell}px cells, top row y={CANVAS_MIN}, left column x={CANVAS_MIN}, #=used .=free):")
+        lines.extend("".join("#" if used else "." for used in row) for row in grid)
+    if regions:
+        free = free_regions(grid, regions)
+        if free:
+            lines.append("Largest free regions (x0,y0,x1,y1): " + " ".join(f"({x0},{y0},{x1},{y1})" for x0, y0, x1, y1 in free))
+            lines.append("Place new shapes inside free regions unless the user asks for a position.")
+
+    if selected and neighbours:
+        nearest = nearest_neighbours(shapes, selected, neighbours)
+        if nearest:
+            lines.append("Nearest to the selection: " + "; ".join(_describe(shape) for shape in nearest) + ".")
+    return "\n".join(lines)
+
+def summarize_canvas(shapes: list[dict], selected: list[dict] | None = None,
+                     budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """Summarizes a canvas within a token budget, dropping detail until it fits.
+
+    Section sizes depend only on the budget, not on the number of shapes, so the
+    summary stays roughly the same size from 10 to 10,000 shapes.
+    """
+    selected = selected or []
+    # Progressively smaller renderings; the last one is just counts and extent
+    for options in (
+        {},
+        {"neighbours": 3, "regions": 4, "colors": 4},
+        {"neighbours": 3, "regions": 4, "colors": 4, "include_map": False},
+        {"neighbours": 1, "regions": 2, "colors": 2, "include_map": False},
+        {"neighbours": 0, "regions": 0, "colors": 0, "include_map": False},
+    ):
+        text = render_summary(shapes, selected, **options)
+        if estimate_tokens(text) <= budget:
+            return text
+    return text
+
+def snapshot_revision(shapes: list[dict]) -> str:
+    """Content hash standing in for a revision when the client sends a snapshot without one."""
+    canonical = json.dumps(shapes, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def load_canvas_snapshot(canvas_id: str, db=None) -> tuple[list[dict], str | None]:
+    """Reads a canvas's content from Firestore, returning (shapes, revision).
+
+    The revision is the latest document update time, matching the revision
+    returned by firestore_writer.commit_commands.
+    """
+    from firebase_admin import firestore
+    db = db or firestore.client()
+    query = db.collection("canvases").document(canvas_id).collection("content").select(SNAPSHOT_FIELDS)
+    shapes = []
+    latest = None
+    for snapshot in query.stream():
+        shape = snapshot.to_dict()
+        shape["id"] = snapshot.id
+        shapes.append(shape)
+        if snapshot.update_time and (latest is None or snapshot.update_time > latest):
+            latest = snapshot.update_time
+    return shapes, latest.isoformat() if latest else None
+
+class CanvasContextProvider:
+    """Builds canvas summaries, cached per canvas revision and selection."""
+
+    def __init__(self, cache: LRUCache | None = None, loader=load_canvas_snapshot):
+        self.cache = cache or LRUCache(max_entries=CONTEXT_CACHE_MAX_ENTRIES)
+        self.loader = loader
+
+    def summary(self, canvas_key: str, revision: str | None, selected_ids: list[str], load) -> tuple[str, dict]:
+        """Returns (summary_text, info), calling load() -> (shapes, revision) only on a cache miss.
+
+        `info["free_regions"]` holds the canvas's largest empty regions as (x0, y0, x1, y1) boxes.
+        """
+        selection = ",".join(sorted(selected_ids))
+        if revision:
+            hit = self.cache.get(f"{canvas_key}:{revision}:{selection}")
+            if hit is not None:
+                entry, _ = hit
+                return entry["summary"], {"cached": True, "revision": revision, "tokens": estimate_tokens(entry["summary"]),
+                                          "free_regions": entry["free_regions"]}
+
+        shapes, loaded_revision = load()
+        revision = revision or loaded_revision
+        wanted = set(selected_ids)
+        text = summarize_canvas(shapes, [shape for shape in shapes if shape.get("id") in wanted])
+        # Kept apart from the text so the fast path can place its layouts without a model
+        regions = free_regions(occupancy_grid([box for box in map(shape_bounds, shapes) if box]))
+        if revision:
+            self.cache.set(f"{canvas_key}:{revision}:{selection}", {"summary": text, "free_regions": regions})
+        info = {"cached": False, "revision": revision, "shapes": len(shapes), "tokens": estimate_tokens(text)}
+        log_event("Canvas Context", "Summarized canvas", canvas=canvas_key, **info)
+        return text, {**info, "free_regions": regions}
+
+    def for_snapshot(self, shapes: list[dict], selected_ids: list[str], revision: str | None = None) -> tuple[str, dict]:
+        """Summarizes a client-supplied snapshot.
+
+        Snapshots are cached by their content hash; `revision` may replace it only
+        when the server issued it, since client revisions are not unique across callers.
+        """
+        revision = revision or snapshot_revision(shapes)
+        return self.summary("snapshot", revision, selected_ids, lambda: (shapes, revision))
+
+    def for_canvas(self, canvas_id: str, selected_ids: list[str], revision: str | None = None) -> tuple[str, dict]:
+        """Summarizes a canvas stored in Firestore; a known revision skips the read on a cache hit."""
+        return self.summary(canvas_id, revision, selected_ids, lambda: self.loader(canvas_id))
+
+canvas_context = CanvasContextProvider()
@@ -0,0 +1,112 @@
+"""
+Incremental, tolerant parser that recovers canvas command objects from streamed model text
+"""
+import json
+import re
+
+# Characters that change parser state outside and inside JSON strings
+_STRUCTURAL = re.compile(r'[{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+class CommandStreamParser:
+    """Extracts every complete top-level JSON object from text fed in arbitrary chunks.
+
+    The scan is a single linear pass that tracks brace depth and string state, so
+    surrounding prose, code fences, a wrapping array or a truncated tail do not
+    prevent the complete objects before it from being recovered.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.skipped = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # Pieces of the object currently being scanned, across chunk boundaries
+        self._pending = []
+
+    def feed(self, chunk: str) -> list[dict]:
+        """Consumes the next chunk and returns the commands completed within it."""
+        found = []
+        pos = 0
+        # Start of the current object's text within this chunk
+        segment_start = 0 if self._depth else None
+        length = len(chunk)
+
+        while pos < length:
+            if self._depth == 0:
+                pos = chunk.find('{', pos)
+                if pos == -1:
+                    break
+                segment_start = pos
+                self._depth = 1
+                pos += 1
+                continue
+
+            if self._escape:
+                self._escape = False
+                pos += 1
+                continue
+
+            if self._in_string:
+                match = _STRING_SPECIAL.search(chunk, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == '\\':
+                    self._escape = True
+                else:
+                    self._in_string = False
+                continue
+
+            match = _STRUCTURAL.search(chunk, pos)
+            if match is None:
+                break
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pending.append(chunk[segment_start:pos])
+                    found.extend(self._decode(''.join(self._pending)))
+                    self._pending = []
+                    segment_start = None
+
+        if self._depth and segment_start is not None:
+            self._pending.append(chunk[segment_start:])
+
+        self.commands.extend(found)
+        return found
+
+    def close(self) -> bool:
+        """Finishes parsing; returns True if the text ended inside an unfinished object."""
+        truncated = self._depth > 0
+        if truncated:
+            self.skipped += 1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._pending = []
+        return truncated
+
+    def _decode(self, text: str) -> list[dict]:
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            self.skipped += 1
+            return []
+        # Some models wrap the array as {"commands": [...]}
+        if "action" not in value and isinstance(value.get("commands"), list):
+            return [command for command in value["commands"] if isinstance(command, dict)]
+        return [value]
+
+def parse_commands(text: str) -> list[dict]:
+    """Parses every complete command object from a full response text."""
+    parser = CommandStreamParser()
+    parser.feed(text)
+    parser.close()
+    return parser.commands
@@ -0,0 +1,191 @@
+"""
+Parallel fan-out for very large shape requests: split the canvas into regions, generate each concurrently, merge
+"""
+import contextvars
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from instrumentation import log_event, span
+from fast_path import GRID_SPEC, SHAPE_NOUNS
+from layout import CANVAS_MIN, CANVAS_MAX, grid_dimensions
+
+# Requested shape count at which a prompt is split into shards
+FANOUT_MIN_SHAPES = int(os.environ.get('AI_FANOUT_MIN_SHAPES', '200'))
+# Target number of shapes each shard is asked for
+FANOUT_SHARD_SIZE = int(os.environ.get('AI_FANOUT_SHARD_SIZE', '100'))
+# Upper bound on concurrent shard requests (and on the number of shards)
+FANOUT_MAX_PARALLEL = int(os.environ.get('AI_FANOUT_MAX_PARALLEL', '8'))
+# Shards still running after this many seconds are dropped from the merge
+FANOUT_SHARD_TIMEOUT_S = float(os.environ.get('AI_FANOUT_SHARD_TIMEOUT_S', '60'))
+
+# "1000 shapes", "500 small red squares", "2,000 colorful circles"; up to three words may sit between
+COUNT_PATTERN = re.compile(r'\b(\d{1,3}(?:,\d{3})+|\d+)((?:\s+[a-z-]+){1,4})')
+
+# Nouns that make a number a shape count
+COUNT_NOUNS = set(SHAPE_NOUNS) | {"shape", "shapes"}
+
+# Words that make a number a measurement ("500 pixels wide", "200px apart") rather than a count
+UNIT_WORDS = {
+    "px", "pixel", "pixels", "pt", "wide", "tall", "high", "long", "radius", "apart",
+    "degree", "degrees", "percent", "units",
+}
+
+def requested_count(prompt: str) -> int | None:
+    """Returns the number of shapes a prompt asks for, if it states one."""
+    text = prompt.lower()
+    grid_match = GRID_SPEC.search(text)
+    if grid_match:
+        return int(grid_match.group(1)) * int(grid_match.group(2))
+    counts = []
+    for match in COUNT_PATTERN.finditer(text):
+        for word in match.group(2).split():
+            if word in UNIT_WORDS:
+                break
+            if word in COUNT_NOUNS:
+                counts.append(int(match.group(1).replace(',', '')))
+                break
+    return max(counts) if counts else None
+
+def partition_regions(shards: int) -> list[dict]:
+    """Splits the canvas into a near-square grid of equal regions, row-major."""
+    rows, cols = grid_dimensions(shards)
+    width = (CANVAS_MAX - CANVAS_MIN) / cols
+    height = (CANVAS_MAX - CANVAS_MIN) / rows
+    regions = []
+    for i in range(shards):
+        row, col = divmod(i, cols)
+        x0 = CANVAS_MIN + col * width
+        y0 = CANVAS_MIN + row * height
+        regions.append({"x0": round(x0), "y0": round(y0), "x1": round(x0 + width), "y1": round(y0 + height)})
+    return regions
+
+def plan_shards(prompt: str, min_shapes: int = FANOUT_MIN_SHAPES, shard_size: int = FANOUT_SHARD_SIZE,
+                max_parallel: int = FANOUT_MAX_PARALLEL) -> list[dict] | None:
+    """Returns one {count, region} entry per shard, or None if the prompt is small enough for one call."""
+    count = requested_count(prompt)
+    if count is None or count < min_shapes:
+        return None
+    shards = max(2, min(max_parallel, -(-count // shard_size)))
+    base, extra = divmod(count, shards)
+    return [
+        {"count": base + (1 if i < extra else 0), "region": region}
+        for i, region in enumerate(partition_regions(shards))
+    ]
+
+def shard_prompt(prompt: str, index: int, shards: list[dict]) -> str:
+    """Rewrites a prompt as one shard of a larger request, confined to its region."""
+    shard = shards[index]
+    region = shard["region"]
+    return (
+        f"{prompt}\n\n"
+        f"This request is being generated in {len(shards)} parallel parts; this is part {index + 1}. "
+        f"Create exactly {shard['count']} of the shapes in this part, and place every shape with "
+        f"x between {region['x0']} and {region['x1']} and y between {region['y0']} and {region['y1']}."
+    )
+
+def _within(value, low, high) -> float:
+    return max(low, min(high, value))
+
+def merge_shard_commands(shards: list[dict], results: list[dict | None]) -> tuple[list[dict], dict]:
+    """Merges shard results into one command list.
+
+    Each shard's create commands are validated, clamped into the shard's region,
+    trimmed to its share and deduplicated by type and position across shards.
+    """
+    merged = []
+    seen = set()
+    stats = {"invalid": 0, "clamped": 0, "duplicates": 0, "trimmed": 0}
+    for shard, result in zip(shards, results):
+        if result is None or not result.get("success"):
+            continue
+        region = shard["region"]
+        kept = 0
+        for command in result["data"].get("commands", []):
+            x, y = command.get("x"), command.get("y")
+            if command.get("action") != "create" or not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+                stats["invalid"] += 1
+                continue
+            if kept >= shard["count"]:
+                stats["trimmed"] += 1
+                continue
+            clamped_x = _within(x, region["x0"], region["x1"])
+            clamped_y = _within(y, region["y0"], region["y1"])
+            if (clamped_x, clamped_y) != (x, y):
+                stats["clamped"] += 1
+                command = {**command, "x": clamped_x, "y": clamped_y}
+            key = (command.get("type"), round(clamped_x), round(clamped_y))
+            if key in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            merged.append(command)
+            kept += 1
+    return merged, stats
+
+def fan_out(prompt: str, call_shard, shards: list[dict], max_parallel: int = FANOUT_MAX_PARALLEL,
+            timeout_s: float = FANOUT_SHARD_TIMEOUT_S) -> dict:
+    """Runs one call per shard concurrently and merges the results.
+
+    `call_shard(shard_prompt)` returns a service result dict. Wall-clock time is
+    bounded by the slowest shard or `timeout_s`, whichever comes first; shards
+    that fail or time out are reported in debug.fanout and left out of the merge.
+    """
+    start = time.time()
+    executor = ThreadPoolExecutor(max_workers=min(max_parallel, len(shards)))
+
+    def run(index):
+        shard_start = time.time()
+        with span('shard'):
+            try:
+                result = call_shard(shard_prompt(prompt, index, shards))
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+        return result, int((time.time() - shard_start) * 1000)
+
+    futures = [executor.submit(contextvars.copy_context().run, run, i) for i in range(len(shards))]
+    done, _ = wait(futures, timeout=timeout_s)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    shard_info = []
+    for shard, future in zip(shards, futures):
+        if future not in done:
+            results.append(None)
+            shard_info.append({"requested": shard["count"], "status": "timeout"})
+            continue
+        result, elapsed_ms = future.result()
+        results.append(result)
+        status = "ok" if result.get("success") else "error"
+        info = {"requested": shard["count"], "status": status, "response_time_ms": elapsed_ms}
+        if status == "ok":
+            info["returned"] = len(result["data"].get("commands", []))
+        else:
+            info["error"] = result.get("error")
+        shard_info.append(info)
+
+    commands, merge_stats = merge_shard_commands(shards, results)
+    completed = sum(1 for info in shard_info if info["status"] == "ok")
+    response_time = int((time.time() - start) * 1000)
+    log_event("Fan-out", "Merged shards", shards=len(shards), completed=completed, commands=len(commands),
+              response_time_ms=response_time)
+
+    if not commands:
+        errors = [info.get("error") or info["status"] for info in shard_info]
+        return {"success": False, "error": f"All {len(shards)} fan-out shards failed: {errors[0]}"}
+
+    first = next(result for result in results if result and result.get("success"))
+    debug = {
+        "provider": first["debug"].get("provider"),
+        "model": first["debug"].get("model"),
+        "response_time_ms": response_time,
+        "fanout": {
+            "shards": len(shards),
+            "completed": completed,
+            "requested": sum(shard["count"] for shard in shards),
+            "merged": len(commands),
+            **merge_stats,
+            "shard_results": shard_info,
+        },
+    }
+    return {"success": True, "data": {"commands": commands}, "debug": debug}
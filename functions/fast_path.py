@@ -0,0 +1,264 @@
+"""
+Local fast path that answers formulaic bulk-shape prompts without calling a model
+"""
+import math
+import re
+import time
+from instrumentation import log_event
+from layout import CANVAS_MIN, CANVAS_MAX, DEFAULT_GAP, layout_positions
+
+# Largest request the fast path will answer; anything bigger goes to the model
+MAX_FAST_PATH_SHAPES = 1000
+
+# Smallest shape size the fast path will shrink to when fitting a layout on the canvas
+MIN_SHAPE_SIZE = 10
+
+# Colors from CANVAS_SYSTEM_PROMPT plus a few common extras
+COLOR_NAMES = {
+    "red": "#FF0000",
+    "blue": "#0000FF",
+    "green": "#00FF00",
+    "yellow": "#FFFF00",
+    "purple": "#800080",
+    "orange": "#FFA500",
+    "black": "#000000",
+    "white": "#FFFFFF",
+    "pink": "#FFC0CB",
+    "gray": "#808080",
+    "grey": "#808080",
+}
+
+# Palette cycled when the prompt does not name a color
+DEFAULT_PALETTE = ["#FF0000", "#0000FF", "#00FF00", "#FFA500", "#800080", "#FFFF00"]
+
+SHAPE_NOUNS = {
+    "square": "square", "squares": "square",
+    "rectangle": "rectangle", "rectangles": "rectangle",
+    "box": "rectangle", "boxes": "rectangle",
+    "circle": "circle", "circles": "circle",
+    "dot": "circle", "dots": "circle",
+}
+
+LAYOUT_WORDS = {
+    "grid": "grid",
+    "row": "row", "rows": "row", "line": "row", "horizontal": "row",
+    "column": "column", "columns": "column", "vertical": "column",
+    "ring": "circle",
+}
+
+SIZE_WORDS = {"tiny": 0.25, "small": 0.5, "big": 1.5, "large": 1.5, "huge": 2}
+
+VARIED_COLOR_WORDS = {"colorful", "colourful", "random", "different", "varied", "various", "rainbow", "multicolored"}
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "fifteen": 15,
+    "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50, "hundred": 100,
+}
+
+# Words that carry no meaning for the layout; any other unknown word falls through to the model
+FILLER_WORDS = {
+    "create", "make", "draw", "add", "generate", "place", "put", "give", "me", "please",
+    "a", "an", "the", "of", "in", "into", "as", "with", "and", "some", "on", "canvas",
+    "arranged", "laid", "out", "shapes", "shape", "colors", "colours", "color", "colour",
+    "sized", "by", "x", "around", "single", "each",
+}
+
+GRID_SPEC = re.compile(r'\b(\d+)\s*(?:x|by|\*)\s*(\d+)\b')
+
+def parse_bulk_prompt(prompt: str) -> dict | None:
+    """Parses a formulaic shape prompt into a layout spec, or returns None if unsure."""
+    text = prompt.lower().strip()
+    rows = cols = None
+    grid_match = GRID_SPEC.search(text)
+    if grid_match:
+        rows, cols = int(grid_match.group(1)), int(grid_match.group(2))
+        text = text[:grid_match.start()] + " grid " + text[grid_match.end():]
+
+    if re.search(r'[^a-z0-9\s,.!*\-]', text):
+        return None
+    tokens = re.findall(r"[a-z]+|\d+", text.replace("-", " "))
+
+    count = None
+    shape = None
+    pattern = None
+    colors = []
+    scale = 1.0
+
+    for i, token in enumerate(tokens):
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else None
+        if token.isdigit() or token in NUMBER_WORDS:
+            value = int(token) if token.isdigit() else NUMBER_WORDS[token]
+            if count is not None and value == 100 and count < 10:
+                count *= value  # "one hundred", "two hundred"
+            elif count is not None:
+                return None
+            else:
+                count = value
+        elif token in COLOR_NAMES:
+            colors.append(COLOR_NAMES[token])
+        elif token in VARIED_COLOR_WORDS:
+            continue
+        elif token in SIZE_WORDS:
+            scale = SIZE_WORDS[token]
+        elif token in ("circle", "circles") and (shape is not None or next_token == "of"):
+            # "squares in a circle" / "a circle of squares" describe the layout, not the shape
+            if pattern is not None:
+                return None
+            pattern = "circle"
+        elif token in SHAPE_NOUNS:
+            if shape is not None:
+                return None
+            shape = SHAPE_NOUNS[token]
+        elif token in LAYOUT_WORDS:
+            if pattern is not None and pattern != LAYOUT_WORDS[token]:
+                return None
+            pattern = LAYOUT_WORDS[token]
+        elif token not in FILLER_WORDS:
+            return None
+
+    if shape is None:
+        return None
+    if rows and cols:
+        if count is not None and count != rows * cols:
+            return None
+        count = rows * cols
+        pattern = "grid"
+    if count is None:
+        # "a red circle" with no number asks for a single shape
+        if not re.search(r'\b(a|an|one|single)\b', text) or tokens[-1].endswith("s"):
+            return None
+        count = 1
+    if count < 1 or count > MAX_FAST_PATH_SHAPES:
+        return None
+
+    return {
+        "shape": shape,
+        "count": count,
+        "pattern": pattern or "grid",
+        "rows": rows,
+        "cols": cols,
+        # "colorful" with no named colors, or no colors at all, cycles the default palette
+        "colors": colors or DEFAULT_PALETTE,
+        "size": 100 * scale,
+    }
+
+def fit_layout(spec: dict) -> tuple[dict, float] | None:
+    """Returns (layout, shape size) shrunk to fit inside the canvas bounds, or None."""
+    canvas_span = CANVAS_MAX - CANVAS_MIN
+    count = spec["count"]
+    size = spec["size"]
+    pattern = spec["pattern"]
+
+    if pattern == "circle":
+        # Ring circumference must hold every shape plus a gap between neighbours
+        while size >= MIN_SHAPE_SIZE:
+            ring_radius = max(count * (size + DEFAULT_GAP) / (2 * math.pi), size + DEFAULT_GAP)
+            if ring_radius + size <= canvas_span / 2:
+                return {"pattern": "circle", "ringRadius": ring_radius}, size
+            size = size * 0.8
+        return None
+
+    if pattern == "row":
+        rows, cols = 1, count
+    elif pattern == "column":
+        rows, cols = count, 1
+    else:
+        cols = spec["cols"] or math.ceil(math.sqrt(count))
+        rows = spec["rows"] or -(-count // cols)
+
+    # Gap stays within the 50-100px spacing rule; only the shape size shrinks
+    longest = max(rows, cols)
+    size = min(size, canvas_span / longest - DEFAULT_GAP)
+    if size < MIN_SHAPE_SIZE:
+        return None
+    return {"pattern": pattern, "rows": rows, "cols": cols}, size
+
+def command_bounds(commands: list[dict]) -> tuple[float, float, float, float]:
+    """Returns the (x0, y0, x1, y1) box around fast-path commands; circles are positioned by their centre."""
+    boxes = [
+        (c["x"] - c["radius"], c["y"] - c["radius"], c["x"] + c["radius"], c["y"] + c["radius"])
+        if c["type"] == "circle" else (c["x"], c["y"], c["x"] + c["width"], c["y"] + c["height"])
+        for c in commands
+    ]
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def place_in_free_region(commands: list[dict], regions: list) -> tuple | None:
+    """Moves commands, in place, to the centre of the first free region that holds them.
+
+    `regions` are (x0, y0, x1, y1) boxes, biggest first. Returns the region used,
+    or None if none is large enough.
+    """
+    x0, y0, x1, y1 = command_bounds(commands)
+    for region in regions:
+        if x1 - x0 <= region[2] - region[0] and y1 - y0 <= region[3] - region[1]:
+            dx = (region[0] + region[2]) / 2 - (x0 + x1) / 2
+            dy = (region[1] + region[3]) / 2 - (y0 + y1) / 2
+            for command in commands:
+                command["x"] = round(command["x"] + dx, 2)
+                command["y"] = round(command["y"] + dy, 2)
+            return tuple(region)
+    return None
+
+def fast_path_commands(prompt: str, selected_content=None, free_regions: list | None = None) -> dict | None:
+    """Returns a service-style result for prompts the fast path can answer, else None.
+
+    With canvas context, `free_regions` lists the canvas's empty regions and the
+    layout is moved into one; if none can hold it the prompt goes to the model.
+    """
+    if selected_content is not None:
+        return None
+
+    start_time = time.time()
+    spec = parse_bulk_prompt(prompt)
+    if spec is None:
+        return None
+    fitted = fit_layout(spec)
+    if fitted is None:
+        return None
+    layout, size = fitted
+    size = round(size, 2)
+
+    shape_type = "circle" if spec["shape"] == "circle" else "rectangle"
+    width = height = size
+    if spec["shape"] == "rectangle":
+        # Plain rectangles read better a little wider than tall
+        height = round(size * 0.6, 2)
+    positions = layout_positions(spec["count"], layout, (width, height), centred=shape_type == "circle")
+
+    colors = spec["colors"]
+    commands = []
+    for i, (x, y) in enumerate(positions):
+        command = {
+            "action": "create",
+            "type": shape_type,
+            "x": round(x, 2),
+            "y": round(y, 2),
+            "fill": colors[i % len(colors)],
+        }
+        if shape_type == "circle":
+            command["radius"] = round(size / 2, 2)
+        else:
+            command["width"] = width
+            command["height"] = height
+        commands.append(command)
+
+    region = None
+    if free_regions is not None:
+        region = place_in_free_region(commands, free_regions)
+        if region is None:
+            return None
+
+    duration = (time.time() - start_time) * 1000
+    log_event("Fast Path", "Served commands", count=len(commands), response_time_ms=round(duration, 3),
+              pattern=layout["pattern"])
+    debug_info = {
+        "path": "fast_path",
+        "provider": "local",
+        "model": None,
+        "response_time_ms": duration,
+        "pattern": layout["pattern"],
+    }
+    if region is not None:
+        debug_info["region"] = region
+    return {"success": True, "data": {"commands": commands}, "debug": debug_info}
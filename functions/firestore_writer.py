@@ -0,0 +1,135 @@
+"""
+Server-side persistence of generated shapes using chunked, parallel Firestore batch commits
+"""
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import log_event, span
+from layout import EDIT_FIELDS
+
+# Firestore allows at most 500 writes per batch
+FIRESTORE_BATCH_LIMIT = 500
+COMMIT_MAX_PARALLEL = int(os.environ.get('AI_COMMIT_MAX_PARALLEL', '4'))
+
+def command_to_content(command: dict, created_by: str, server_timestamp, batch_id: str | None = None) -> dict | None:
+    """Converts a create command into a content document, matching what the client writes."""
+    if command.get("action") != "create":
+        return None
+    shape_type = command.get("type")
+    x, y = command.get("x"), command.get("y")
+    if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+        return None
+
+    content = {"type": shape_type, "version": "v2", "x": x, "y": y}
+    if shape_type == "rectangle":
+        if not isinstance(command.get("width"), (int, float)) or not isinstance(command.get("height"), (int, float)):
+            return None
+        content.update({
+            "width": command["width"],
+            "height": command["height"],
+            "rotation": command.get("rotation") or 0,
+            "fill": command.get("fill") or "#000000",
+            "stroke": command.get("stroke") or "#000000",
+            "strokeWidth": command.get("strokeWidth") or 1,
+        })
+    elif shape_type == "circle":
+        radius = command.get("radius") or (command.get("width") or 0) / 2
+        if not radius:
+            return None
+        content.update({
+            "radius": radius,
+            "fill": command.get("fill") or "#000000",
+            "stroke": command.get("stroke") or "#000000",
+            "strokeWidth": command.get("strokeWidth") or 1,
+        })
+    elif shape_type == "text":
+        if not isinstance(command.get("text"), str):
+            return None
+        content.update({
+            "text": command["text"],
+            "fontSize": command.get("fontSize") or 16,
+            "fontFamily": command.get("fontFamily") or "Arial",
+            "fontStyle": command.get("fontStyle") or "normal",
+            "fill": command.get("fill") or "#000000",
+        })
+        for key in ("width", "height"):
+            if isinstance(command.get(key), (int, float)):
+                content[key] = command[key]
+    else:
+        return None
+
+    content.update({"createdBy": created_by, "createdAt": server_timestamp, "updatedAt": server_timestamp})
+    if batch_id:
+        content["aiBatchId"] = batch_id
+    return content
+
+def command_to_update(command: dict, server_timestamp) -> tuple[str, dict] | None:
+    """Converts an edit command into (shape id, changed fields), matching the client's updates."""
+    shape_id = command.get("shapeId")
+    if command.get("action") != "edit" or not isinstance(shape_id, str) or not shape_id:
+        return None
+    updates = {key: command[key] for key in EDIT_FIELDS if command.get(key) is not None}
+    if not updates:
+        return None
+    updates["updatedAt"] = server_timestamp
+    return shape_id, updates
+
+def commit_commands(canvas_id: str, commands: list[dict], created_by: str, db=None) -> dict:
+    """Writes create and edit commands into canvases/{canvas_id}/content.
+
+    Creates become new documents and edits become updates of their shapeId's
+    document. Writes are split into batches of up to 500 that are committed in
+    parallel. Each batch is atomic on its own; the set as a whole is not. `db` may
+    be any Firestore client (including one pointed at the emulator).
+    Returns the created ids and the updated shape ids.
+    """
+    from firebase_admin import firestore
+    db = db or firestore.client()
+    collection = db.collection("canvases").document(canvas_id).collection("content")
+
+    batch_id = uuid.uuid4().hex
+    documents = []
+    updates = []
+    skipped = 0
+    for command in commands:
+        content = command_to_content(command, created_by, firestore.SERVER_TIMESTAMP, batch_id)
+        if content is not None:
+            documents.append((collection.document(), content))
+            continue
+        update = command_to_update(command, firestore.SERVER_TIMESTAMP)
+        if update is not None:
+            updates.append((collection.document(update[0]), update[1]))
+            continue
+        skipped += 1
+
+    writes = [("set", ref, data) for ref, data in documents] + [("update", ref, data) for ref, data in updates]
+    chunks = [writes[i:i + FIRESTORE_BATCH_LIMIT] for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT)]
+
+    def commit(chunk):
+        batch = db.batch()
+        for operation, ref, data in chunk:
+            getattr(batch, operation)(ref, data)
+        return batch.commit()
+
+    with span("firestore_commit"):
+        if len(chunks) <= 1:
+            results = [commit(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(COMMIT_MAX_PARALLEL, len(chunks))) as executor:
+                results = list(executor.map(commit, chunks))
+
+    # Latest commit time across batches; clients can compare it with snapshot read times
+    update_times = [write.update_time for writes in results for write in writes if getattr(write, "update_time", None)]
+    revision = max(update_times).isoformat() if update_times else None
+
+    log_event("Firestore Writer", "Committed generated shapes", canvas_id=canvas_id, created=len(documents),
+              updated=len(updates), skipped=skipped, batches=len(chunks))
+    return {
+        "canvasId": canvas_id,
+        "ids": [ref.id for ref, _ in documents],
+        "updated": [ref.id for ref, _ in updates],
+        "batchId": batch_id,
+        "batches": len(chunks),
+        "revision": revision,
+        "skipped": skipped,
+    }
@@ -0,0 +1,157 @@
+"""
+Hedged execution across AI providers: start the primary, hedge to the secondary, keep the first valid result
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import log_event
+
+# Fixed delay before the secondary provider is started
+HEDGE_DELAY_MS = float(os.environ.get('AI_HEDGE_DELAY_MS', '3000'))
+# When set (e.g. "95"), hedge after that percentile of the primary's recent latency instead
+HEDGE_PERCENTILE = os.environ.get('AI_HEDGE_PERCENTILE')
+# Samples required before the percentile replaces the fixed delay
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_WORKERS = int(os.environ.get('AI_HEDGE_MAX_WORKERS', '8'))
+
+def percentile(values, pct: float) -> float | None:
+    """Returns the nearest-rank percentile of a sequence, or None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+class HedgeStats:
+    """Thread-safe latency windows and win/hedge counters per provider."""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._window = window
+        self.requests = 0
+        self.hedged = 0
+        self.wins = {}
+
+    def record_latency(self, provider: str, latency_ms: float):
+        with self._lock:
+            self._latencies.setdefault(provider, deque(maxlen=self._window)).append(latency_ms)
+
+    def record_outcome(self, winner: str | None, hedged: bool):
+        with self._lock:
+            self.requests += 1
+            if hedged:
+                self.hedged += 1
+            if winner is not None:
+                self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    def hedge_delay_ms(self, provider: str, pct: str | None = HEDGE_PERCENTILE) -> float:
+        """Returns the hedge delay for a primary provider from its latency history."""
+        if pct:
+            with self._lock:
+                samples = list(self._latencies.get(provider, ()))
+            if len(samples) >= HEDGE_MIN_SAMPLES:
+                return percentile(samples, float(pct))
+        return HEDGE_DELAY_MS
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+                "wins": dict(self.wins),
+                "p50_ms": {name: percentile(values, 50) for name, values in self._latencies.items()},
+                "p95_ms": {name: percentile(values, 95) for name, values in self._latencies.items()},
+            }
+
+hedge_stats = HedgeStats()
+_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+def is_valid_result(result: dict) -> bool:
+    """A result is usable if it succeeded with at least one command parsed from the model's output.
+
+    Replicate's placeholder text shape for unparseable output (`debug.fallback`)
+    does not count, so a fast garbage answer cannot beat a good one.
+    """
+    return bool(result and result.get('success') and result.get('data', {}).get('commands')
+                and not (result.get('debug') or {}).get('fallback'))
+
+def hedged_call(primary: tuple, secondary: tuple, delay_ms: float | None = None, stats: HedgeStats = hedge_stats,
+                validate=is_valid_result, executor: ThreadPoolExecutor | None = None) -> dict:
+    """Runs (name, fn) providers with hedging and returns the first valid result.
+
+    The secondary starts after `delay_ms` (or the primary's percentile latency), or
+    immediately if the primary finishes with an invalid result. The losing call is
+    cancelled if it has not started and otherwise left to finish in the background.
+    """
+    executor = executor or _executor
+    primary_name, primary_fn = primary
+    secondary_name, secondary_fn = secondary
+    if delay_ms is None:
+        delay_ms = stats.hedge_delay_ms(primary_name)
+    start_time = time.time()
+
+    def submit(name, fn):
+        def run():
+            call_start = time.time()
+            try:
+                result = fn()
+            except Exception as e:
+                return {"success": False, "error": str(e)}
+            # Only successful calls feed the latency window used for percentile hedging
+            if result.get('success'):
+                stats.record_latency(name, (time.time() - call_start) * 1000)
+            return result
+        # Run in a copy of the caller's context so spans and logs stay tied to the request
+        future = executor.submit(contextvars.copy_context().run, run)
+        names[future] = name
+        return future
+
+    names = {}
+    pending = {submit(primary_name, primary_fn)}
+    wait(pending, timeout=delay_ms / 1000)
+    hedged = False
+    results = {}
+
+    while True:
+        done = {future for future in pending if future.done()}
+        for future in done:
+            pending.discard(future)
+            result = future.result()
+            results[names[future]] = result
+            if validate(result):
+                for loser in pending:
+                    loser.cancel()
+                return _finish(result, names[future], hedged, delay_ms, start_time, stats)
+
+        if not hedged:
+            hedged = True
+            log_event("Hedging", "Starting secondary provider", provider=secondary_name,
+                      after_ms=round((time.time() - start_time) * 1000, 1))
+            pending.add(submit(secondary_name, secondary_fn))
+        elif not pending:
+            break
+        wait(pending, return_when=FIRST_COMPLETED)
+
+    # Neither provider produced a valid result; report the primary's outcome
+    result = results.get(primary_name) or results.get(secondary_name)
+    return _finish(result, None, hedged, delay_ms, start_time, stats)
+
+def _finish(result: dict, winner: str | None, hedged: bool, delay_ms: float, start_time: float,
+            stats: HedgeStats) -> dict:
+    stats.record_outcome(winner, hedged)
+    duration = (time.time() - start_time) * 1000
+    log_event("Hedging", "Completed", winner=winner, hedged=hedged, response_time_ms=round(duration, 1))
+    if result.get('success'):
+        result.setdefault('debug', {})['hedge'] = {
+            "winner": winner,
+            "hedged": hedged,
+            "hedge_delay_ms": delay_ms,
+            "response_time_ms": duration,
+            "hedge_rate": stats.snapshot()["hedge_rate"],
+        }
+    return result
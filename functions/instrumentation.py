@@ -0,0 +1,223 @@
+"""
+Request tracing: nested timing spans, structured JSON logs, Server-Timing headers and rolling latency histograms
+"""
+import contextvars
+import functools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Keep per-stage latency histograms in memory for the diagnostics endpoint
+TIMING_HISTOGRAM_ENABLED = os.environ.get('AI_TIMING_HISTOGRAM', 'true').lower() == 'true'
+# Samples kept per (model, stage) window
+TIMING_HISTOGRAM_WINDOW = int(os.environ.get('AI_TIMING_HISTOGRAM_WINDOW', '500'))
+# Distinct model names kept in per-model statistics; names are caller-supplied, so later ones share one bucket
+MAX_TRACKED_MODELS = int(os.environ.get('AI_MAX_TRACKED_MODELS', '32'))
+OTHER_MODEL = 'other'
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class RequestTrace:
+    """Timing spans and attributes collected while handling one request."""
+
+    def __init__(self, endpoint: str, request_id: str | None = None):
+        self.endpoint = endpoint
+        self.request_id = request_id or uuid.uuid4().hex
+        self.attributes = {}
+        self.spans = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, parent: str | None, start: float, duration_ms: float, cpu_ms: float):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "parent": parent,
+                "start_ms": round((start - self.start) * 1000, 3),
+                "duration_ms": round(duration_ms, 3),
+                "cpu_ms": round(cpu_ms, 3),
+            })
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def stage_totals(self) -> dict:
+        """Returns total duration per span name, in first-seen order."""
+        totals = {}
+        with self._lock:
+            for span_info in self.spans:
+                totals[span_info["name"]] = totals.get(span_info["name"], 0) + span_info["duration_ms"]
+        return totals
+
+    def server_timing(self) -> str:
+        """Formats the stage totals plus the overall time as a Server-Timing header value."""
+        entries = [f"{_timing_token(name)};dur={duration:.1f}" for name, duration in self.stage_totals().items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+def _timing_token(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_\-]', '_', name)
+
+class LatencyHistogram:
+    """Rolling per-model, per-stage latency windows with percentile snapshots.
+
+    At most `max_models` model names get their own windows; any further names
+    are recorded under OTHER_MODEL.
+    """
+
+    def __init__(self, window: int = TIMING_HISTOGRAM_WINDOW, max_models: int = MAX_TRACKED_MODELS):
+        self._window = window
+        self._max_models = max_models
+        self._models = set()
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, stage: str, duration_ms: float):
+        with self._lock:
+            if model not in self._models:
+                if len(self._models) >= self._max_models:
+                    model = OTHER_MODEL
+                self._models.add(model)
+            key = (model, stage)
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self._window)
+            self._samples[key].append(duration_ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+        report = {}
+        for (model, stage), values in samples.items():
+            report.setdefault(model, {})[stage] = {
+                "count": len(values),
+                "p50_ms": _nearest_rank(values, 50),
+                "p95_ms": _nearest_rank(values, 95),
+                "p99_ms": _nearest_rank(values, 99),
+            }
+        return report
+
+def _nearest_rank(ordered: list, pct: float) -> float:
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return round(ordered[rank], 3)
+
+latency_histogram = LatencyHistogram()
+
+def current_trace() -> RequestTrace | None:
+    return _current_trace.get()
+
+def set_attributes(**attributes):
+    """Attaches attributes (e.g. model, path) to the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+@contextmanager
+def span(name: str):
+    """Times a stage of the current request; a no-op when no trace is active."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        trace.add_span(name, parent, start, (time.perf_counter() - start) * 1000, (time.thread_time() - cpu_start) * 1000)
+
+def log_event(component: str, message: str, severity: str = "INFO", **fields):
+    """Writes one structured JSON log line, tagged with the current request id."""
+    entry = {"severity": severity, "component": component, "message": message}
+    trace = _current_trace.get()
+    if trace is not None:
+        entry["request_id"] = trace.request_id
+    entry.update(fields)
+    print(json.dumps(entry, default=str), flush=True)
+
+def request_id_from(req) -> str | None:
+    """Reuses a caller-supplied or Cloud Trace id so logs correlate across services."""
+    request_id = req.headers.get('X-Request-Id')
+    if request_id:
+        return request_id[:64]
+    cloud_trace = req.headers.get('X-Cloud-Trace-Context')
+    if cloud_trace:
+        return cloud_trace.split('/')[0]
+    return None
+
+def finish_trace(trace: RequestTrace, status: int | None = None):
+    """Logs the trace summary and feeds the latency histogram."""
+    total_ms = trace.elapsed_ms()
+    stages = trace.stage_totals()
+    if TIMING_HISTOGRAM_ENABLED:
+        model = str(trace.attributes.get('model', 'none'))
+        for stage, duration in stages.items():
+            latency_histogram.record(model, stage, duration)
+        latency_histogram.record(model, 'total', total_ms)
+    log_event(
+        "Timing", f"{trace.endpoint} completed in {total_ms:.0f}ms",
+        request_id=trace.request_id,
+        endpoint=trace.endpoint,
+        status=status,
+        total_ms=round(total_ms, 3),
+        stages={name: round(duration, 3) for name, duration in stages.items()},
+        spans=trace.spans,
+        **trace.attributes,
+    )
+
+def traced(endpoint: str):
+    """Decorates an HTTP handler to run inside a request trace.
+
+    Adds Server-Timing and X-Request-Id headers to the response, then logs the
+    trace and records it in the latency histogram.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(req):
+            trace = RequestTrace(endpoint, request_id_from(req))
+            token = _current_trace.set(trace)
+            try:
+                response = handler(req)
+            finally:
+                _current_trace.reset(token)
+            response.headers['Server-Timing'] = trace.server_timing()
+            response.headers['Timing-Allow-Origin'] = '*'
+            response.headers['X-Request-Id'] = trace.request_id
+            response.headers['Access-Control-Expose-Headers'] = 'Server-Timing, X-Request-Id, Retry-After'
+            if not response.is_streamed:
+                finish_trace(trace, response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+def stream_in_trace(iterator):
+    """Wraps a response body iterator so it runs inside the current trace.
+
+    The body of a streamed response is consumed after the handler returns, so the
+    trace context is captured here and re-entered for every chunk; the trace is
+    finished once the stream is exhausted.
+    """
+    trace = _current_trace.get()
+    context = contextvars.copy_context()
+
+    def generate():
+        try:
+            while True:
+                try:
+                    chunk = context.run(next, iterator)
+                except StopIteration:
+                    break
+                yield chunk
+        finally:
+            if trace is not None:
+                context.run(finish_trace, trace, 200)
+
+    return generate()
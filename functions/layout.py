@@ -0,0 +1,259 @@
+"""
+Procedural layout helpers for expanding bulk shape requests and bulk edits into per-shape commands
+"""
+import math
+from prompt_budget import PROMPT_TOKEN_BUDGET
+
+# Canvas coordinate bounds, matching CANVAS_SYSTEM_PROMPT
+CANVAS_MIN = -2000
+CANVAS_MAX = 2000
+
+# Gap left between neighbouring shapes when no spacing is given
+DEFAULT_GAP = 50
+
+# Upper bound on shapes produced by a single bulk request
+MAX_BATCH_SHAPES = 2000
+
+DEFAULT_SIZES = {
+    "rectangle": 100,
+    "circle": 100,
+    "text": 100,
+}
+
+# Per-shape fields that may be supplied as columnar arrays
+COLUMN_FIELDS = (
+    "shapeType", "x", "y", "width", "height", "radius", "fill",
+    "stroke", "strokeWidth", "text", "fontSize", "fontFamily", "fontStyle",
+)
+
+# Fields shared by every shape in a batch unless overridden by a column
+SHARED_FIELDS = (
+    "shapeType", "width", "height", "radius", "fill",
+    "stroke", "strokeWidth", "text", "fontSize", "fontFamily", "fontStyle",
+)
+
+# Properties an edit may change
+EDIT_FIELDS = (
+    "x", "y", "width", "height", "radius", "fill", "stroke", "strokeWidth",
+    "rotation", "text", "fontSize", "fontFamily", "fontStyle",
+)
+
+# Size properties multiplied by an editShapes `scale`
+SCALED_FIELDS = ("width", "height", "radius", "fontSize")
+
+# Estimated prompt tokens per row of the selection table (id, type, position, size and colors)
+SELECTION_TOKENS_PER_SHAPE = 50
+# Prompt tokens left for the system prompt, tool schema and request alongside a selection
+SELECTION_RESERVED_TOKENS = 4000
+
+# Largest selection accepted for a batch edit: as many rows as the prompt budget holds
+MAX_SELECTION_SHAPES = max(1, (PROMPT_TOKEN_BUDGET - SELECTION_RESERVED_TOKENS) // SELECTION_TOKENS_PER_SHAPE)
+
+# Layout settings that must be numbers
+LAYOUT_NUMBER_FIELDS = ("rows", "cols", "spacingX", "spacingY", "originX", "originY", "ringRadius")
+# Shared sizes used to compute the layout extent
+SIZE_FIELDS = ("width", "height", "radius")
+
+def to_number(value) -> float | None:
+    """Returns value as a finite float if it is numeric (or a numeric string), else None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    # "nan", "inf" and JSON NaN/Infinity parse as floats but cannot be placed on the canvas
+    return number if math.isfinite(number) else None
+
+def clamp_to_canvas(value: float) -> float:
+    """Clamps a coordinate to the canvas bounds."""
+    return max(CANVAS_MIN, min(CANVAS_MAX, value))
+
+def shape_extent(shape_type: str, width=None, height=None, radius=None) -> tuple[float, float]:
+    """Returns the (width, height) a shape occupies for layout purposes."""
+    if shape_type == "circle" and radius is not None:
+        return radius * 2, radius * 2
+    default = DEFAULT_SIZES.get(shape_type, 100)
+    return (width if width is not None else default), (height if height is not None else default)
+
+def grid_dimensions(count: int, rows=None, cols=None) -> tuple[int, int]:
+    """Resolves grid rows and columns, filling in whichever is missing."""
+    if rows and cols:
+        return int(rows), int(cols)
+    if cols:
+        return math.ceil(count / cols), int(cols)
+    if rows:
+        return int(rows), math.ceil(count / rows)
+    cols = math.ceil(math.sqrt(count))
+    return math.ceil(count / cols), cols
+
+def grid_positions(count: int, rows: int, cols: int, origin_x: float, origin_y: float,
+                   step_x: float, step_y: float) -> list[tuple[float, float]]:
+    """Returns row-major positions for a grid, starting at the top-left origin."""
+    positions = []
+    for i in range(min(count, rows * cols)):
+        row, col = divmod(i, cols)
+        positions.append((origin_x + col * step_x, origin_y + row * step_y))
+    return positions
+
+def circle_positions(count: int, center_x: float, center_y: float, ring_radius: float) -> list[tuple[float, float]]:
+    """Returns positions evenly spaced around a circle, starting at the top."""
+    positions = []
+    for i in range(count):
+        angle = 2 * math.pi * i / count - math.pi / 2
+        positions.append((center_x + ring_radius * math.cos(angle), center_y + ring_radius * math.sin(angle)))
+    return positions
+
+def layout_positions(count: int, layout: dict, extent: tuple[float, float],
+                     centred: bool = False) -> list[tuple[float, float]]:
+    """Expands a compact layout spec into a list of positions.
+
+    Supported patterns are "grid" (default), "row", "column" and "circle". Positions
+    are top-left corners, or shape centres when `centred` (circles). When no origin
+    is given the shapes' bounding box is centred on the canvas origin.
+    """
+    pattern = layout.get("pattern", "grid")
+    step_x = layout.get("spacingX") or extent[0] + DEFAULT_GAP
+    step_y = layout.get("spacingY") or extent[1] + DEFAULT_GAP
+    # A top-left corner sits half a shape up and left of the shape's centre
+    shift_x, shift_y = (0, 0) if centred else (extent[0] / 2, extent[1] / 2)
+
+    if pattern == "circle":
+        # Default ring keeps neighbours roughly one step apart
+        ring_radius = layout.get("ringRadius") or max(step_x * count / (2 * math.pi), step_x)
+        return circle_positions(count, layout.get("originX", -shift_x), layout.get("originY", -shift_y), ring_radius)
+
+    if pattern == "row":
+        rows, cols = 1, count
+    elif pattern == "column":
+        rows, cols = count, 1
+    else:
+        rows, cols = grid_dimensions(count, layout.get("rows"), layout.get("cols"))
+
+    origin_x = layout.get("originX", -(cols - 1) * step_x / 2 - shift_x)
+    origin_y = layout.get("originY", -(rows - 1) * step_y / 2 - shift_y)
+    return grid_positions(count, rows, cols, origin_x, origin_y, step_x, step_y)
+
+def _layout_spec(layout) -> dict:
+    """Keeps a model-supplied layout's pattern and its numeric settings, as numbers."""
+    if not isinstance(layout, dict):
+        return {}
+    spec = {key: to_number(layout.get(key)) for key in LAYOUT_NUMBER_FIELDS}
+    spec = {key: value for key, value in spec.items() if value is not None}
+    if isinstance(layout.get("pattern"), str):
+        spec["pattern"] = layout["pattern"]
+    return spec
+
+def expand_shape_batch(args: dict) -> list[dict]:
+    """Expands createShapes tool arguments into per-shape createShape arguments.
+
+    Per-shape values come from `columns` arrays when present; anything missing falls
+    back to the shared fields, `colors` is cycled for fills, and positions not given
+    in columns are generated from `layout`. Model arguments that are not numbers
+    where numbers belong are ignored, and shapes left without a position are skipped.
+    """
+    columns = args.get("columns") if isinstance(args.get("columns"), dict) else {}
+    column_lengths = [len(values) for key, values in columns.items() if key in COLUMN_FIELDS and isinstance(values, list)]
+    count = to_number(args.get("count")) or (max(column_lengths) if column_lengths else 0)
+    count = min(int(count), MAX_BATCH_SHAPES)
+    if count <= 0:
+        return []
+
+    shared = {key: args[key] for key in SHARED_FIELDS if args.get(key) is not None}
+    for key in SIZE_FIELDS:
+        if key in shared:
+            shared[key] = to_number(shared[key])
+            if shared[key] is None or shared[key] <= 0:
+                del shared[key]
+    if not isinstance(shared.get("shapeType"), str):
+        shared["shapeType"] = "rectangle"
+    colors = args.get("colors") if isinstance(args.get("colors"), list) else []
+
+    positions = None
+    if not (isinstance(columns.get("x"), list) and isinstance(columns.get("y"), list)):
+        extent = shape_extent(shared["shapeType"], shared.get("width"), shared.get("height"), shared.get("radius"))
+        positions = layout_positions(count, _layout_spec(args.get("layout")), extent,
+                                     centred=shared["shapeType"] == "circle")
+
+    shapes = []
+    for i in range(count):
+        shape = dict(shared)
+        if colors:
+            shape["fill"] = colors[i % len(colors)]
+        if positions is not None and i < len(positions):
+            shape["x"], shape["y"] = positions[i]
+        for key in COLUMN_FIELDS:
+            values = columns.get(key)
+            if isinstance(values, list) and i < len(values) and values[i] is not None:
+                shape[key] = values[i]
+        x, y = to_number(shape.get("x")), to_number(shape.get("y"))
+        if x is None or y is None:
+            continue
+        shape["x"] = clamp_to_canvas(round(x, 2))
+        shape["y"] = clamp_to_canvas(round(y, 2))
+        shapes.append(shape)
+    return shapes
+
+def selected_shapes(selected_content) -> list[dict]:
+    """Normalizes selectedContent (one shape or a list of shapes) to a list of shapes."""
+    if isinstance(selected_content, dict):
+        return [selected_content]
+    if isinstance(selected_content, list):
+        return [shape for shape in selected_content[:MAX_SELECTION_SHAPES] if isinstance(shape, dict)]
+    return []
+
+def _edit_delta(shape: dict, changes: dict) -> dict:
+    """Keeps only the changes that differ from the shape's current values."""
+    return {key: value for key, value in changes.items() if key in EDIT_FIELDS and shape.get(key) != value}
+
+def expand_shape_edits(args: dict, selected: list[dict]) -> list[dict]:
+    """Expands editShapes tool arguments into one edit command per selected shape.
+
+    `changes` applies the same values to every target, `offset` moves each target
+    by {x, y}, `scale` multiplies its sizes and `perShape` entries ({id, ...})
+    override values for individual shapes. Targets are `ids`, or the whole
+    selection when omitted. Commands only carry properties that actually change.
+    """
+    shapes_by_id = {shape["id"]: shape for shape in selected if shape.get("id")}
+    ids = args.get("ids") or list(shapes_by_id)
+    changes = args.get("changes") or {}
+    offset = args.get("offset") or {}
+    scale = args.get("scale")
+    per_shape = {entry["id"]: entry for entry in args.get("perShape") or [] if isinstance(entry, dict) and entry.get("id")}
+
+    commands = []
+    for shape_id in dict.fromkeys(list(ids) + list(per_shape)):
+        shape = shapes_by_id.get(shape_id)
+        if shape is None:
+            # Only shapes the user selected may be edited
+            continue
+        values = dict(changes)
+        for axis in ("x", "y"):
+            if isinstance(offset.get(axis), (int, float)) and isinstance(shape.get(axis), (int, float)):
+                values[axis] = clamp_to_canvas(round(shape[axis] + offset[axis], 2))
+        if isinstance(scale, (int, float)) and scale > 0:
+            for key in SCALED_FIELDS:
+                if isinstance(shape.get(key), (int, float)):
+                    values[key] = round(shape[key] * scale, 2)
+        values.update({key: value for key, value in per_shape.get(shape_id, {}).items() if key != "id"})
+        delta = _edit_delta(shape, values)
+        if delta:
+            commands.append({"action": "edit", "shapeId": shape_id, **delta})
+    return commands
+
+def expand_edit_commands(commands: list[dict], selected: list[dict]) -> list[dict]:
+    """Expands editShapes commands and targets plain edits at a single selected shape."""
+    expanded = []
+    for command in commands:
+        if command.get("action") == "editShapes":
+            expanded.extend(expand_shape_edits(command, selected))
+        elif command.get("action") == "edit" and not command.get("shapeId") and len(selected) == 1 and selected[0].get("id"):
+            expanded.append({**command, "shapeId": selected[0]["id"]})
+        else:
+            expanded.append(command)
+    return expanded
@@ -1,15 +1,322 @@
-
 from firebase_functions import https_fn
 from firebase_functions.options import set_global_options
 from firebase_admin import initialize_app
 import json
-from utils import handle_cors, validate_request
-from openai_service import text_to_canvas_commands
+import math
+import time
+from utils import handle_cors, validate_request, get_auth_uid, wants_event_stream, format_stream_frame
+from openai_service import text_to_canvas_commands, stream_text_to_canvas_commands
 from replicate_service import text_to_canvas_commands_replicate
+from fast_path import fast_path_commands
+from cache import response_cache, make_cache_key, content_hash
+from canvas_context import canvas_context, valid_snapshot_shape, SNAPSHOT_MAX_SHAPES
+from hedging import hedged_call, hedge_stats, is_valid_result
+from fanout import plan_shards, fan_out, FANOUT_SHARD_TIMEOUT_S
+from postprocess import postprocess_commands
+from layout import selected_shapes
+from singleflight import single_flight
+from prompt_budget import prompt_cache_stats
+from firestore_writer import commit_commands
+from router import model_router, model_stats, DEFAULT_MODEL, AUTO_MODEL
+from resilience import with_deadline, remaining_s, breakers, error_status, CircuitOpenError, DeadlineExceeded, FUNCTION_TIMEOUT_S
+from sessions import session_store, is_follow_up
+from admission import admission, AdmissionRejected, FUNCTION_CONCURRENCY, client_key, estimate_completion_tokens
+from response_format import DEBUG_LEVELS, DEFAULT_DEBUG_LEVEL, shape_result, shape_debug, encode_body
+from instrumentation import traced, span, set_attributes, log_event, stream_in_trace, latency_histogram
 
-set_global_options(max_instances=10)
+# Request deadlines end DEADLINE_MARGIN_S before this timeout, so a hung upstream call gets a 504
+if FUNCTION_CONCURRENCY > 1:
+    # Concurrent requests per instance need at least one full vCPU
+    set_global_options(max_instances=10, timeout_sec=FUNCTION_TIMEOUT_S, concurrency=FUNCTION_CONCURRENCY, cpu=1)
+else:
+    set_global_options(max_instances=10, timeout_sec=FUNCTION_TIMEOUT_S)
 initialize_app()
 
+# Times a coalesced request starts over after the call it waited on was shed
+COALESCE_MAX_ATTEMPTS = 3
+
+def provider_options(provider: str, request_data: dict) -> dict:
+    """Returns the sampling options a provider honours, which also form part of the cache key."""
+    if provider == 'replicate':
+        return {}
+    return {'temperature': request_data.get('temperature', 1.0), 'seed': request_data.get('seed')}
+
+def call_provider(provider: str, prompt: str, model: str, selected_content, request_data: dict,
+                  canvas_context: str | None = None) -> dict:
+    """Calls the service for a provider ('openai', 'replicate' or 'hedged')."""
+    if provider in ('openai', 'replicate'):
+        start_time = time.time()
+        if provider == 'openai':
+            options = provider_options(provider, request_data)
+            result = text_to_canvas_commands(prompt, model, selected_content, canvas_context=canvas_context, **options)
+        else:
+            result = text_to_canvas_commands_replicate(prompt, model, selected_content, canvas_context)
+        # Every single-provider call, including hedge legs and fan-out shards, feeds the router
+        model_router.record_result(provider, model, result, (time.time() - start_time) * 1000)
+        return result
+
+    primary = request_data.get('primary', 'openai')
+    secondary = 'replicate' if primary == 'openai' else 'openai'
+    secondary_model = request_data.get('secondaryModel', model)
+    # Fail over straight to the other provider while one breaker is open; hedging needs both
+    if breakers[primary].is_open() and not breakers[secondary].is_open():
+        log_event("Hedging", "Primary circuit open, failing over", provider=secondary)
+        set_attributes(failover=secondary)
+        return call_provider(secondary, prompt, secondary_model, selected_content, request_data, canvas_context)
+    if breakers[secondary].is_open():
+        return call_provider(primary, prompt, model, selected_content, request_data, canvas_context)
+    return hedged_call(
+        (primary, lambda: call_provider(primary, prompt, model, selected_content, request_data, canvas_context)),
+        (secondary, lambda: call_provider(secondary, prompt, secondary_model, selected_content, request_data,
+                                          canvas_context)),
+        delay_ms=request_data.get('hedgeDelayMs'),
+    )
+
+def call_with_fanout(provider: str, prompt: str, model: str, selected_content, request_data: dict,
+                     canvas_context: str | None = None) -> dict:
+    """Calls the provider once, or once per canvas region for prompts asking for very many shapes."""
+    shards = plan_shards(prompt) if request_data.get('fanOut', True) and selected_content is None else None
+    if shards is None:
+        return call_provider(provider, prompt, model, selected_content, request_data, canvas_context)
+    set_attributes(fanout_shards=len(shards))
+    remaining = remaining_s()
+    return fan_out(
+        prompt,
+        lambda shard_prompt: call_provider(provider, shard_prompt, model, selected_content, request_data, canvas_context),
+        shards,
+        timeout_s=FANOUT_SHARD_TIMEOUT_S if remaining is None else max(0.0, min(FANOUT_SHARD_TIMEOUT_S, remaining)),
+    )
+
+def overlap_option(request_data: dict) -> bool | None:
+    """Returns the request's `resolveOverlaps` choice, or None to resolve overlaps only in bulk output."""
+    value = request_data.get('resolveOverlaps')
+    return None if value is None else bool(value)
+
+def postprocess_result(result: dict, request_data: dict) -> dict:
+    """Validates, clamps and de-overlaps a provider result's commands in place."""
+    if result['success']:
+        fix_overlaps = overlap_option(request_data)
+        # Merged fan-out shards are bulk output however many shapes came back
+        if fix_overlaps is None and 'fanout' in result['debug']:
+            fix_overlaps = True
+        with span('postprocess'):
+            commands, stats = postprocess_commands(result['data']['commands'], fix_overlaps=fix_overlaps)
+        result['data']['commands'] = commands
+        result['debug']['postprocess'] = stats
+    return result
+
+def rejected_result(error: AdmissionRejected) -> dict:
+    """Turns a shed request into a failed result carrying its 429 status and retry delay."""
+    set_attributes(path='shed', shed_reason=error.reason)
+    return {'success': False, 'error': str(error), 'status': 429, 'retry_after': error.retry_after}
+
+def route_model(provider: str, prompt: str, selected_content, request_data: dict) -> tuple[str, dict]:
+    """Picks a model for an "auto" request; hedged requests route on the primary provider's statistics."""
+    stats_provider = request_data.get('primary', 'openai') if provider == 'hedged' else provider
+    with span('route'):
+        model, route = model_router.route(stats_provider, prompt, selected_content)
+    set_attributes(model=model, tier=route['tier'])
+    return model, route
+
+def generate_commands(provider: str, request_data: dict, context: tuple[str, dict] | None = None,
+                      client: str | None = None) -> dict:
+    """Runs a validated request through the fast path, response cache, single-flight and provider service.
+
+    `context` is the (summary, info) pair from resolve_canvas_context, if any.
+    `client` is the caller's rate-limit key; model calls must pass admission for it.
+    """
+    prompt = request_data['prompt']
+    model = request_data.get('model', DEFAULT_MODEL)
+    selected_content = request_data.get('selectedContent')
+    canvas_summary, context_info = context or (None, None)
+
+    # With canvas context the fast path moves its layout into a free region, or leaves the prompt to the model
+    if request_data.get('fastPath', True):
+        with span('fast_path'):
+            result = fast_path_commands(prompt, selected_content, (context_info or {}).get('free_regions'))
+        if result is not None:
+            if context_info:
+                result['debug']['canvas_context'] = context_info
+            set_attributes(path='fast_path')
+            return result
+
+    options = provider_options(provider, request_data)
+    use_cache = request_data.get('cache', True)
+    # Disabling fan-out or choosing overlap resolution changes the result, so each gets its own key
+    fanout = None if request_data.get('fanOut', True) else False
+    cache_key = make_cache_key(provider, prompt, model, selected_content, fanout=fanout,
+                               overlaps=overlap_option(request_data),
+                               context=content_hash(canvas_summary), **options)
+    if use_cache:
+        with span('cache'):
+            cached = response_cache.get(cache_key)
+        if cached is not None:
+            result, cache_info = cached
+            result['debug']['path'] = 'cache'
+            result['debug']['cache'] = cache_info
+            if context_info:
+                result['debug']['canvas_context'] = context_info
+            set_attributes(path='cache')
+            return result
+
+    # The cache is keyed by the requested model, so "auto" requests share entries whichever model served them
+    route = None
+    if model == AUTO_MODEL:
+        model, route = route_model(provider, prompt, selected_content, request_data)
+
+    # Fast-path and cache hits above are free, and so is waiting on another caller's identical call;
+    # only the single-flight leader pays from its bucket and takes a model-call slot
+    led = False
+
+    def model_call():
+        nonlocal led
+        led = True
+        with admission.admit(client or 'anonymous', estimate_completion_tokens(prompt)):
+            return postprocess_result(
+                call_with_fanout(provider, prompt, model, selected_content, request_data, canvas_summary),
+                request_data,
+            )
+
+    for attempt in range(1, COALESCE_MAX_ATTEMPTS + 1):
+        try:
+            # Identical concurrent requests share one upstream call
+            with span('provider'):
+                result, flight_info = single_flight.do(cache_key, model_call)
+            break
+        except AdmissionRejected as e:
+            # A leader shed for its own limits says nothing about this caller's; try again as leader
+            if led or attempt == COALESCE_MAX_ATTEMPTS:
+                return rejected_result(e)
+        except DeadlineExceeded as e:
+            return {'success': False, 'error': str(e), **error_status(e)}
+    if result['success']:
+        # Replicate's placeholder for unparseable output is returned but never cached
+        if use_cache and flight_info['leader'] and is_valid_result(result):
+            response_cache.set(cache_key, result)
+        result['debug']['path'] = 'model'
+        result['debug']['cache'] = {'hit': False} if use_cache else {'hit': False, 'bypassed': True}
+        result['debug']['singleflight'] = flight_info
+        if route:
+            result['debug']['route'] = route
+        if context_info:
+            result['debug']['canvas_context'] = context_info
+    set_attributes(path='model')
+    return result
+
+def selected_ids(selected_content) -> list[str]:
+    """Returns the ids of the selected shapes."""
+    return [shape['id'] for shape in selected_shapes(selected_content) if shape.get('id')]
+
+def snapshot_error(snapshot) -> https_fn.Response | None:
+    """Returns a 400 response unless `canvasSnapshot` is a bounded list of shapes with numeric geometry."""
+    if not isinstance(snapshot, list) or len(snapshot) > SNAPSHOT_MAX_SHAPES or not all(map(valid_snapshot_shape, snapshot)):
+        return json_error(400, f'canvasSnapshot must be a list of at most {SNAPSHOT_MAX_SHAPES} shapes '
+                               'with numeric positions and sizes')
+    return None
+
+def resolve_canvas_context(req: https_fn.Request, request_data: dict) -> tuple[tuple[str, dict] | None, https_fn.Response | None]:
+    """Returns a (summary, info) pair for the request's canvas, or an error response.
+
+    The canvas comes from a `canvasSnapshot` list in the body or, with
+    `canvasContext: true`, from Firestore for `canvasId`. For a stored canvas, a
+    `canvasRevision` lets a cached summary be reused without reading it again.
+    """
+    snapshot = request_data.get('canvasSnapshot')
+    revision = request_data.get('canvasRevision')
+    ids = selected_ids(request_data.get('selectedContent'))
+
+    if snapshot is not None:
+        error_response = snapshot_error(snapshot)
+        if error_response:
+            return None, error_response
+        with span('canvas_context'):
+            # The client's canvasRevision is not unique across callers, so snapshots are keyed by content
+            return canvas_context.for_snapshot(snapshot, ids), None
+
+    if not request_data.get('canvasContext'):
+        return None, None
+    canvas_id = request_data.get('canvasId')
+    if not isinstance(canvas_id, str) or not canvas_id or '/' in canvas_id or len(canvas_id) > 128:
+        return None, json_error(400, 'canvasContext requires a valid canvasId')
+    # Server reads bypass security rules, so require the same signed-in user the rules would
+    if get_auth_uid(req) is None:
+        return None, json_error(401, 'canvasContext requires a valid Firebase ID token')
+    try:
+        with span('canvas_context'):
+            return canvas_context.for_canvas(canvas_id, ids, revision), None
+    except Exception as e:
+        # Context only improves placement; carry on without it
+        log_event("Canvas Context", "Failed to load canvas", severity="WARNING", canvas=canvas_id, error=str(e))
+        return None, None
+
+def json_error(status: int, message: str) -> https_fn.Response:
+    """Builds a JSON error response."""
+    return https_fn.Response(
+        json.dumps({'success': False, 'error': message}),
+        status=status,
+        headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    )
+
+def commit_target(req: https_fn.Request, request_data: dict) -> tuple[tuple[str, str] | None, https_fn.Response | None]:
+    """Returns (canvas_id, uid) when the request opts into server-side commits, or an error response."""
+    if not request_data.get('commit'):
+        return None, None
+
+    canvas_id = request_data.get('canvasId')
+    if not isinstance(canvas_id, str) or not canvas_id or '/' in canvas_id or len(canvas_id) > 128:
+        return None, json_error(400, 'commit requires a valid canvasId')
+
+    # Server writes bypass security rules, so require the same signed-in user the rules would
+    uid = get_auth_uid(req)
+    if uid is None:
+        return None, json_error(401, 'commit requires a valid Firebase ID token')
+    return (canvas_id, uid), None
+
+def caller_key(req: https_fn.Request, target: tuple[str, str] | None = None) -> str:
+    """Returns the rate-limit key for a request, reusing the uid already verified for a commit."""
+    return client_key(req, target[1] if target else get_auth_uid(req))
+
+def commit_result(result: dict, canvas_id: str, uid: str) -> dict:
+    """Writes a result's commands to Firestore and replaces them with the created ids."""
+    if not result['success']:
+        return result
+    try:
+        result['data'] = commit_commands(canvas_id, result['data']['commands'], uid)
+    except Exception as e:
+        log_event("Firestore Writer", "Commit failed", severity="ERROR", error=str(e))
+        return {'success': False, 'error': f'Failed to save shapes: {str(e)}'}
+    return result
+
+def debug_level(request_data: dict) -> str:
+    """Returns the requested debug level, falling back to the default for unknown values."""
+    level = request_data.get('debug', DEFAULT_DEBUG_LEVEL)
+    return level if level in DEBUG_LEVELS else DEFAULT_DEBUG_LEVEL
+
+def commands_response(result: dict, req: https_fn.Request, request_data: dict) -> https_fn.Response:
+    """Builds the JSON HTTP response for a service result, shaped and compressed as requested."""
+    if result['success']:
+        with span('serialize'):
+            payload = shape_result(result, debug_level(request_data), bool(request_data.get('compact')))
+            body, content_encoding = encode_body(json.dumps(payload, separators=(',', ':')),
+                                                 req.headers.get('Accept-Encoding'))
+        headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding'}
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        return https_fn.Response(
+            body,
+            status=200,
+            headers=headers
+        )
+    else:
+        headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+        if 'retry_after' in result:
+            headers['Retry-After'] = str(result['retry_after'])
+        return https_fn.Response(
+            json.dumps({'success': False, 'error': result['error']}),
+            status=result.get('status', 500),
+            headers=headers
+        )
+
 @https_fn.on_request()
 def hello_world(req: https_fn.Request) -> https_fn.Response:
     cors_response = handle_cors(req)
@@ -24,71 +331,353 @@ def hello_world(req: https_fn.Request) -> https_fn.Response:
     )
 
 @https_fn.on_request(secrets=["OPENAI_API_KEY"])
+@traced('ai_text_to_canvas')
+@with_deadline
 def ai_text_to_canvas(req: https_fn.Request) -> https_fn.Response:
     cors_response = handle_cors(req)
     if cors_response:
         return cors_response
 
-    request_data, error_response = validate_request(req)
+    with span('validate'):
+        request_data, error_response = validate_request(req)
     if error_response:
         return error_response
 
-    prompt = request_data['prompt']
-    model = request_data.get('model', 'gpt-5-mini')
-    selected_content = request_data.get('selectedContent')
+    target, error_response = commit_target(req, request_data)
+    if error_response:
+        return error_response
 
-    print(f"[OpenAI Endpoint] Request - Model: {model}, Has selected content: {selected_content is not None}")
+    context, error_response = resolve_canvas_context(req, request_data)
+    if error_response:
+        return error_response
 
-    result = text_to_canvas_commands(prompt, model, selected_content)
+    model = request_data.get('model', DEFAULT_MODEL)
+    selected_content = request_data.get('selectedContent')
 
-    print(f"[OpenAI Endpoint] Response - Success: {result['success']}, Commands: {len(result.get('data', {}).get('commands', []))}")
-    if not result['success']:
-        print(f"[OpenAI Endpoint] Error: {result.get('error')}")
+    set_attributes(model=model)
+    log_event("OpenAI Endpoint", "Request", model=model, has_selected_content=selected_content is not None)
+
+    result = generate_commands('openai', request_data, context, caller_key(req, target))
 
     if result['success']:
-        return https_fn.Response(
-            json.dumps(result),
-            status=200,
-            headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
-        )
+        log_event("OpenAI Endpoint", "Response", commands=len(result['data']['commands']), path=result['debug'].get('path'))
     else:
-        return https_fn.Response(
-            json.dumps({'success': False, 'error': result['error']}),
-            status=500,
-            headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
-        )
+        log_event("OpenAI Endpoint", "Error", severity="ERROR", error=result.get('error'))
 
-@https_fn.on_request(secrets=["REPLICATE_API_TOKEN"])
-def ai_text_to_canvas_replicate(req: https_fn.Request) -> https_fn.Response:
+    if target:
+        result = commit_result(result, *target)
+
+    return commands_response(result, req, request_data)
+
+@https_fn.on_request(secrets=["OPENAI_API_KEY"])
+@traced('ai_text_to_canvas_stream')
+@with_deadline
+def ai_text_to_canvas_stream(req: https_fn.Request) -> https_fn.Response:
     cors_response = handle_cors(req)
     if cors_response:
         return cors_response
 
-    request_data, error_response = validate_request(req)
+    with span('validate'):
+        request_data, error_response = validate_request(req)
+    if error_response:
+        return error_response
+
+    context, error_response = resolve_canvas_context(req, request_data)
     if error_response:
         return error_response
+    canvas_summary, context_info = context or (None, None)
 
     prompt = request_data['prompt']
-    model = request_data.get('model', 'gpt-5-mini')
+    model = request_data.get('model', DEFAULT_MODEL)
     selected_content = request_data.get('selectedContent')
+    temperature = request_data.get('temperature', 1.0)
+    seed = request_data.get('seed')
+    sse = wants_event_stream(req, request_data)
+    level = debug_level(request_data)
 
-    print(f"[Replicate Endpoint] Request - Model: {model}, Has selected content: {selected_content is not None}")
+    set_attributes(model=model)
+    log_event("OpenAI Stream Endpoint", "Request", model=model, has_selected_content=selected_content is not None, sse=sse)
 
-    result = text_to_canvas_commands_replicate(prompt, model, selected_content)
+    fast_result = None
+    if request_data.get('fastPath', True):
+        with span('fast_path'):
+            fast_result = fast_path_commands(prompt, selected_content, (context_info or {}).get('free_regions'))
 
-    print(f"[Replicate Endpoint] Response - Success: {result['success']}, Commands: {len(result.get('data', {}).get('commands', []))}")
-    if not result['success']:
-        print(f"[Replicate Endpoint] Error: {result.get('error')}")
+    route = None
+    if fast_result is None and model == AUTO_MODEL:
+        model, route = route_model('openai', prompt, selected_content, request_data)
+
+    # Admit model streams before the response starts so a shed request can still get a 429
+    if fast_result is None:
+        try:
+            breakers['openai'].ensure_closed()
+        except CircuitOpenError as e:
+            return commands_response({'success': False, 'error': str(e), **error_status(e)}, req, request_data)
+        try:
+            admission.acquire(caller_key(req), estimate_completion_tokens(prompt))
+        except AdmissionRejected as e:
+            return commands_response(rejected_result(e), req, request_data)
+
+    stream_start = time.time()
+
+    def generate():
+        if fast_result is not None:
+            commands = fast_result['data']['commands']
+            events = [{'type': 'command', 'command': command} for command in commands]
+            events.append({'type': 'done', 'success': True, 'count': len(commands), 'debug': fast_result['debug']})
+        else:
+            events = stream_text_to_canvas_commands(prompt, model, selected_content, temperature, seed, canvas_summary)
+
+        for event in events:
+            if event['type'] == 'command' and fast_result is None:
+                # Streamed commands are validated one at a time; overlaps need the whole batch
+                commands, _ = postprocess_commands([event['command']], fix_overlaps=False)
+                if not commands:
+                    continue
+                event['command'] = commands[0]
+            elif event['type'] == 'done':
+                if fast_result is None:
+                    model_router.record('openai', model, event['debug']['response_time_ms'], event['count'] > 0)
+                    if route:
+                        event['debug']['route'] = route
+                event['debug'].setdefault('path', 'model')
+                if context_info:
+                    event['debug']['canvas_context'] = context_info
+                set_attributes(path=event['debug']['path'])
+                log_event("OpenAI Stream Endpoint", "Response", commands=event['count'], path=event['debug']['path'])
+                event['debug'] = shape_debug(event['debug'], level)
+                if event['debug'] is None:
+                    del event['debug']
+            elif event['type'] == 'error':
+                if event.pop('upstream', False):
+                    model_router.record('openai', model, (time.time() - stream_start) * 1000, False)
+                log_event("OpenAI Stream Endpoint", "Error", severity="ERROR", error=event['error'])
+            yield format_stream_frame(event, sse)
+
+    response = https_fn.Response(
+        stream_in_trace(generate()),
+        status=200,
+        headers={
+            'Content-Type': 'text/event-stream' if sse else 'application/x-ndjson',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'Access-Control-Allow-Origin': '*',
+        }
+    )
+    if fast_result is None:
+        # Held until the server closes the body, whether the stream finished or the client went away
+        response.call_on_close(admission.release)
+    return response
+
+@https_fn.on_request(secrets=["REPLICATE_API_TOKEN"])
+@traced('ai_text_to_canvas_replicate')
+@with_deadline
+def ai_text_to_canvas_replicate(req: https_fn.Request) -> https_fn.Response:
+    cors_response = handle_cors(req)
+    if cors_response:
+        return cors_response
+
+    with span('validate'):
+        request_data, error_response = validate_request(req)
+    if error_response:
+        return error_response
+
+    target, error_response = commit_target(req, request_data)
+    if error_response:
+        return error_response
+
+    context, error_response = resolve_canvas_context(req, request_data)
+    if error_response:
+        return error_response
+
+    model = request_data.get('model', DEFAULT_MODEL)
+    selected_content = request_data.get('selectedContent')
+
+    set_attributes(model=model)
+    log_event("Replicate Endpoint", "Request", model=model, has_selected_content=selected_content is not None)
+
+    result = generate_commands('replicate', request_data, context, caller_key(req, target))
 
     if result['success']:
-        return https_fn.Response(
-            json.dumps(result),
-            status=200,
-            headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
-        )
+        log_event("Replicate Endpoint", "Response", commands=len(result['data']['commands']), path=result['debug'].get('path'))
     else:
+        log_event("Replicate Endpoint", "Error", severity="ERROR", error=result.get('error'))
+
+    if target:
+        result = commit_result(result, *target)
+
+    return commands_response(result, req, request_data)
+
+@https_fn.on_request(secrets=["OPENAI_API_KEY", "REPLICATE_API_TOKEN"])
+@traced('ai_text_to_canvas_hedged')
+@with_deadline
+def ai_text_to_canvas_hedged(req: https_fn.Request) -> https_fn.Response:
+    cors_response = handle_cors(req)
+    if cors_response:
+        return cors_response
+
+    with span('validate'):
+        request_data, error_response = validate_request(req)
+    if error_response:
+        return error_response
+
+    target, error_response = commit_target(req, request_data)
+    if error_response:
+        return error_response
+
+    context, error_response = resolve_canvas_context(req, request_data)
+    if error_response:
+        return error_response
+
+    model = request_data.get('model', DEFAULT_MODEL)
+    primary = request_data.get('primary', 'openai')
+    if primary not in ('openai', 'replicate'):
         return https_fn.Response(
-            json.dumps({'success': False, 'error': result['error']}),
-            status=500,
+            json.dumps({'success': False, 'error': 'primary must be "openai" or "replicate"'}),
+            status=400,
             headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
         )
+    hedge_delay = request_data.get('hedgeDelayMs')
+    if hedge_delay is not None and (isinstance(hedge_delay, bool) or not isinstance(hedge_delay, (int, float))
+                                    or not math.isfinite(hedge_delay) or hedge_delay < 0):
+        return json_error(400, 'hedgeDelayMs must be a non-negative number of milliseconds')
+
+    set_attributes(model=model, primary=primary)
+    log_event("Hedged Endpoint", "Request", model=model, primary=primary)
+
+    result = generate_commands('hedged', request_data, context, caller_key(req, target))
+
+    if result['success']:
+        log_event("Hedged Endpoint", "Response", commands=len(result['data']['commands']), path=result['debug'].get('path'))
+    else:
+        log_event("Hedged Endpoint", "Error", severity="ERROR", error=result.get('error'))
+
+    if target:
+        result = commit_result(result, *target)
+
+    return commands_response(result, req, request_data)
+
+def session_canvas_update(request_data: dict) -> tuple[tuple[list | None, dict | None], https_fn.Response | None]:
+    """Returns the (snapshot, delta) a session turn sends, or an error response."""
+    snapshot = request_data.get('canvasSnapshot')
+    delta = request_data.get('canvasDelta')
+    if snapshot is not None:
+        error_response = snapshot_error(snapshot)
+        if error_response:
+            return (None, None), error_response
+    if delta is not None:
+        upsert = (delta.get('upsert') or []) if isinstance(delta, dict) else None
+        remove = (delta.get('remove') or []) if isinstance(delta, dict) else None
+        if (not isinstance(upsert, list) or not isinstance(remove, list) or len(upsert) > SNAPSHOT_MAX_SHAPES
+                or not all(valid_snapshot_shape(shape) and isinstance(shape.get('id'), str) for shape in upsert)
+                or not all(isinstance(shape_id, str) for shape_id in remove)):
+            return (None, None), json_error(400, 'canvasDelta must be {"upsert": [shapes with ids], "remove": [ids]}')
+    return (snapshot, delta), None
+
+@https_fn.on_request(secrets=["OPENAI_API_KEY"])
+@traced('ai_text_to_canvas_session')
+@with_deadline
+def ai_text_to_canvas_session(req: https_fn.Request) -> https_fn.Response:
+    """Runs one turn of a conversation whose history and canvas state stay on the server.
+
+    The first turn omits `sessionId` and may send a full `canvasSnapshot`; the
+    response carries the new `sessionId`. Follow-up turns send the id, the prompt
+    and only a `canvasDelta` of what changed on the canvas since.
+    """
+    cors_response = handle_cors(req)
+    if cors_response:
+        return cors_response
+
+    with span('validate'):
+        request_data, error_response = validate_request(req)
+    if error_response:
+        return error_response
+
+    target, error_response = commit_target(req, request_data)
+    if error_response:
+        return error_response
+
+    (snapshot, delta), error_response = session_canvas_update(request_data)
+    if error_response:
+        return error_response
+
+    client = caller_key(req, target)
+    session_id = request_data.get('sessionId')
+    if session_id is not None:
+        session = session_store.get(session_id, client) if isinstance(session_id, str) else None
+        if session is None:
+            return json_error(404, 'Unknown or expired session; start a new one without sessionId')
+    else:
+        session = session_store.create(client)
+
+    prompt = request_data['prompt']
+    model = request_data.get('model', DEFAULT_MODEL)
+    set_attributes(model=model, session_turn=len(session.turns) + 1)
+
+    # Turns of one session run one at a time, so each sees the state the previous one left
+    with session.lock:
+        with span('session'):
+            if snapshot is not None:
+                session.replace_canvas(snapshot)
+            if delta is not None:
+                session.apply_delta(delta)
+            # "make them bigger" with nothing selected means the shapes the last turn touched;
+            # a `followUp` flag from the client overrides the guess from the prompt's wording
+            follow_up = request_data.get('followUp')
+            follow_up = is_follow_up(prompt) if follow_up is None else bool(follow_up)
+            if request_data.get('selectedContent') is None and follow_up and session.focus_shapes():
+                request_data = {**request_data, 'selectedContent': session.focus_shapes()}
+
+            history = session.history_text()
+            summary, context_info = None, {}
+            if session.shapes:
+                summary, context_info = canvas_context.for_snapshot(
+                    list(session.shapes.values()), selected_ids(request_data.get('selectedContent')),
+                    f"{session.id}:{session.revision}",
+                )
+            sections = [section for section in (history, summary) if section]
+            context = ("\n\n".join(sections), {**context_info, "history_turns": len(session.turns)}) if sections else None
+
+        log_event("Session Endpoint", "Request", model=model, session=session.id, turn=len(session.turns) + 1,
+                  canvas=session.canvas_state(), has_selected_content=request_data.get('selectedContent') is not None)
+
+        result = generate_commands('openai', request_data, context, client)
+
+        if result['success']:
+            commands = result['data']['commands']
+            log_event("Session Endpoint", "Response", commands=len(commands), path=result['debug'].get('path'))
+            if target:
+                result = commit_result(result, *target)
+            if result['success']:
+                session.record_turn(prompt, commands, result['data'].get('ids') if target else None)
+                session_store.save(session)
+                result['data'].update({'sessionId': session.id, 'turn': len(session.turns),
+                                       'canvasState': session.canvas_state()})
+        else:
+            log_event("Session Endpoint", "Error", severity="ERROR", error=result.get('error'))
+
+    return commands_response(result, req, request_data)
+
+@https_fn.on_request()
+def ai_diagnostics(req: https_fn.Request) -> https_fn.Response:
+    """Reports this instance's rolling per-stage latency percentiles and pipeline counters."""
+    cors_response = handle_cors(req)
+    if cors_response:
+        return cors_response
+
+    diagnostics = {
+        "latency": latency_histogram.snapshot(),
+        "hedging": hedge_stats.snapshot(),
+        "singleflight": single_flight.snapshot(),
+        "cache": {"memory_entries": len(response_cache.memory)},
+        "prompt_cache": prompt_cache_stats.snapshot(),
+        "admission": admission.snapshot(),
+        "models": model_stats.snapshot(),
+        "breakers": {name: breaker.snapshot() for name, breaker in breakers.items()},
+        "sessions": {"memory_entries": len(session_store)},
+    }
+    return https_fn.Response(
+        json.dumps(diagnostics),
+        status=200,
+        headers={'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    )
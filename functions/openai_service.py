@@ -1,130 +1,417 @@
 
 import os
 import json
+import threading
 import time
-from openai import OpenAI
-from prompts import get_canvas_system_prompt
+from prompts import get_canvas_system_prompt, get_user_prompt
+from prompt_budget import fit_user_prompt, static_prefix_tokens, cached_prompt_tokens, prompt_cache_stats
+from layout import expand_shape_batch, expand_shape_edits, selected_shapes
+from instrumentation import log_event, span
+from resilience import call_with_retries, remaining_s, error_status, DeadlineExceeded
 
 client = None
+_client_lock = threading.Lock()
+
+# Optional routing hint so requests sharing the static prefix land on the same provider cache
+PROMPT_CACHE_KEY = os.environ.get('AI_PROMPT_CACHE_KEY')
 
 def get_openai_client():
-    """Initialize OpenAI client lazily"""
+    """Initialize OpenAI client lazily; one client (and connection pool) is shared by all threads"""
     global client
     if client is None:
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("OpenAI API key not found.")
-        client = OpenAI(api_key=api_key)
+        with _client_lock:
+            if client is None:
+                api_key = os.environ.get('OPENAI_API_KEY')
+                if not api_key:
+                    raise ValueError("OpenAI API key not found.")
+                # Imported on first use so cold starts of other endpoints skip the SDK
+                from openai import OpenAI
+                # Retries are handled by call_with_retries within the request deadline
+                client = OpenAI(api_key=api_key, max_retries=0)
     return client
 
-def get_canvas_tools():
-    """Returns the tools schema for the canvas."""
-    return [
-        {
-            "type": "function",
-            "function": {
-                "name": "createShape",
-                "description": "Create a new shape on the canvas",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "shapeType": {"type": "string", "enum": ["rectangle", "circle", "text"]},
-                        "x": {"type": "number"},
-                        "y": {"type": "number"},
-                        "width": {"type": "number"},
-                        "height": {"type": "number"},
-                        "radius": {"type": "number"},
-                        "fill": {"type": "string"},
-                        "stroke": {"type": "string"},
-                        "strokeWidth": {"type": "number"},
-                        "text": {"type": "string"},
-                        "fontSize": {"type": "number"},
-                        "fontFamily": {"type": "string"},
-                        "fontStyle": {"type": "string"},
+# Built once at import; the schema is static and must not be mutated per request
+CANVAS_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "createShape",
+            "description": "Create a new shape on the canvas",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "shapeType": {"type": "string", "enum": ["rectangle", "circle", "text"]},
+                    "x": {"type": "number"},
+                    "y": {"type": "number"},
+                    "width": {"type": "number"},
+                    "height": {"type": "number"},
+                    "radius": {"type": "number"},
+                    "fill": {"type": "string"},
+                    "stroke": {"type": "string"},
+                    "strokeWidth": {"type": "number"},
+                    "text": {"type": "string"},
+                    "fontSize": {"type": "number"},
+                    "fontFamily": {"type": "string"},
+                    "fontStyle": {"type": "string"},
+                },
+                "required": ["shapeType", "x", "y", "fill"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "createShapes",
+            "description": (
+                "Create many shapes in one call. Prefer this over repeated createShape calls "
+                "whenever more than a few shapes are requested. Give a compact layout "
+                "(grid, row, column or circle) and optional colors to cycle through, or "
+                "per-shape values as columnar arrays in `columns`."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "shapeType": {"type": "string", "enum": ["rectangle", "circle", "text"]},
+                    "count": {"type": "integer", "description": "Number of shapes to create"},
+                    "layout": {
+                        "type": "object",
+                        "properties": {
+                            "pattern": {"type": "string", "enum": ["grid", "row", "column", "circle"]},
+                            "rows": {"type": "integer"},
+                            "cols": {"type": "integer"},
+                            "originX": {"type": "number", "description": "Top-left x (center x for circle)"},
+                            "originY": {"type": "number", "description": "Top-left y (center y for circle)"},
+                            "spacingX": {"type": "number", "description": "Step between neighbouring x positions"},
+                            "spacingY": {"type": "number", "description": "Step between neighbouring y positions"},
+                            "ringRadius": {"type": "number", "description": "Radius of a circle pattern"},
+                        },
+                    },
+                    "colors": {"type": "array", "items": {"type": "string"}, "description": "Fill colors cycled across shapes"},
+                    "width": {"type": "number"},
+                    "height": {"type": "number"},
+                    "radius": {"type": "number"},
+                    "fill": {"type": "string"},
+                    "stroke": {"type": "string"},
+                    "strokeWidth": {"type": "number"},
+                    "text": {"type": "string"},
+                    "fontSize": {"type": "number"},
+                    "fontFamily": {"type": "string"},
+                    "fontStyle": {"type": "string"},
+                    "columns": {
+                        "type": "object",
+                        "description": "Per-shape values; index i applies to shape i and overrides shared values",
+                        "properties": {
+                            "shapeType": {"type": "array", "items": {"type": "string"}},
+                            "x": {"type": "array", "items": {"type": "number"}},
+                            "y": {"type": "array", "items": {"type": "number"}},
+                            "width": {"type": "array", "items": {"type": "number"}},
+                            "height": {"type": "array", "items": {"type": "number"}},
+                            "radius": {"type": "array", "items": {"type": "number"}},
+                            "fill": {"type": "array", "items": {"type": "string"}},
+                            "text": {"type": "array", "items": {"type": "string"}},
+                        },
+                    },
+                },
+                "required": ["shapeType"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "editShapes",
+            "description": (
+                "Edit selected shapes in one call. Use `changes` for values every target gets, "
+                "`offset` to move and `scale` to resize every target relative to its current "
+                "values, and `perShape` for values that differ by shape. Targets default to the "
+                "whole selection."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "ids": {"type": "array", "items": {"type": "string"}, "description": "Selected shape ids to edit"},
+                    "changes": {
+                        "type": "object",
+                        "properties": {
+                            "x": {"type": "number"},
+                            "y": {"type": "number"},
+                            "width": {"type": "number"},
+                            "height": {"type": "number"},
+                            "radius": {"type": "number"},
+                            "fill": {"type": "string"},
+                            "stroke": {"type": "string"},
+                            "strokeWidth": {"type": "number"},
+                            "rotation": {"type": "number"},
+                            "text": {"type": "string"},
+                            "fontSize": {"type": "number"},
+                            "fontFamily": {"type": "string"},
+                            "fontStyle": {"type": "string"},
+                        },
+                    },
+                    "offset": {
+                        "type": "object",
+                        "properties": {"x": {"type": "number"}, "y": {"type": "number"}},
+                    },
+                    "scale": {"type": "number", "description": "Multiplier for width, height, radius and fontSize"},
+                    "perShape": {
+                        "type": "array",
+                        "description": "Per-shape values: {id, ...properties}",
+                        "items": {"type": "object", "properties": {"id": {"type": "string"}}, "required": ["id"]},
                     },
-                    "required": ["shapeType", "x", "y", "fill"],
                 },
             },
         },
-    ]
+    },
+]
+
+def get_canvas_tools():
+    """Returns the tools schema for the canvas."""
+    return CANVAS_TOOLS
+
+def build_messages(prompt: str, selected_content=None, canvas_context: str | None = None) -> tuple[list, dict]:
+    """Builds the chat messages for a canvas request and returns them with the prompt budget info.
+
+    The tool schema and system message form a static prefix; the selection, canvas
+    summary and request all go in the user message at the tail.
+    """
+    system_prompt = get_canvas_system_prompt()
+    user_prompt, budget_info = fit_user_prompt(
+        lambda context: get_user_prompt(prompt, selected_content, context),
+        canvas_context,
+        static_prefix_tokens(system_prompt, CANVAS_TOOLS),
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ], budget_info
+
+def build_create_command(function_args: dict) -> dict:
+    """Converts createShape tool arguments into a canvas create command."""
+    command = {
+        "action": "create",
+        "type": function_args["shapeType"],
+        "x": function_args["x"],
+        "y": function_args["y"],
+        "fill": function_args.get("fill") or "#000000",
+    }
+
+    # Add shape-specific properties
+    if function_args["shapeType"] == "rectangle":
+        command["width"] = function_args.get("width", 100)
+        command["height"] = function_args.get("height", 100)
+    elif function_args["shapeType"] == "circle":
+        command["radius"] = function_args.get("radius", 50)
+    elif function_args["shapeType"] == "text":
+        command["text"] = function_args.get("text", "")
+        command["fontSize"] = function_args.get("fontSize", 16)
+        command["fontFamily"] = function_args.get("fontFamily", "Arial")
+        command["fontStyle"] = function_args.get("fontStyle", "normal")
+
+    # Add optional properties
+    if "stroke" in function_args:
+        command["stroke"] = function_args["stroke"]
+    if "strokeWidth" in function_args:
+        command["strokeWidth"] = function_args["strokeWidth"]
+
+    return command
 
-def text_to_canvas_commands(prompt: str, model: str, selected_content=None) -> dict:
+def tool_call_to_commands(function_name: str, function_args: dict, selected: list[dict] | None = None) -> list:
+    """Converts a single tool call into zero or more canvas commands."""
+    if function_name == "createShape":
+        return [build_create_command(function_args)]
+    if function_name == "createShapes":
+        return [build_create_command(shape_args) for shape_args in expand_shape_batch(function_args)]
+    if function_name == "editShapes":
+        return expand_shape_edits(function_args, selected or [])
+    return []
+
+def completion_options(temperature: float = 1.0, seed: int | None = None) -> dict:
+    """Returns sampling and caching options for a completion request, omitting unset ones."""
+    options = {"temperature": temperature}
+    if seed is not None:
+        options["seed"] = seed
+    if PROMPT_CACHE_KEY:
+        options["extra_body"] = {"prompt_cache_key": PROMPT_CACHE_KEY}
+    return options
+
+def usage_debug(model: str, usage, budget_info: dict) -> dict:
+    """Returns token usage debug fields, including prefix-cache hits, and records them per model."""
+    cached_tokens = cached_prompt_tokens(usage)
+    prompt_cache_stats.record(model, usage.prompt_tokens if usage else None, cached_tokens)
+    return {
+        "tokens_used": usage.total_tokens if usage else None,
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": usage.completion_tokens if usage else None,
+        **budget_info,
+    }
+
+def text_to_canvas_commands(prompt: str, model: str, selected_content=None, temperature: float = 1.0,
+                            seed: int | None = None, canvas_context: str | None = None) -> dict:
     """Converts a natural language prompt to canvas commands using OpenAI."""
     start_time = time.time()
+    selected = selected_shapes(selected_content)
+    # Set once the model is called, so failures before that are not blamed on it
+    upstream = False
     try:
         is_editing = selected_content is not None
-        print(f"[OpenAI Service] Calling with model: {model}, editing: {is_editing}")
+        log_event("OpenAI Service", "Calling model", model=model, editing=is_editing)
 
-        # Get system prompt with optional selected content context
-        system_prompt = get_canvas_system_prompt(selected_content)
+        with span("prompt_build"):
+            messages, budget_info = build_messages(prompt, selected_content, canvas_context)
 
         openai_client = get_openai_client()
-        response = openai_client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"{prompt}\n\nPlease generate ALL requested shapes in this single response."},
-            ],
-            tools=get_canvas_tools(),
-            tool_choice="auto",
-            max_completion_tokens=16000,
-            temperature=1.0,
-        )
+        upstream = True
+        with span("upstream"):
+            response = call_with_retries('openai', lambda timeout: openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=get_canvas_tools(),
+                tool_choice="auto",
+                max_completion_tokens=16000,
+                **completion_options(temperature, seed),
+                timeout=timeout,
+            ))
         end_time = time.time()
         api_duration = (end_time - start_time) * 1000
 
         message = response.choices[0].message
         usage = response.usage
 
-        print(f"[OpenAI Service] Completed in {api_duration:.0f}ms, tool_calls: {len(message.tool_calls) if message.tool_calls else 0}")
+        log_event("OpenAI Service", "Completed", model=model, response_time_ms=round(api_duration, 1),
+                  tool_calls=len(message.tool_calls) if message.tool_calls else 0,
+                  completion_tokens=usage.completion_tokens if usage else None,
+                  cached_tokens=cached_prompt_tokens(usage))
         debug_info = {
-            "tokens_used": usage.total_tokens if usage else None,
-            "prompt_tokens": usage.prompt_tokens if usage else None,
-            "completion_tokens": usage.completion_tokens if usage else None,
+            **usage_debug(model, usage, budget_info),
             "model": model,
             "response_time_ms": api_duration,
             "function_calls": len(message.tool_calls) if message.tool_calls else 0,
         }
 
         if message.tool_calls:
-            canvas_commands = []
-            for tool_call in message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                if function_name == "createShape":
-                    command = {
-                        "action": "create",
-                        "type": function_args["shapeType"],
-                        "x": function_args["x"],
-                        "y": function_args["y"],
-                        "fill": function_args.get("fill") or "#000000",
-                    }
-
-                    # Add shape-specific properties
-                    if function_args["shapeType"] == "rectangle":
-                        command["width"] = function_args.get("width", 100)
-                        command["height"] = function_args.get("height", 100)
-                    elif function_args["shapeType"] == "circle":
-                        command["radius"] = function_args.get("radius", 50)
-                    elif function_args["shapeType"] == "text":
-                        command["text"] = function_args.get("text", "")
-                        command["fontSize"] = function_args.get("fontSize", 16)
-                        command["fontFamily"] = function_args.get("fontFamily", "Arial")
-                        command["fontStyle"] = function_args.get("fontStyle", "normal")
-
-                    # Add optional properties
-                    if "stroke" in function_args:
-                        command["stroke"] = function_args["stroke"]
-                    if "strokeWidth" in function_args:
-                        command["strokeWidth"] = function_args["strokeWidth"]
-
-                    canvas_commands.append(command)
-            print(f"[OpenAI Service] Returning {len(canvas_commands)} commands")
+            with span("parse"):
+                canvas_commands = []
+                for tool_call in message.tool_calls:
+                    function_name = tool_call.function.name
+                    function_args = json.loads(tool_call.function.arguments)
+                    canvas_commands.extend(tool_call_to_commands(function_name, function_args, selected))
+            log_event("OpenAI Service", "Returning commands", count=len(canvas_commands))
             return {"success": True, "data": {"commands": canvas_commands}, "debug": debug_info}
         else:
-            print(f"[OpenAI Service] No tool calls in response")
+            log_event("OpenAI Service", "No tool calls in response")
             return {"success": True, "data": {"commands": []}, "debug": debug_info}
 
     except Exception as e:
-        print(f"[OpenAI Service] Error: {str(e)}")
-        return {"success": False, "error": str(e)}
+        log_event("OpenAI Service", "Error", severity="ERROR", error=str(e))
+        return {"success": False, "error": str(e), "upstream": upstream, **error_status(e)}
+
+def stream_text_to_canvas_commands(prompt: str, model: str, selected_content=None, temperature: float = 1.0,
+                                   seed: int | None = None, canvas_context: str | None = None):
+    """Streams canvas commands as each tool call completes.
+
+    Yields event dicts: {"type": "command", "command": ...} for every command
+    produced by a finished tool call, then a final {"type": "done", ...} summary frame, or an
+    {"type": "error", ...} frame if the request fails.
+    """
+    start_time = time.time()
+    first_token_ms = None
+    first_command_ms = None
+    command_count = 0
+    function_calls = 0
+    invalid_calls = 0
+    usage = None
+    # Tool call index -> {"name": str, "arguments": [str]} for calls still being generated
+    pending = {}
+    selected = selected_shapes(selected_content)
+    upstream = False
+
+    def flush(indices):
+        nonlocal first_command_ms, command_count, function_calls, invalid_calls
+        for index in sorted(indices):
+            call = pending.pop(index)
+            function_calls += 1
+            try:
+                function_args = json.loads(''.join(call["arguments"]))
+            except json.JSONDecodeError:
+                invalid_calls += 1
+                log_event("OpenAI Service", "Skipping tool call with malformed arguments", severity="WARNING", index=index)
+                continue
+            for command in tool_call_to_commands(call["name"], function_args, selected):
+                if first_command_ms is None:
+                    first_command_ms = (time.time() - start_time) * 1000
+                command_count += 1
+                yield {"type": "command", "command": command}
+
+    try:
+        is_editing = selected_content is not None
+        log_event("OpenAI Service", "Streaming model", model=model, editing=is_editing)
+
+        with span("prompt_build"):
+            messages, budget_info = build_messages(prompt, selected_content, canvas_context)
+
+        openai_client = get_openai_client()
+        upstream = True
+        # Only opening the stream is retried; once commands have been sent a retry would duplicate them
+        with span("upstream_connect"):
+            stream = call_with_retries('openai', lambda timeout: openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=get_canvas_tools(),
+                tool_choice="auto",
+                max_completion_tokens=16000,
+                **completion_options(temperature, seed),
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout,
+            ))
+
+        for chunk in stream:
+            remaining = remaining_s()
+            if remaining is not None and remaining <= 0:
+                stream.close()
+                raise DeadlineExceeded("Request deadline exceeded while streaming")
+            if first_token_ms is None:
+                first_token_ms = (time.time() - start_time) * 1000
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+            for tool_call in delta.tool_calls or []:
+                if tool_call.index not in pending:
+                    # Tool calls are generated sequentially, so a new index means
+                    # every earlier call has received all of its arguments.
+                    yield from flush([i for i in pending if i < tool_call.index])
+                    pending[tool_call.index] = {"name": "", "arguments": []}
+                call = pending[tool_call.index]
+                if tool_call.function:
+                    if tool_call.function.name:
+                        call["name"] = tool_call.function.name
+                    if tool_call.function.arguments:
+                        call["arguments"].append(tool_call.function.arguments)
+
+            if chunk.choices[0].finish_reason:
+                yield from flush(list(pending))
+
+        yield from flush(list(pending))
+
+        api_duration = (time.time() - start_time) * 1000
+        log_event("OpenAI Service", "Stream completed", model=model, response_time_ms=round(api_duration, 1),
+                  time_to_first_token_ms=first_token_ms, commands=command_count)
+        debug_info = {
+            **usage_debug(model, usage, budget_info),
+            "model": model,
+            "response_time_ms": api_duration,
+            "time_to_first_token_ms": first_token_ms,
+            "time_to_first_command_ms": first_command_ms,
+            "function_calls": function_calls,
+            "invalid_function_calls": invalid_calls,
+        }
+        yield {"type": "done", "success": True, "count": command_count, "debug": debug_info}
+
+    except Exception as e:
+        log_event("OpenAI Service", "Stream error", severity="ERROR", error=str(e))
+        yield {"type": "error", "success": False, "error": str(e), "count": command_count, "upstream": upstream,
+               **error_status(e)}
@@ -0,0 +1,282 @@
+"""
+Shared post-processing for generated commands: bulk validation, clamping, color normalization and overlap resolution
+"""
+import os
+import re
+from array import array
+from functools import lru_cache
+from fast_path import COLOR_NAMES
+from layout import CANVAS_MIN, CANVAS_MAX, DEFAULT_GAP, DEFAULT_SIZES, to_number
+
+SHAPE_TYPES = ("rectangle", "circle", "text")
+COLOR_FIELDS = ("fill", "stroke")
+DEFAULT_FILL = "#000000"
+
+# Smallest and largest sizes kept; anything outside is clamped
+MIN_SHAPE_SIZE = 1
+MAX_SHAPE_SIZE = CANVAS_MAX - CANVAS_MIN
+
+# Moves tried per overlapping shape before it is left where it is
+MAX_NUDGES = 16
+# Batches with at least this many create commands count as bulk output and have overlaps resolved
+# by default; smaller results are usually composed drawings whose shapes overlap on purpose
+OVERLAP_MIN_SHAPES = int(os.environ.get('AI_OVERLAP_MIN_SHAPES', '20'))
+
+HEX_COLOR = re.compile(r'^#?([0-9a-fA-F]{3,4}|[0-9a-fA-F]{6}|[0-9a-fA-F]{8})$')
+RGB_COLOR = re.compile(r'^rgba?\(\s*(\d{1,3})\s*,\s*(\d{1,3})\s*,\s*(\d{1,3})\s*(?:,\s*[\d.]+\s*)?\)$')
+HSL_COLOR = re.compile(r'^hsla?\(\s*[\d.]+(?:deg)?\s*,\s*[\d.]+%\s*,\s*[\d.]+%\s*(?:,\s*[\d.]+%?\s*)?\)$')
+
+# CSS named colors, all of which Konva renders; kept as written
+CSS_COLOR_NAMES = frozenset("""
+    aliceblue antiquewhite aqua aquamarine azure beige bisque black blanchedalmond blue blueviolet brown
+    burlywood cadetblue chartreuse chocolate coral cornflowerblue cornsilk crimson cyan darkblue darkcyan
+    darkgoldenrod darkgray darkgreen darkgrey darkkhaki darkmagenta darkolivegreen darkorange darkorchid
+    darkred darksalmon darkseagreen darkslateblue darkslategray darkslategrey darkturquoise darkviolet
+    deeppink deepskyblue dimgray dimgrey dodgerblue firebrick floralwhite forestgreen fuchsia gainsboro
+    ghostwhite gold goldenrod gray green greenyellow grey honeydew hotpink indianred indigo ivory khaki
+    lavender lavenderblush lawngreen lemonchiffon lightblue lightcoral lightcyan lightgoldenrodyellow
+    lightgray lightgreen lightgrey lightpink lightsalmon lightseagreen lightskyblue lightslategray
+    lightslategrey lightsteelblue lightyellow lime limegreen linen magenta maroon mediumaquamarine
+    mediumblue mediumorchid mediumpurple mediumseagreen mediumslateblue mediumspringgreen mediumturquoise
+    mediumvioletred midnightblue mintcream mistyrose moccasin navajowhite navy oldlace olive olivedrab
+    orange orangered orchid palegoldenrod palegreen paleturquoise palevioletred papayawhip peachpuff peru
+    pink plum powderblue purple rebeccapurple red rosybrown royalblue saddlebrown salmon sandybrown
+    seagreen seashell sienna silver skyblue slateblue slategray slategrey snow springgreen steelblue tan
+    teal thistle tomato transparent turquoise violet wheat white whitesmoke yellow yellowgreen
+""".split())
+
+def normalize_color(value) -> str | None:
+    """Returns a color the canvas can render, or None if it cannot be parsed.
+
+    Hex and rgb() colors become uppercase #RRGGBB (#RRGGBBAA keeps its alpha), the
+    prompt's basic names become their hex value, and other CSS names and hsl()
+    colors are kept as written.
+    """
+    # Model output may put lists or objects here, which the cache cannot hash
+    if not isinstance(value, str):
+        return None
+    return _normalize_color_text(value)
+
+@lru_cache(maxsize=1024)
+def _normalize_color_text(value: str) -> str | None:
+    text = value.strip()
+    named = COLOR_NAMES.get(text.lower())
+    if named:
+        return named
+    match = HEX_COLOR.match(text)
+    if match:
+        digits = match.group(1)
+        if len(digits) <= 4:
+            digits = "".join(ch * 2 for ch in digits)
+        return "#" + digits.upper()
+    lowered = text.lower()
+    match = RGB_COLOR.match(lowered)
+    if match:
+        return "#" + "".join(f"{min(int(part), 255):02X}" for part in match.groups())
+    if lowered in CSS_COLOR_NAMES or HSL_COLOR.match(lowered):
+        return lowered
+    return None
+
+def _clamp_column(values: array, low: float, high: float) -> int:
+    """Clamps an array in place and returns how many values changed."""
+    changed = 0
+    for i, value in enumerate(values):
+        if value < low:
+            values[i] = low
+            changed += 1
+        elif value > high:
+            values[i] = high
+            changed += 1
+    return changed
+
+def _bounds(shape_type: str, x: float, y: float, width: float, height: float) -> tuple[float, float, float, float]:
+    # Circles are positioned by their centre, rectangles by their top-left corner
+    if shape_type == "circle":
+        radius = width / 2
+        return x - radius, y - radius, x + radius, y + radius
+    return x, y, x + width, y + height
+
+def _intersects(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def _contains(a, b) -> bool:
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+class SpatialHash:
+    """Uniform-grid spatial hash over axis-aligned boxes."""
+
+    def __init__(self, cell_size: float):
+        self.cell_size = max(cell_size, 1.0)
+        self._cells = {}
+        self._boxes = []
+
+    def _cell_range(self, box):
+        size = self.cell_size
+        return range(int(box[0] // size), int(box[2] // size) + 1), range(int(box[1] // size), int(box[3] // size) + 1)
+
+    def insert(self, box, tag):
+        index = len(self._boxes)
+        self._boxes.append((box, tag))
+        cols, rows = self._cell_range(box)
+        for cx in cols:
+            for cy in rows:
+                self._cells.setdefault((cx, cy), []).append(index)
+
+    def query(self, box):
+        """Yields (box, tag) for stored boxes that intersect `box`."""
+        seen = set()
+        cols, rows = self._cell_range(box)
+        for cx in cols:
+            for cy in rows:
+                for index in self._cells.get((cx, cy), ()):
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    other = self._boxes[index]
+                    if _intersects(box, other[0]):
+                        yield other
+
+def _conflicts(index: SpatialHash, shape_type: str, box) -> bool:
+    # Only stacked or partially overlapping shapes of the same type are treated as mistakes;
+    # nesting (eyes inside a face) and mixed types (labels on boxes) are intentional
+    for other_box, other_type in index.query(box):
+        if other_type != shape_type:
+            continue
+        if other_box == box or not (_contains(other_box, box) or _contains(box, other_box)):
+            return True
+    return False
+
+def resolve_overlaps(types: list, xs: array, ys: array, widths: array, heights: array,
+                     gap: float = DEFAULT_GAP) -> tuple[int, int]:
+    """Moves shapes that partially overlap an earlier shape of the same type.
+
+    Shapes are placed in order into a uniform-grid spatial hash sized to the
+    typical shape, so each placement only checks its neighbouring cells and the
+    whole pass is O(n) for a bounded density. An overlapping shape is nudged right
+    one step at a time, wrapping to the next row at the canvas edge, until it
+    fits or MAX_NUDGES is reached. Returns (moved, unresolved).
+    """
+    sized = sorted(max(w, h) for t, w, h in zip(types, widths, heights) if t != "text")
+    if not sized:
+        return 0, 0
+    index = SpatialHash(sized[len(sized) // 2] + gap)
+    moved = unresolved = 0
+
+    for i, shape_type in enumerate(types):
+        if shape_type == "text":
+            continue
+        width, height = widths[i], heights[i]
+        box = _bounds(shape_type, xs[i], ys[i], width, height)
+        if _conflicts(index, shape_type, box):
+            x, y = xs[i], ys[i]
+            placed = False
+            for _ in range(MAX_NUDGES):
+                x += width + gap
+                if _bounds(shape_type, x, y, width, height)[2] > CANVAS_MAX:
+                    x = CANVAS_MIN + (width / 2 if shape_type == "circle" else 0)
+                    y += height + gap
+                if _bounds(shape_type, x, y, width, height)[3] > CANVAS_MAX:
+                    break
+                candidate = _bounds(shape_type, x, y, width, height)
+                if not _conflicts(index, shape_type, candidate):
+                    xs[i], ys[i], box = x, y, candidate
+                    placed = True
+                    break
+            if placed:
+                moved += 1
+            else:
+                unresolved += 1
+        index.insert(box, shape_type)
+    return moved, unresolved
+
+def postprocess_commands(commands: list[dict], fix_overlaps: bool | None = None) -> tuple[list[dict], dict]:
+    """Validates and normalizes a batch of commands.
+
+    Create commands are checked and defaulted, their positions and sizes are
+    copied into arrays and clamped to the canvas in bulk, colors are normalized
+    (unparseable ones are dropped, except a new shape's fill, which defaults)
+    and same-type overlaps are resolved if `fix_overlaps` is set, or, when it
+    is None, for bulk batches of at least OVERLAP_MIN_SHAPES creates.
+    Non-create commands keep their fields apart from color normalization.
+    Returns (commands, stats) where stats counts every change made.
+    """
+    stats = {"input": len(commands), "dropped": 0, "clamped": 0, "colors_fixed": 0, "moved": 0, "unresolved": 0}
+    creates = []
+    output = []
+
+    # Validation pass: keep well-formed commands and fill per-type defaults
+    for command in commands:
+        if not isinstance(command, dict) or not command.get("action"):
+            stats["dropped"] += 1
+            continue
+        command = dict(command)
+        for field in COLOR_FIELDS:
+            if field in command:
+                color = normalize_color(command[field])
+                if color != command[field]:
+                    stats["colors_fixed"] += 1
+                if color is None:
+                    # A new shape still needs a fill; an edit just leaves the shape's color alone
+                    if field == "fill" and command["action"] == "create":
+                        command[field] = DEFAULT_FILL
+                    else:
+                        del command[field]
+                else:
+                    command[field] = color
+        if command["action"] != "create":
+            output.append(command)
+            continue
+
+        shape_type = command.get("type")
+        x, y = to_number(command.get("x")), to_number(command.get("y"))
+        if shape_type not in SHAPE_TYPES or x is None or y is None:
+            stats["dropped"] += 1
+            continue
+        command["x"], command["y"] = x, y
+        command.setdefault("fill", DEFAULT_FILL)
+        default_size = DEFAULT_SIZES[shape_type]
+        if shape_type == "rectangle":
+            command["width"] = to_number(command.get("width")) or default_size
+            command["height"] = to_number(command.get("height")) or default_size
+        elif shape_type == "circle":
+            command["radius"] = to_number(command.get("radius")) or default_size / 2
+        elif not isinstance(command.get("text"), str):
+            command["text"] = str(command.get("text") or "")
+        creates.append(command)
+        output.append(command)
+
+    # Column pass: positions and sizes as arrays, clamped in bulk
+    types = [command["type"] for command in creates]
+    xs = array("d", (command["x"] for command in creates))
+    ys = array("d", (command["y"] for command in creates))
+    widths = array("d", (_extent(command, "width") for command in creates))
+    heights = array("d", (_extent(command, "height") for command in creates))
+    size_changes = _clamp_column(widths, MIN_SHAPE_SIZE, MAX_SHAPE_SIZE) + _clamp_column(heights, MIN_SHAPE_SIZE, MAX_SHAPE_SIZE)
+    stats["clamped"] = _clamp_column(xs, CANVAS_MIN, CANVAS_MAX) + _clamp_column(ys, CANVAS_MIN, CANVAS_MAX) + size_changes
+
+    if fix_overlaps is None:
+        fix_overlaps = len(creates) >= OVERLAP_MIN_SHAPES
+    if fix_overlaps:
+        stats["moved"], stats["unresolved"] = resolve_overlaps(types, xs, ys, widths, heights)
+
+    for i, command in enumerate(creates):
+        command["x"], command["y"] = _tidy(xs[i]), _tidy(ys[i])
+        if command["type"] == "circle":
+            command["radius"] = _tidy(widths[i] / 2)
+        elif command["type"] == "rectangle":
+            command["width"], command["height"] = _tidy(widths[i]), _tidy(heights[i])
+
+    stats["output"] = len(output)
+    return output, stats
+
+def _extent(command: dict, field: str) -> float:
+    # Text is never resized or moved, so it only needs a placeholder extent
+    if command["type"] == "circle":
+        return command["radius"] * 2
+    if command["type"] == "rectangle":
+        return command[field]
+    return MIN_SHAPE_SIZE
+
+def _tidy(value: float):
+    """Returns whole numbers as ints so responses stay compact."""
+    return int(value) if value.is_integer() else round(value, 2)
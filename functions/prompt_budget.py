@@ -0,0 +1,112 @@
+"""
+Prompt token estimation, per-request prompt budgets and provider prefix-cache accounting
+"""
+import json
+import math
+import os
+import re
+import threading
+from instrumentation import MAX_TRACKED_MODELS, OTHER_MODEL
+
+# Upper bound on the estimated prompt size (system prompt, tools and user message) per request
+PROMPT_TOKEN_BUDGET = int(os.environ.get('AI_PROMPT_TOKEN_BUDGET', '24000'))
+
+# Per-message framing tokens added by the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TOKEN_PIECES = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]+")
+
+class PromptBudgetExceeded(ValueError):
+    """Raised when a prompt cannot be fitted within the token budget."""
+
+def estimate_tokens(text: str) -> int:
+    """Estimates BPE tokens without a tokenizer.
+
+    Words count as one token per four letters, digit runs one per three and
+    punctuation runs one per two characters, which errs on the high side.
+    """
+    total = 0
+    for piece in TOKEN_PIECES.findall(text or ""):
+        if piece[0].isalpha():
+            total += math.ceil(len(piece) / 4)
+        elif piece[0].isdigit():
+            total += math.ceil(len(piece) / 3)
+        else:
+            total += math.ceil(len(piece) / 2)
+    return total
+
+_static_estimates = {}
+
+def static_prefix_tokens(system_prompt: str, tools: list | None = None) -> int:
+    """Estimated tokens of the cacheable prefix (tool schema plus system message), memoized."""
+    key = (system_prompt, id(tools))
+    if key not in _static_estimates:
+        tools_tokens = estimate_tokens(json.dumps(tools)) if tools else 0
+        _static_estimates[key] = tools_tokens + estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    return _static_estimates[key]
+
+def fit_user_prompt(build, canvas_context: str | None, prefix_tokens: int,
+                    budget: int = PROMPT_TOKEN_BUDGET) -> tuple[str, dict]:
+    """Builds the user message within the budget, dropping the canvas summary first if needed.
+
+    `build(canvas_context)` returns the user message text. Raises
+    PromptBudgetExceeded when even the message without canvas context is too large.
+    """
+    text = build(canvas_context)
+    tokens = prefix_tokens + estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+    dropped = False
+    if tokens > budget and canvas_context:
+        text = build(None)
+        tokens = prefix_tokens + estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+        dropped = True
+    if tokens > budget:
+        raise PromptBudgetExceeded(f"Prompt needs about {tokens} tokens, over the {budget} token budget")
+    return text, {
+        "estimated_prompt_tokens": tokens,
+        "static_prefix_tokens": prefix_tokens,
+        "prompt_budget": budget,
+        "dropped_canvas_context": dropped,
+    }
+
+def cached_prompt_tokens(usage) -> int | None:
+    """Returns the prompt tokens the provider served from its prefix cache, if reported."""
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    return getattr(details, "cached_tokens", None) if details else None
+
+class PromptCacheStats:
+    """Thread-safe per-model totals of prompt tokens and provider-cached prompt tokens.
+
+    At most `max_models` model names get their own totals; any further names
+    are counted under OTHER_MODEL.
+    """
+
+    def __init__(self, max_models: int = MAX_TRACKED_MODELS):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._max_models = max_models
+
+    def record(self, model: str, prompt_tokens: int | None, cached_tokens: int | None):
+        if not prompt_tokens:
+            return
+        with self._lock:
+            if model not in self._models and len(self._models) >= self._max_models:
+                model = OTHER_MODEL
+            totals = self._models.setdefault(model, {"requests": 0, "hits": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            totals["requests"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            if cached_tokens:
+                totals["hits"] += 1
+                totals["cached_tokens"] += cached_tokens
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                model: {
+                    **totals,
+                    "hit_rate": round(totals["hits"] / totals["requests"], 3),
+                    "cached_token_ratio": round(totals["cached_tokens"] / totals["prompt_tokens"], 3),
+                }
+                for model, totals in self._models.items()
+            }
+
+prompt_cache_stats = PromptCacheStats()
@@ -3,6 +3,12 @@ Canvas system prompts and prompt templates for AI functions
 """
 import json
 
+# Shape properties included when serializing a multi-selection
+SELECTION_FIELDS = (
+    "id", "type", "x", "y", "width", "height", "radius", "fill", "stroke", "strokeWidth",
+    "rotation", "text", "fontSize", "fontFamily", "fontStyle",
+)
+
 CANVAS_SYSTEM_PROMPT = """You are an AI Canvas Agent that converts natural language instructions into canvas commands.
 
 You can create and edit shapes on a collaborative canvas. When given a request, analyze what the user wants and call the appropriate functions to achieve it.
@@ -112,19 +118,46 @@ Example output for EDIT (when selected content is provided):
   }
 ]"""
 
-def get_canvas_system_prompt(selected_content=None):
-    """Get the canvas system prompt, optionally with selected content context"""
-    base_prompt = CANVAS_SYSTEM_PROMPT
+def format_selection(shapes):
+    """Serializes selected shapes compactly as a shared key list plus one value row per shape"""
+    keys = []
+    for shape in shapes:
+        for key in shape:
+            if key in SELECTION_FIELDS and key not in keys:
+                keys.append(key)
+    # Sub-pixel precision only costs tokens
+    rows = [[round(value, 2) if isinstance(value, float) else value for value in (shape.get(key) for key in keys)]
+            for shape in shapes]
+    return json.dumps({"keys": keys, "rows": rows}, separators=(',', ':'))
+
+def get_canvas_system_prompt():
+    """Get the canvas system prompt.
+
+    The system prompt is static and byte-identical across requests so providers can
+    cache it (together with the tool schema) as a prompt prefix; everything that
+    varies per request belongs in the user message built by get_user_prompt.
+    """
+    return CANVAS_SYSTEM_PROMPT
+
+def get_editing_context(selected_content=None):
+    """Get the editing instructions for the selected content, or None when nothing is selected"""
+    if isinstance(selected_content, list) and selected_content:
+        return f"""CURRENT EDITING CONTEXT:
+You are editing {len(selected_content)} selected shapes. Each row below is one shape, with values in the order of "keys":
+{format_selection(selected_content)}
+
+The user wants to modify these shapes. Make every change in a single editShapes call (or, when answering in JSON, a single object with "action": "editShapes"): put values shared by all targets in "changes", relative moves in "offset" ({{"x": dx, "y": dy}}), proportional resizing in "scale", and values that differ by shape in "perShape" ([{{"id": ..., ...}}]). Only list "ids" when editing part of the selection. Do not repeat unchanged properties."""
 
     if selected_content:
-        content_info = f"""
-
-CURRENT EDITING CONTEXT:
+        return f"""CURRENT EDITING CONTEXT:
 You are editing an existing {selected_content.get('type', 'content')} with the following current properties:
-{json.dumps(selected_content, indent=2)}
+{json.dumps(selected_content, separators=(',', ':'))}
 
-The user wants to modify this content. Return an "edit" action with ONLY the properties that should change based on their request. Do not repeat unchanged properties.
-"""
-        return base_prompt + content_info
+The user wants to modify this content. Return an "edit" action with ONLY the properties that should change based on their request. Do not repeat unchanged properties."""
+
+    return None
 
-    return base_prompt
+def get_user_prompt(prompt, selected_content=None, canvas_context=None):
+    """Get the user message: canvas summary and editing context first, then the request itself"""
+    sections = [canvas_context, get_editing_context(selected_content), prompt]
+    return "\n\n".join(section for section in sections if section)
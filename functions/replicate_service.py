@@ -1,28 +1,37 @@
 
 import os
-import json
 import time
-import replicate
-import re
-from prompts import get_canvas_system_prompt
-
-def text_to_canvas_commands_replicate(prompt: str, model: str, selected_content=None) -> dict:
+from prompts import get_canvas_system_prompt, get_user_prompt
+from prompt_budget import fit_user_prompt, static_prefix_tokens
+from command_parser import CommandStreamParser
+from layout import expand_edit_commands, selected_shapes
+from instrumentation import log_event, span
+from resilience import call_with_retries, remaining_s, error_status, DeadlineExceeded
+
+def text_to_canvas_commands_replicate(prompt: str, model: str, selected_content=None,
+                                      canvas_context: str | None = None) -> dict:
     """Converts a natural language prompt to canvas commands using Replicate."""
     start_time = time.time()
+    # Set once the model is called, so failures before that are not blamed on it
+    upstream = False
     try:
         api_token = os.environ.get('REPLICATE_API_TOKEN')
         if not api_token:
-            print("[Replicate Service] API token not configured")
+            log_event("Replicate Service", "API token not configured", severity="ERROR")
             return {"success": False, "error": "Replicate API token not configured"}
 
         is_editing = selected_content is not None
-        print(f"[Replicate Service] Calling with model: {model}, editing: {is_editing}")
-
-        # Get system prompt with optional selected content context
-        system_prompt = get_canvas_system_prompt(selected_content)
+        # Static system prompt first; selection, canvas summary and request go in the prompt
+        with span("prompt_build"):
+            system_prompt = get_canvas_system_prompt()
+            user_prompt, budget_info = fit_user_prompt(
+                lambda context: get_user_prompt(prompt, selected_content, context),
+                canvas_context,
+                static_prefix_tokens(system_prompt),
+            )
 
         input_payload = {
-            "prompt": prompt,
+            "prompt": user_prompt,
             "messages": [],
             "verbosity": "low",
             "image_input": [],
@@ -33,77 +42,43 @@ def text_to_canvas_commands_replicate(prompt: str, model: str, selected_content=
         # Use model string as-is if it contains a "/", otherwise prepend "openai/"
         model_path = model if "/" in model else f"openai/{model}"
 
-        print(f"[Replicate Service] Calling with model: {model_path}")
-
-        raw_output = replicate.run(
-            model_path,
-            input=input_payload,
-            api_token=api_token,
-        )
+        log_event("Replicate Service", "Calling model", model=model_path, editing=is_editing)
+
+        # Imported on first use so cold starts of other endpoints skip the SDK
+        import replicate
+
+        def run_stream(timeout):
+            # Stream output so command parsing overlaps with generation; a retry starts a fresh parse
+            replicate_client = replicate.Client(api_token=api_token, timeout=timeout)
+            parser = CommandStreamParser()
+            raw_output = []
+            for event in replicate_client.stream(model_path, input=input_payload):
+                text = str(event)
+                raw_output.append(text)
+                parser.feed(text)
+                remaining = remaining_s()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded("Request deadline exceeded while streaming")
+            return parser, raw_output, parser.close()
+
+        # Parsing is interleaved with the stream, so it is timed as part of the upstream wait
+        upstream = True
+        with span("upstream"):
+            parser, raw_output, truncated = call_with_retries('replicate', run_stream)
         end_time = time.time()
         api_duration = (end_time - start_time) * 1000
 
-        if isinstance(raw_output, list):
-            response_text = ''.join(raw_output)
-        else:
-            response_text = str(raw_output)
-
-        print(f"[Replicate Service] Completed in {api_duration:.0f}ms, response length: {len(response_text)}")
-
-        try:
-            cleaned_response = response_text.strip()
-            canvas_commands = json.loads(cleaned_response)
-            if not isinstance(canvas_commands, list):
-                canvas_commands = [canvas_commands]
-            print(f"[Replicate Service] Parsed {len(canvas_commands)} commands")
-        except json.JSONDecodeError:
-            json_match = re.search(r'\[[\s\S]*?\]', response_text, re.DOTALL)
-            if json_match:
-                json_text = json_match.group().strip()
-                try:
-                    canvas_commands = json.loads(json_text)
-                    if not isinstance(canvas_commands, list):
-                        canvas_commands = [canvas_commands]
-                except json.JSONDecodeError:
-                    command_matches = re.findall(r'\{[^{}]*"action"[^{}]*\}', response_text, re.DOTALL)
-                    if command_matches:
-                        canvas_commands = []
-                        for match in command_matches:
-                            try:
-                                command = json.loads(match)
-                                canvas_commands.append(command)
-                            except json.JSONDecodeError:
-                                continue
-                    else:
-                        canvas_commands = [
-                            {
-                                "action": "create",
-                                "type": "text",
-                                "x": 0,
-                                "y": 0,
-                                "width": 400,
-                                "height": 100,
-                                "fill": "#000000",
-                                "text": response_text[:100],
-                                "fontSize": 16,
-                            }
-                        ]
-            else:
-                canvas_commands = [
-                    {
-                        "action": "create",
-                        "type": "text",
-                        "x": 0,
-                        "y": 0,
-                        "width": 400,
-                        "height": 100,
-                        "fill": "#000000",
-                        "text": response_text[:100],
-                        "fontSize": 16,
-                    }
-                ]
-
-        if 'canvas_commands' not in locals() or not canvas_commands:
+        response_text = ''.join(raw_output)
+        # editShapes objects become one edit per selected shape, like the OpenAI tool
+        canvas_commands = expand_edit_commands(parser.commands, selected_shapes(selected_content))
+        # The raw-text fallback below is not a successful parse; hedging and the router treat it as a failure
+        fallback = not canvas_commands
+
+        log_event("Replicate Service", "Completed", model=model_path, response_time_ms=round(api_duration, 1),
+                  response_length=len(response_text), parsed=len(canvas_commands), skipped=parser.skipped,
+                  truncated=truncated)
+
+        if not canvas_commands:
             canvas_commands = [
                 {
                     "action": "create",
@@ -118,13 +93,17 @@ def text_to_canvas_commands_replicate(prompt: str, model: str, selected_content=
                 }
             ]
 
-        print(f"[Replicate Service] Returning {len(canvas_commands)} commands")
+        log_event("Replicate Service", "Returning commands", count=len(canvas_commands))
 
         debug_info = {
             "provider": "replicate",
             "model": model_path,
             "response_time_ms": api_duration,
+            **budget_info,
             "raw_response_length": len(response_text),
+            "skipped_objects": parser.skipped,
+            "truncated": truncated,
+            "fallback": fallback,
             "raw_output": raw_output,
             "raw_output_type": str(type(raw_output)),
             "processed_response": response_text,
@@ -133,4 +112,5 @@ def text_to_canvas_commands_replicate(prompt: str, model: str, selected_content=
         return {"success": True, "data": {"commands": canvas_commands}, "debug": debug_info}
 
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        log_event("Replicate Service", "Error", severity="ERROR", error=str(e))
+        return {"success": False, "error": str(e), "upstream": upstream, **error_status(e)}
@@ -0,0 +1,260 @@
+"""
+Request deadlines, jittered bounded retries and per-provider circuit breakers for upstream model calls
+"""
+import contextvars
+import functools
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from instrumentation import log_event, set_attributes
+from prompt_budget import PromptBudgetExceeded
+
+# Platform timeout the HTTP functions are deployed with; past it the instance is killed without a response
+FUNCTION_TIMEOUT_S = int(os.environ.get('AI_FUNCTION_TIMEOUT_S', '120'))
+# Time kept back from the platform timeout so a request out of budget can still send its 504
+DEADLINE_MARGIN_S = 10
+# End-to-end budget when the client sends no X-Request-Timeout-Ms header, and the most a client may ask for;
+# both are capped so every deadline expires before the platform timeout
+MAX_REQUEST_DEADLINE_S = min(float(os.environ.get('AI_MAX_REQUEST_DEADLINE_S', '300')), FUNCTION_TIMEOUT_S - DEADLINE_MARGIN_S)
+REQUEST_DEADLINE_S = min(float(os.environ.get('AI_REQUEST_DEADLINE_S', '60')), MAX_REQUEST_DEADLINE_S)
+DEADLINE_HEADER = 'X-Request-Timeout-Ms'
+
+# Attempts per upstream call, including the first, and the full-jitter backoff range
+RETRY_MAX_ATTEMPTS = int(os.environ.get('AI_RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY_S = float(os.environ.get('AI_RETRY_BASE_DELAY_S', '0.25'))
+RETRY_MAX_DELAY_S = 2.0
+# A retry is only started if at least this much budget would remain after its backoff
+RETRY_MIN_ATTEMPT_S = float(os.environ.get('AI_RETRY_MIN_ATTEMPT_S', '5'))
+
+# A breaker opens when failed or slow calls reach this share of its recent window
+BREAKER_FAILURE_RATE = float(os.environ.get('AI_BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_MIN_CALLS = int(os.environ.get('AI_BREAKER_MIN_CALLS', '10'))
+BREAKER_WINDOW_S = float(os.environ.get('AI_BREAKER_WINDOW_S', '60'))
+# Calls slower than this count against the breaker even when they succeed
+BREAKER_SLOW_CALL_MS = float(os.environ.get('AI_BREAKER_SLOW_CALL_MS', '30000'))
+# How long an open breaker fails fast before letting one probe call through
+BREAKER_OPEN_S = float(os.environ.get('AI_BREAKER_OPEN_S', '30'))
+
+# HTTP statuses worth retrying; anything else (bad request, auth) fails at once
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request's deadline has passed, or too little of it is left for another call."""
+
+class CircuitOpenError(Exception):
+    """Raised when a provider's breaker is open; `retry_after` is in whole seconds."""
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__(f"{provider} is temporarily unavailable; try again later")
+        self.provider = provider
+        self.retry_after = retry_after
+
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+def deadline_from(req) -> float:
+    """Returns the request's budget in seconds from its timeout header, else the default."""
+    header = req.headers.get(DEADLINE_HEADER)
+    try:
+        budget_s = float(header) / 1000 if header else REQUEST_DEADLINE_S
+    except ValueError:
+        budget_s = REQUEST_DEADLINE_S
+    return max(1.0, min(budget_s, MAX_REQUEST_DEADLINE_S))
+
+def with_deadline(handler):
+    """Decorates an HTTP handler so the request's deadline applies to everything it calls.
+
+    Thread pools that run work in a copy of the caller's context (hedging, fan-out,
+    streamed bodies) inherit the deadline.
+    """
+    @functools.wraps(handler)
+    def wrapper(req):
+        budget_s = deadline_from(req)
+        set_attributes(deadline_s=budget_s)
+        token = _current_deadline.set(time.monotonic() + budget_s)
+        try:
+            return handler(req)
+        finally:
+            _current_deadline.reset(token)
+    return wrapper
+
+def remaining_s() -> float | None:
+    """Seconds left before the current request's deadline, or None outside a request."""
+    deadline = _current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def call_timeout(cap_s: float | None = None) -> float | None:
+    """Returns the timeout for the next upstream call, or raises DeadlineExceeded if none is left."""
+    remaining = remaining_s()
+    if remaining is None:
+        return cap_s
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return remaining if cap_s is None else min(cap_s, remaining)
+
+def is_retryable(error: Exception) -> bool:
+    """Timeouts, connection failures, rate limits and 5xx responses are worth another attempt."""
+    if isinstance(error, (DeadlineExceeded, CircuitOpenError)):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUSES
+    # SDK transport errors (openai.APITimeoutError, httpx.ReadTimeout, ...) carry no status
+    return any(word in type(error).__name__ for word in ('Timeout', 'Connection'))
+
+def error_status(error: Exception) -> dict:
+    """Returns the HTTP status (and Retry-After) a failed call should surface as, if not a plain 500."""
+    if isinstance(error, CircuitOpenError):
+        return {"status": 503, "retry_after": error.retry_after}
+    if isinstance(error, DeadlineExceeded) or (is_retryable(error) and 'Timeout' in type(error).__name__):
+        return {"status": 504}
+    if isinstance(error, PromptBudgetExceeded):
+        return {"status": 413}
+    return {}
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling window of one provider's calls.
+
+    While open, calls fail fast with CircuitOpenError. After `open_s` one probe call
+    is let through; its success closes the breaker and its failure re-opens it.
+    """
+
+    def __init__(self, name: str, failure_rate: float = BREAKER_FAILURE_RATE, min_calls: int = BREAKER_MIN_CALLS,
+                 window_s: float = BREAKER_WINDOW_S, slow_call_ms: float = BREAKER_SLOW_CALL_MS,
+                 open_s: float = BREAKER_OPEN_S, clock=time.monotonic):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_s = window_s
+        self.slow_call_ms = slow_call_ms
+        self.open_s = open_s
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probing = False
+        self.rejected = 0
+        self.opened = 0
+
+    def _trim(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window_s:
+            self._calls.popleft()
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go ahead now."""
+        with self._lock:
+            if self.state == "open" and self.clock() - self._opened_at >= self.open_s:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "closed" or (self.state == "half_open" and not self._probing):
+                self._probing = self.state == "half_open"
+                return
+            self.rejected += 1
+            retry_after = max(1, math.ceil(self.open_s - (self.clock() - self._opened_at)))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, ok: bool, latency_ms: float):
+        """Records a finished call; slow successes count as failures."""
+        bad = not ok or latency_ms > self.slow_call_ms
+        with self._lock:
+            now = self.clock()
+            if self.state == "half_open":
+                self._probing = False
+                if bad:
+                    self._open(now, "probe failed")
+                else:
+                    self.state = "closed"
+                    self._calls.clear()
+                    log_event("Circuit Breaker", "Closed", provider=self.name)
+                return
+            self._calls.append((now, bad))
+            self._trim(now)
+            failures = sum(1 for _, call_bad in self._calls if call_bad)
+            if self.state == "closed" and len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_rate:
+                self._open(now, f"{failures}/{len(self._calls)} calls failed or slow")
+
+    def _open(self, now: float, reason: str):
+        self.state = "open"
+        self._opened_at = now
+        self.opened += 1
+        self._calls.clear()
+        log_event("Circuit Breaker", "Opened", severity="WARNING", provider=self.name, reason=reason)
+
+    def open_for_s(self) -> float:
+        """Seconds until an open breaker lets a probe through; 0 when calls may be attempted."""
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.open_s - (self.clock() - self._opened_at))
+
+    def is_open(self) -> bool:
+        return self.open_for_s() > 0
+
+    def ensure_closed(self):
+        """Raises CircuitOpenError while the breaker is open, without using up a half-open probe."""
+        open_for = self.open_for_s()
+        if open_for:
+            raise CircuitOpenError(self.name, max(1, math.ceil(open_for)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._trim(self.clock())
+            failures = sum(1 for _, bad in self._calls if bad)
+            return {
+                "state": self.state,
+                "window_calls": len(self._calls),
+                "window_failures": failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+breakers = {name: CircuitBreaker(name) for name in ("openai", "replicate")}
+
+def backoff_s(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** (attempt - 1)))
+
+def call_with_retries(provider: str, call, max_attempts: int = RETRY_MAX_ATTEMPTS, cap_s: float | None = None):
+    """Runs call(timeout_s) through the provider's breaker, retrying transient failures while budget remains.
+
+    Each attempt gets the time left before the request deadline (at most `cap_s`)
+    as its timeout. Errors that are not retryable, an exhausted attempt budget, or
+    a deadline too close for another attempt re-raise the last error.
+    """
+    breaker = breakers[provider]
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.allow()
+        try:
+            timeout = call_timeout(cap_s)
+        except DeadlineExceeded:
+            # A probe that never ran must not leave the breaker half-open
+            breaker.record(True, 0)
+            raise
+        start = time.monotonic()
+        try:
+            result = call(timeout)
+        except Exception as e:
+            retryable = is_retryable(e)
+            # Client errors mean the provider is up; only transient failures and hangs count against it
+            breaker.record(not retryable and not isinstance(e, DeadlineExceeded), (time.monotonic() - start) * 1000)
+            if not retryable or attempt >= max_attempts:
+                raise
+            delay = backoff_s(attempt)
+            remaining = remaining_s()
+            if remaining is not None and remaining - delay < RETRY_MIN_ATTEMPT_S:
+                raise
+            log_event("Retry", "Retrying upstream call", severity="WARNING", provider=provider, attempt=attempt,
+                      delay_s=round(delay, 3), error=str(e))
+            time.sleep(delay)
+            continue
+        breaker.record(True, (time.monotonic() - start) * 1000)
+        if attempt > 1:
+            set_attributes(retries=attempt - 1)
+        return result
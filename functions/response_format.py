@@ -0,0 +1,90 @@
+"""
+Response shaping for the AI endpoints: debug levels, columnar command encoding and compression
+"""
+import gzip
+import brotli
+
+DEBUG_LEVELS = ("none", "summary", "full")
+DEFAULT_DEBUG_LEVEL = "summary"
+
+# Debug fields that repeat the full model output and are only sent at debug=full
+FULL_ONLY_DEBUG_FIELDS = ("raw_output", "raw_output_type", "processed_response")
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+def shape_debug(debug: dict | None, level: str) -> dict | None:
+    """Trims a debug payload to the requested level."""
+    if debug is None or level == "none":
+        return None
+    if level == "full":
+        return debug
+    return {key: value for key, value in debug.items() if key not in FULL_ONLY_DEBUG_FIELDS}
+
+def encode_columnar(commands: list[dict]) -> dict:
+    """Encodes commands as a shared key table plus one value row per command.
+
+    Keys are ordered by first appearance; a key missing from a command is null in
+    its row.
+    """
+    keys = []
+    index = {}
+    for command in commands:
+        for key in command:
+            if key not in index:
+                index[key] = len(keys)
+                keys.append(key)
+    rows = [[command.get(key) for key in keys] for command in commands]
+    return {"keys": keys, "rows": rows}
+
+def decode_columnar(columns: dict) -> list[dict]:
+    """Inverse of encode_columnar."""
+    keys = columns["keys"]
+    return [{key: value for key, value in zip(keys, row) if value is not None} for row in columns["rows"]]
+
+def shape_result(result: dict, debug_level: str = DEFAULT_DEBUG_LEVEL, compact: bool = False) -> dict:
+    """Returns the response payload for a successful result at the requested debug level and encoding."""
+    shaped = {"success": result["success"]}
+    data = result.get("data", {})
+    if compact and "commands" in data:
+        shaped["data"] = {key: value for key, value in data.items() if key != "commands"}
+        shaped["data"]["encoding"] = "columnar"
+        shaped["data"]["columns"] = encode_columnar(data.get("commands", []))
+    else:
+        shaped["data"] = data
+    debug = shape_debug(result.get("debug"), debug_level)
+    if debug is not None:
+        shaped["debug"] = debug
+    return shaped
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    """Picks the best supported content coding from an Accept-Encoding header."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ("br", "gzip"):
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return None
+
+def encode_body(body: str, accept_encoding: str | None) -> tuple[bytes, str | None]:
+    """Encodes a response body, compressing it when the client accepts it and it is large enough."""
+    raw = body.encode("utf-8")
+    if len(raw) < MIN_COMPRESS_BYTES:
+        return raw, None
+    coding = negotiate_encoding(accept_encoding)
+    if coding == "br":
+        return brotli.compress(raw, quality=5), coding
+    if coding == "gzip":
+        return gzip.compress(raw, compresslevel=6), coding
+    return raw, None
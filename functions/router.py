@@ -0,0 +1,180 @@
+"""
+Adaptive model routing: classify prompt complexity locally, then pick the healthiest model of that tier
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+from fanout import requested_count
+from fast_path import LAYOUT_WORDS
+from hedging import percentile, is_valid_result
+from instrumentation import log_event, OTHER_MODEL
+
+# Model used when a request omits `model`; "auto" routes by prompt complexity
+DEFAULT_MODEL = os.environ.get('AI_DEFAULT_MODEL', 'auto')
+AUTO_MODEL = 'auto'
+
+# Candidate models per tier, most preferred first; comma-separated overrides
+MODEL_TIERS = {
+    "simple": os.environ.get('AI_ROUTER_SIMPLE_MODELS', 'gpt-5-nano,gpt-5-mini').split(','),
+    "standard": os.environ.get('AI_ROUTER_STANDARD_MODELS', 'gpt-5-mini,gpt-5').split(','),
+    "complex": os.environ.get('AI_ROUTER_COMPLEX_MODELS', 'gpt-5,gpt-5-mini').split(','),
+}
+# p95 latency a model must stay under to keep receiving a tier's traffic
+TIER_LATENCY_SLO_MS = {"simple": 6000, "standard": 15000, "complex": 45000}
+# Success rate (valid, non-empty parses) below which a model is routed around
+ROUTER_MIN_SUCCESS_RATE = float(os.environ.get('AI_ROUTER_MIN_SUCCESS_RATE', '0.8'))
+# Only outcomes this recent count, so a model routed around is retried once its bad samples age out
+ROUTER_WINDOW_S = float(os.environ.get('AI_ROUTER_WINDOW_S', '600'))
+# Outcomes needed before a model's statistics can move traffic
+ROUTER_MIN_SAMPLES = 5
+ROUTER_MAX_SAMPLES = 200
+
+# Largest prompts that still count as simple
+SIMPLE_MAX_WORDS = 12
+SIMPLE_MAX_SHAPES = 5
+SIMPLE_MAX_EDITS = 10
+# Prompts at least this large go to the complex tier
+COMPLEX_MIN_WORDS = 40
+COMPLEX_MIN_SHAPES = 50
+
+# Words asking for composed layouts or multi-part designs rather than placing shapes
+COMPOSITION_WORDS = {
+    "layout", "form", "login", "signup", "navbar", "nav", "menu", "dashboard", "card", "header", "footer",
+    "sidebar", "diagram", "flowchart", "chart", "graph", "tree", "house", "face", "scene", "logo", "button",
+    "align", "arrange", "distribute", "center", "centre", "evenly", "spacing", "between", "around",
+}
+
+WORD_PATTERN = re.compile(r"[a-z]+|\d+")
+
+def classify_prompt(prompt: str, selected_content=None) -> tuple[str, dict]:
+    """Returns (tier, features) for a prompt; purely local and deterministic."""
+    words = WORD_PATTERN.findall(prompt.lower())
+    count = requested_count(prompt) or 1
+    editing = selected_content is not None
+    edits = len(selected_content) if isinstance(selected_content, list) else int(editing)
+    composition = sorted(set(words) & COMPOSITION_WORDS)
+    layout = sorted(set(words) & LAYOUT_WORDS.keys())
+    features = {
+        "words": len(words),
+        "count": count,
+        "editing": editing,
+        "edits": edits,
+        "composition": composition,
+        "layout": layout,
+    }
+
+    if len(words) >= COMPLEX_MIN_WORDS or count >= COMPLEX_MIN_SHAPES or len(composition) >= 2:
+        return "complex", features
+    simple_edit = editing and edits <= SIMPLE_MAX_EDITS
+    simple_create = not editing and count <= SIMPLE_MAX_SHAPES and not layout
+    if len(words) <= SIMPLE_MAX_WORDS and not composition and (simple_edit or simple_create):
+        return "simple", features
+    return "standard", features
+
+def parse_succeeded(result: dict) -> bool:
+    """A call counts as successful if it returned commands parsed from the model's output."""
+    return is_valid_result(result)
+
+class ModelStats:
+    """Thread-safe rolling windows of (time, latency, success) outcomes per provider model."""
+
+    def __init__(self, window_s: float = ROUTER_WINDOW_S, max_samples: int = ROUTER_MAX_SAMPLES, clock=time.time):
+        self._lock = threading.Lock()
+        self._outcomes = {}
+        self.window_s = window_s
+        self.max_samples = max_samples
+        self.clock = clock
+
+    def record(self, key: str, latency_ms: float, ok: bool):
+        with self._lock:
+            self._outcomes.setdefault(key, deque(maxlen=self.max_samples)).append((self.clock(), latency_ms, ok))
+
+    def summary(self, key: str) -> dict:
+        """Returns sample count, success rate and latency percentiles over the recent window."""
+        cutoff = self.clock() - self.window_s
+        with self._lock:
+            outcomes = [outcome for outcome in self._outcomes.get(key, ()) if outcome[0] >= cutoff]
+        latencies = [latency for _, latency, ok in outcomes if ok]
+        return {
+            "samples": len(outcomes),
+            "success_rate": round(len(latencies) / len(outcomes), 3) if outcomes else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+        }
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            keys = list(self._outcomes)
+        return {key: self.summary(key) for key in keys}
+
+model_stats = ModelStats()
+
+class ModelRouter:
+    """Picks a model for a prompt from its tier's candidates.
+
+    The first candidate that is healthy (too few samples to judge, or meeting
+    both the success-rate floor and the tier's p95 latency SLO) is chosen. If none
+    is healthy, the one with the best success rate, then lowest p50, is used. The
+    decision depends only on the prompt and the recorded statistics.
+    """
+
+    def __init__(self, tiers: dict = MODEL_TIERS, stats: ModelStats = model_stats,
+                 min_success_rate: float = ROUTER_MIN_SUCCESS_RATE, min_samples: int = ROUTER_MIN_SAMPLES):
+        self.tiers = tiers
+        self.models = {model for models in tiers.values() for model in models}
+        self.stats = stats
+        self.min_success_rate = min_success_rate
+        self.min_samples = min_samples
+
+    def healthy(self, summary: dict, tier: str) -> bool:
+        if summary["samples"] < self.min_samples:
+            return True
+        if summary["success_rate"] < self.min_success_rate:
+            return False
+        return summary["p95_ms"] is None or summary["p95_ms"] <= TIER_LATENCY_SLO_MS[tier]
+
+    def route(self, provider: str, prompt: str, selected_content=None) -> tuple[str, dict]:
+        """Returns (model, decision) for a prompt sent to `provider`."""
+        tier, features = classify_prompt(prompt, selected_content)
+        candidates = []
+        for model in self.tiers[tier]:
+            summary = self.stats.summary(f"{provider}:{model}")
+            candidates.append({"model": model, **summary, "healthy": self.healthy(summary, tier)})
+
+        chosen = next((candidate for candidate in candidates if candidate["healthy"]), None)
+        if chosen is None:
+            chosen = min(candidates, key=lambda c: (-(c["success_rate"] or 0), c["p50_ms"] or float('inf')))
+            reason = "best_available"
+        else:
+            reason = "preferred" if chosen is candidates[0] else "shifted"
+        if reason != "preferred":
+            log_event("Router", "Routed around preferred model", tier=tier, preferred=candidates[0]["model"],
+                      model=chosen["model"], reason=reason)
+        return chosen["model"], {
+            "tier": tier,
+            "model": chosen["model"],
+            "reason": reason,
+            "features": features,
+            "candidates": candidates,
+        }
+
+    def record(self, provider: str, model: str, latency_ms: float, ok: bool):
+        # Model names come from callers; only tier candidates are routed on, so the rest share one window
+        if model not in self.models:
+            model = OTHER_MODEL
+        self.stats.record(f"{provider}:{model}", latency_ms, ok)
+
+    def record_result(self, provider: str, model: str, result: dict, latency_ms: float):
+        """Records a provider call's outcome, preferring the service's own response_time_ms.
+
+        Failures that never reached the model (an over-budget prompt, missing
+        credentials, bad options) say nothing about its health and are skipped.
+        """
+        if not result.get('success') and not result.get('upstream'):
+            return
+        debug = result.get('debug') or {}
+        self.record(provider, model, debug.get('response_time_ms', latency_ms), parse_succeeded(result))
+
+model_router = ModelRouter()
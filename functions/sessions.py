@@ -0,0 +1,259 @@
+"""
+Conversation sessions: bounded turn history, canvas state and the shapes a follow-up refers to, kept between requests
+"""
+import os
+import re
+import secrets
+import threading
+import time
+from collections import Counter, OrderedDict
+from canvas_context import SNAPSHOT_FIELDS
+from instrumentation import log_event
+from layout import MAX_SELECTION_SHAPES
+from prompt_budget import estimate_tokens
+
+# Idle time after which a session is evicted, and sessions kept per instance
+SESSION_TTL_SECONDS = float(os.environ.get('AI_SESSION_TTL_SECONDS', '1800'))
+SESSION_MAX_ENTRIES = int(os.environ.get('AI_SESSION_MAX_ENTRIES', '500'))
+# Set to a collection name (e.g. "ai_sessions") to persist sessions across instances
+SESSION_FIRESTORE_COLLECTION = os.environ.get('AI_SESSION_FIRESTORE_COLLECTION')
+# Upper bound on the estimated size of the turn history added to each prompt
+SESSION_HISTORY_TOKEN_BUDGET = int(os.environ.get('AI_SESSION_HISTORY_TOKEN_BUDGET', '300'))
+
+# Turns kept per session; only the newest that fit the token budget reach the prompt
+MAX_HISTORY_TURNS = 8
+# Longest prompt text kept per turn
+MAX_TURN_PROMPT_CHARS = 160
+# Canvases up to this size are persisted with the session; larger ones keep only history and focus
+SESSION_PERSIST_MAX_SHAPES = 2000
+
+# Verbs that ask for new shapes; "make" alone is left out because it mostly edits ("make them bigger")
+CREATE_WORDS = {"create", "add", "draw", "generate", "build", "insert", "new", "another"}
+# "make a circle", "make 3 squares" ask for new shapes too
+CREATE_PHRASE = re.compile(r"\bmake\s+(?:a|an|one|some|\d+)\b")
+WORD_PATTERN = re.compile(r"[a-z]+|\d+")
+
+def is_follow_up(prompt: str) -> bool:
+    """True if the prompt edits earlier shapes rather than asking for new ones.
+
+    Only consulted when the last turn touched shapes, so any prompt without a
+    create verb counts ("shift the second row", "make the squares bigger"), while
+    "create a rectangle that is blue" and "make a circle" do not.
+    """
+    text = prompt.lower()
+    return CREATE_WORDS.isdisjoint(WORD_PATTERN.findall(text)) and not CREATE_PHRASE.search(text)
+
+def describe_commands(commands: list[dict]) -> str:
+    """One-line digest of a turn's commands, e.g. "created 3 rectangle, 2 circle; edited 4 shapes (fill, x)"."""
+    created = Counter(command.get("type", "shape") for command in commands if command.get("action") == "create")
+    edits = [command for command in commands if command.get("action") == "edit"]
+    parts = []
+    if created:
+        parts.append("created " + ", ".join(f"{count} {shape_type}" for shape_type, count in created.most_common()))
+    if edits:
+        fields = sorted({key for command in edits for key in command if key not in ("action", "shapeId")})
+        parts.append(f"edited {len(edits)} shapes ({', '.join(fields)})")
+    return "; ".join(parts) or "no changes"
+
+def _snapshot_shape(shape: dict) -> dict:
+    return {key: shape[key] for key in ["id", *SNAPSHOT_FIELDS] if shape.get(key) is not None}
+
+class Session:
+    """One conversation: its turns, the canvas as the server last knew it and the shapes the last turn touched."""
+
+    def __init__(self, session_id: str, owner: str, turns: list | None = None, shapes: dict | None = None,
+                 focus: list | None = None, revision: int = 0, created_at: float | None = None):
+        self.id = session_id
+        self.owner = owner
+        self.turns = turns or []
+        # id -> snapshot fields; None when the canvas was never sent or was too large to persist
+        self.shapes = shapes
+        self.focus = focus or []
+        self.revision = revision
+        self.created_at = created_at or time.time()
+        self.last_used = time.time()
+        # The previous turn created shapes whose ids only arrive with the client's next delta
+        self.awaiting_ids = False
+        # False until a full snapshot arrives; deltas alone only describe part of the canvas
+        self.complete = shapes is not None
+        self.lock = threading.Lock()
+
+    def canvas_state(self) -> str:
+        if self.shapes is None:
+            return "missing"
+        return "complete" if self.complete else "partial"
+
+    def replace_canvas(self, snapshot: list[dict]):
+        self.shapes = {shape["id"]: _snapshot_shape(shape) for shape in snapshot if shape.get("id")}
+        self.complete = True
+        self.revision += 1
+
+    def apply_delta(self, delta: dict):
+        """Applies a client canvas delta ({"upsert": [shapes], "remove": [ids]}).
+
+        Shapes new to the session right after a turn that created shapes are taken
+        to be those shapes and become the focus of the next follow-up.
+        """
+        if self.shapes is None:
+            self.shapes = {}
+        new_ids = []
+        for shape in delta.get("upsert") or []:
+            if shape.get("id") not in self.shapes:
+                new_ids.append(shape["id"])
+            self.shapes[shape["id"]] = {**self.shapes.get(shape["id"], {}), **_snapshot_shape(shape)}
+        for shape_id in delta.get("remove") or []:
+            self.shapes.pop(shape_id, None)
+        if self.awaiting_ids and new_ids:
+            self.focus = new_ids[:MAX_SELECTION_SHAPES]
+            self.awaiting_ids = False
+        self.revision += 1
+
+    def focus_shapes(self) -> list[dict]:
+        """The last turn's shapes, as a selection for a follow-up that refers to them."""
+        if not self.shapes:
+            return []
+        return [self.shapes[shape_id] for shape_id in self.focus if shape_id in self.shapes]
+
+    def record_turn(self, prompt: str, commands: list[dict], created_ids: list[str] | None = None):
+        """Adds a turn and applies its edits (and committed creates) to the session's canvas."""
+        self.turns.append({"prompt": prompt[:MAX_TURN_PROMPT_CHARS], "result": describe_commands(commands)})
+        del self.turns[:-MAX_HISTORY_TURNS]
+
+        edited = []
+        for command in commands:
+            if command.get("action") == "edit" and command.get("shapeId"):
+                edited.append(command["shapeId"])
+                if self.shapes is not None and command["shapeId"] in self.shapes:
+                    self.shapes[command["shapeId"]].update(_snapshot_shape(command))
+        creates = [command for command in commands if command.get("action") == "create"]
+        if created_ids and self.shapes is not None:
+            for shape_id, command in zip(created_ids, creates):
+                self.shapes[shape_id] = {**_snapshot_shape(command), "id": shape_id}
+
+        if creates:
+            self.focus = list(created_ids or [])[:MAX_SELECTION_SHAPES]
+            self.awaiting_ids = not created_ids
+        elif edited:
+            self.focus = edited[:MAX_SELECTION_SHAPES]
+        self.revision += 1
+
+    def history_text(self, budget: int = SESSION_HISTORY_TOKEN_BUDGET) -> str | None:
+        """The newest turns that fit the budget, oldest first, so prompt size stays flat as a session grows."""
+        lines = []
+        tokens = 0
+        for number, turn in reversed(list(enumerate(self.turns, 1))):
+            line = f"{number}. \"{turn['prompt']}\" -> {turn['result']}"
+            tokens += estimate_tokens(line)
+            if tokens > budget:
+                break
+            lines.append(line)
+        if not lines:
+            return None
+        return "CONVERSATION SO FAR (earlier requests in this session):\n" + "\n".join(reversed(lines))
+
+    def to_document(self) -> dict:
+        persist_shapes = self.shapes is not None and len(self.shapes) <= SESSION_PERSIST_MAX_SHAPES
+        return {
+            "owner": self.owner,
+            "turns": self.turns,
+            "shapes": list(self.shapes.values()) if persist_shapes else None,
+            "focus": self.focus,
+            "awaiting_ids": self.awaiting_ids,
+            "complete": persist_shapes and self.complete,
+            "revision": self.revision,
+            "created_at": self.created_at,
+            "updated_at": time.time(),
+        }
+
+    @classmethod
+    def from_document(cls, session_id: str, data: dict) -> "Session":
+        shapes = data.get("shapes")
+        session = cls(session_id, data["owner"], data.get("turns"),
+                      {shape["id"]: shape for shape in shapes} if shapes is not None else None,
+                      data.get("focus"), data.get("revision", 0), data.get("created_at"))
+        session.awaiting_ids = data.get("awaiting_ids", False)
+        session.complete = data.get("complete", False)
+        return session
+
+class SessionStore:
+    """Sessions kept in an in-process LRU with an idle TTL, optionally persisted to a Firestore collection.
+
+    `collection` may be any object with the Firestore CollectionReference
+    document(id).get()/set() interface, including one on the emulator.
+    """
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES, ttl_seconds: float = SESSION_TTL_SECONDS,
+                 collection=None, collection_name: str | None = SESSION_FIRESTORE_COLLECTION):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._collection = collection
+        self.collection_name = collection_name
+
+    @property
+    def collection(self):
+        if self._collection is None and self.collection_name:
+            from firebase_admin import firestore
+            self._collection = firestore.client().collection(self.collection_name)
+        return self._collection
+
+    def create(self, owner: str) -> Session:
+        session = Session(secrets.token_urlsafe(16), owner)
+        self._remember(session)
+        return session
+
+    def _remember(self, session: Session):
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def _load(self, session_id: str) -> Session | None:
+        if self.collection is None:
+            return None
+        try:
+            snapshot = self.collection.document(session_id).get()
+        except Exception as e:
+            log_event("Sessions", "Persistent read failed", severity="WARNING", error=str(e))
+            return None
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        if time.time() - data.get("updated_at", 0) > self.ttl_seconds:
+            return None
+        session = Session.from_document(session_id, data)
+        self._remember(session)
+        return session
+
+    def get(self, session_id: str, owner: str) -> Session | None:
+        """Returns the caller's live session, or None if it is unknown, expired or someone else's."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                if time.time() - session.last_used > self.ttl_seconds:
+                    del self._sessions[session_id]
+                    session = None
+                else:
+                    self._sessions.move_to_end(session_id)
+        if session is None:
+            session = self._load(session_id)
+        if session is None or session.owner != owner:
+            return None
+        session.last_used = time.time()
+        return session
+
+    def save(self, session: Session):
+        session.last_used = time.time()
+        if self.collection is None:
+            return
+        try:
+            self.collection.document(session.id).set(session.to_document())
+        except Exception as e:
+            log_event("Sessions", "Persistent write failed", severity="WARNING", session=session.id, error=str(e))
+
+    def __len__(self):
+        return len(self._sessions)
+
+session_store = SessionStore()
@@ -0,0 +1,70 @@
+"""
+Single-flight coalescing so concurrent identical requests share one upstream call
+"""
+import copy
+import threading
+from resilience import DeadlineExceeded, remaining_s
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers wait for its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn) -> tuple[dict, dict]:
+        """Returns (result, flight_info) for fn(), sharing the call with concurrent callers of `key`.
+
+        Waiters raise DeadlineExceeded if their request deadline passes first.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            # A hung leader must not hold waiters past their own request deadlines
+            remaining = remaining_s()
+            if not call.done.wait(None if remaining is None else max(0.0, remaining)):
+                raise DeadlineExceeded("Request deadline exceeded waiting for a coalesced call")
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), {"leader": False, "coalesced_waiters": call.waiters}
+
+        try:
+            result = fn()
+            # Waiters copy from a snapshot so the leader is free to annotate its own result
+            call.result = copy.deepcopy(result)
+            return result, {"leader": True, "coalesced_waiters": call.waiters}
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
+
+single_flight = SingleFlight()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The functions are flat modules deployed from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
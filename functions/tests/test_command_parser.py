@@ -0,0 +1,68 @@
+"""
+Incremental command parser: chunk boundaries, strings that look like structure, and malformed or truncated output
+"""
+import json
+import pytest
+from command_parser import CommandStreamParser, parse_commands
+
+COMMANDS = [
+    {"action": "create", "type": "text", "x": 0, "y": 0, "text": 'say "hi" {not a brace}', "fill": "#000000"},
+    {"action": "create", "type": "text", "x": 10, "y": 20, "text": "back\\slash } and \\\" quote"},
+    {"action": "create", "type": "circle", "x": -5.5, "y": 3, "radius": 40, "meta": {"nested": {"depth": 2}}},
+]
+TEXT = "Here are the commands:\n```json\n" + json.dumps(COMMANDS, indent=2) + "\n```\nDone."
+
+def feed_in_chunks(text: str, size: int) -> CommandStreamParser:
+    parser = CommandStreamParser()
+    for start in range(0, len(text), size):
+        parser.feed(text[start:start + size])
+    parser.close()
+    return parser
+
+def test_recovers_objects_from_prose_and_code_fences():
+    assert parse_commands(TEXT) == COMMANDS
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_chunk_boundaries_do_not_change_the_result(size):
+    # Size 1 splits every escape sequence and every quote from its content
+    parser = feed_in_chunks(TEXT, size)
+    assert parser.commands == COMMANDS
+    assert parser.skipped == 0
+
+def test_feed_returns_only_commands_completed_in_that_chunk():
+    parser = CommandStreamParser()
+    first = json.dumps(COMMANDS[0])
+    second = json.dumps(COMMANDS[2])
+    assert parser.feed(first + ", " + second[:10]) == [COMMANDS[0]]
+    assert parser.feed(second[10:]) == [COMMANDS[2]]
+    assert parser.commands == [COMMANDS[0], COMMANDS[2]]
+
+def test_unwraps_commands_object():
+    wrapped = json.dumps({"commands": COMMANDS[:2] + ["not a command"]})
+    assert parse_commands(wrapped) == COMMANDS[:2]
+
+def test_skips_malformed_object_and_keeps_later_ones():
+    parser = CommandStreamParser()
+    parser.feed('{"action": "create", "x": 1,} ' + json.dumps(COMMANDS[2]))
+    assert parser.close() is False
+    assert parser.commands == [COMMANDS[2]]
+    assert parser.skipped == 1
+
+def test_truncated_tail_keeps_complete_objects():
+    text = json.dumps(COMMANDS)
+    parser = CommandStreamParser()
+    parser.feed(text[:-20])
+    assert parser.close() is True
+    assert parser.commands == COMMANDS[:2]
+    assert parser.skipped == 1
+
+def test_close_resets_state_for_reuse():
+    parser = CommandStreamParser()
+    parser.feed('{"action": "create", "text": "unterminated')
+    parser.close()
+    parser.feed(json.dumps(COMMANDS[0]))
+    assert parser.commands == [COMMANDS[0]]
+
+@pytest.mark.parametrize("text", ["", "no json here", "}}} ]]", '"{"'])
+def test_text_without_objects_yields_nothing(text):
+    assert parse_commands(text) == []
@@ -0,0 +1,57 @@
+"""
+Fan-out planning: which prompts state a shape count, and how large counts are split into shards
+"""
+import pytest
+from admission import BASE_COMPLETION_TOKENS, TOKENS_PER_SHAPE, estimate_completion_tokens
+from fanout import merge_shard_commands, plan_shards, requested_count
+from router import classify_prompt
+
+@pytest.mark.parametrize("prompt, count", [
+    ("create 1000 shapes", 1000),
+    ("draw 500 small red squares", 500),
+    ("add 2,000 colorful circles", 2000),
+    ("create a 10 by 10 grid of squares", 100),
+    ("make 3 squares spaced 200 pixels apart", 3),
+    ("draw 300 boxes 20px wide", 300),
+    ("create a blue rectangle 500 pixels wide", None),
+    ("add text saying 2024 sales numbers", None),
+    ("create a circle with radius 80", None),
+    ("create 500px squares", None),
+    ("rotate it 45 degrees", None),
+])
+def test_requested_count(prompt, count):
+    assert requested_count(prompt) == count
+
+@pytest.mark.parametrize("prompt", [
+    "create a blue rectangle 500 pixels wide",
+    "make 3 squares spaced 200 pixels apart",
+    "add text saying 2024 sales numbers",
+])
+def test_measurements_do_not_fan_out_or_inflate_cost(prompt):
+    assert plan_shards(prompt) is None
+    assert estimate_completion_tokens(prompt) <= BASE_COMPLETION_TOKENS + TOKENS_PER_SHAPE * 3
+    assert classify_prompt(prompt)[0] != "complex"
+
+def test_large_counts_split_evenly():
+    shards = plan_shards("create 1000 shapes", min_shapes=200, shard_size=100, max_parallel=8)
+    assert len(shards) == 8
+    assert sum(shard["count"] for shard in shards) == 1000
+    assert max(shard["count"] for shard in shards) - min(shard["count"] for shard in shards) <= 1
+
+def test_counts_below_threshold_are_not_split():
+    assert plan_shards("create 150 circles", min_shapes=200) is None
+
+def test_merge_clamps_trims_and_deduplicates():
+    shards = [
+        {"count": 2, "region": {"x0": 0, "y0": 0, "x1": 100, "y1": 100}},
+        {"count": 2, "region": {"x0": 0, "y0": 0, "x1": 100, "y1": 100}},
+    ]
+    shape = {"action": "create", "type": "circle"}
+    results = [
+        {"success": True, "data": {"commands": [{**shape, "x": 500, "y": 50}, {**shape, "x": 10, "y": 10},
+                                                {**shape, "x": 20, "y": 20}]}},
+        {"success": True, "data": {"commands": [{**shape, "x": 10, "y": 10}, {"action": "edit"}]}},
+    ]
+    commands, stats = merge_shard_commands(shards, results)
+    assert [(c["x"], c["y"]) for c in commands] == [(100, 50), (10, 10)]
+    assert stats == {"invalid": 1, "clamped": 1, "duplicates": 1, "trimmed": 1}
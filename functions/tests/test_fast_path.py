@@ -0,0 +1,70 @@
+"""
+Fast path: formulaic prompts are laid out inside the canvas with the standard gap, everything else falls through
+"""
+import pytest
+from fast_path import MAX_FAST_PATH_SHAPES, command_bounds, fast_path_commands, parse_bulk_prompt
+from layout import CANVAS_MAX, CANVAS_MIN, DEFAULT_GAP
+
+def commands_for(prompt, **kwargs):
+    result = fast_path_commands(prompt, **kwargs)
+    assert result is not None, prompt
+    return result["data"]["commands"]
+
+@pytest.mark.parametrize("prompt, count", [
+    ("create 30 rectangles in a row", 30),
+    ("create 1000 squares", 1000),
+    ("create 50 circles in a column", 50),
+    ("create a 10x10 grid of huge squares", 100),
+    ("create 200 circles in a ring", 200),
+    ("create 40 boxes in a ring", 40),
+    ("create a red square", 1),
+])
+def test_layouts_stay_inside_the_canvas(prompt, count):
+    commands = commands_for(prompt)
+    assert len(commands) == count
+    x0, y0, x1, y1 = command_bounds(commands)
+    assert CANVAS_MIN <= x0 and x1 <= CANVAS_MAX
+    assert CANVAS_MIN <= y0 and y1 <= CANVAS_MAX
+
+@pytest.mark.parametrize("prompt", ["create 30 rectangles in a row", "create 9 circles in a row"])
+def test_layouts_are_centred_on_the_origin(prompt):
+    x0, y0, x1, y1 = command_bounds(commands_for(prompt))
+    assert x0 + x1 == pytest.approx(0, abs=0.1)
+    assert y0 + y1 == pytest.approx(0, abs=0.1)
+
+@pytest.mark.parametrize("prompt", ["create 5 squares in a row", "create 5 circles in a row"])
+def test_neighbours_keep_the_default_gap(prompt):
+    boxes = sorted(command_bounds([command]) for command in commands_for(prompt))
+    gaps = [round(b[0] - a[2], 2) for a, b in zip(boxes, boxes[1:])]
+    assert gaps == [DEFAULT_GAP] * 4
+
+def test_colors_cycle_named_colors():
+    fills = [command["fill"] for command in commands_for("create 4 red and blue circles")]
+    assert fills == ["#FF0000", "#0000FF", "#FF0000", "#0000FF"]
+
+def test_free_region_placement():
+    region = (0, -2000, 2000, 0)
+    result = fast_path_commands("create 4 squares", free_regions=[(0, 0, 50, 50), region])
+    assert result["debug"]["region"] == region
+    x0, y0, x1, y1 = command_bounds(result["data"]["commands"])
+    assert region[0] <= x0 and x1 <= region[2] and region[1] <= y0 and y1 <= region[3]
+
+def test_no_free_region_falls_through():
+    assert fast_path_commands("create 100 squares", free_regions=[(0, 0, 200, 200)]) is None
+
+@pytest.mark.parametrize("prompt", [
+    "create a login form",
+    "create 5 squares and 3 circles",
+    "create some circles",
+    "draw a house with a red roof",
+    "create 3 squares spaced 200 pixels apart",
+    f"create {MAX_FAST_PATH_SHAPES + 1} circles",
+    "create 4 squares in a 3x3 grid",
+    "make it blue",
+])
+def test_unsure_prompts_fall_through(prompt):
+    assert parse_bulk_prompt(prompt) is None
+    assert fast_path_commands(prompt) is None
+
+def test_selection_always_falls_through():
+    assert fast_path_commands("create 4 squares", selected_content={"id": "a"}) is None
@@ -0,0 +1,74 @@
+"""
+Server-side commits against a fake Firestore client: creates become documents, edits become updates
+"""
+from firestore_writer import FIRESTORE_BATCH_LIMIT, commit_commands
+
+class FakeRef:
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+    def collection(self, name):
+        return FakeCollection()
+
+class FakeCollection:
+    def __init__(self):
+        self.created = 0
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            self.created += 1
+            doc_id = f"new-{self.created}"
+        return FakeRef(doc_id)
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append(("set", ref.id, data))
+
+    def update(self, ref, data):
+        self.writes.append(("update", ref.id, data))
+
+    def commit(self):
+        self.db.commits.append(self.writes)
+        return []
+
+class FakeDb:
+    def __init__(self):
+        self.root = FakeCollection()
+        self.commits = []
+
+    def collection(self, name):
+        return self.root
+
+    def batch(self):
+        return FakeBatch(self)
+
+CIRCLE = {"action": "create", "type": "circle", "x": 0, "y": 0, "radius": 20, "fill": "#FF0000"}
+
+def test_creates_and_edits_are_written_together():
+    db = FakeDb()
+    result = commit_commands("canvas", [
+        CIRCLE,
+        {"action": "edit", "shapeId": "a", "fill": "#0000FF", "x": 5},
+        {"action": "edit", "fill": "#0000FF"},
+        {"action": "edit", "shapeId": "b"},
+    ], "user", db=db)
+    assert result["ids"] == ["new-1"]
+    assert result["updated"] == ["a"]
+    assert result["skipped"] == 2
+    [writes] = db.commits
+    assert [(operation, doc_id) for operation, doc_id, _ in writes] == [("set", "new-1"), ("update", "a")]
+    update = writes[1][2]
+    assert (update["fill"], update["x"]) == ("#0000FF", 5)
+    assert "updatedAt" in update and "createdBy" not in update
+
+def test_writes_are_split_into_batches():
+    db = FakeDb()
+    edits = [{"action": "edit", "shapeId": str(i), "y": i} for i in range(FIRESTORE_BATCH_LIMIT)]
+    result = commit_commands("canvas", [CIRCLE] * 10 + edits, "user", db=db)
+    assert result["batches"] == 2
+    assert sorted(len(writes) for writes in db.commits) == [10, FIRESTORE_BATCH_LIMIT]
+    assert len(result["updated"]) == FIRESTORE_BATCH_LIMIT
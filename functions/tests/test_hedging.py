@@ -0,0 +1,95 @@
+"""
+Hedged calls against stub providers: first valid result wins, invalid or placeholder results never do
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from hedging import HedgeStats, hedged_call
+
+VALID = {"success": True, "data": {"commands": [{"action": "create", "type": "circle"}]}, "debug": {}}
+EMPTY = {"success": True, "data": {"commands": []}, "debug": {}}
+PLACEHOLDER = {"success": True, "data": {"commands": [{"action": "create", "type": "text"}]},
+               "debug": {"fallback": True}}
+
+class Stub:
+    """A provider that returns `result` (or raises it) after `delay_s`, counting its calls."""
+
+    def __init__(self, result, delay_s: float = 0):
+        self.result = result
+        self.delay_s = delay_s
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay_s)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return {**self.result, "debug": dict(self.result.get("debug") or {})}
+
+@pytest.fixture
+def executor():
+    pool = ThreadPoolExecutor(max_workers=4)
+    yield pool
+    pool.shutdown(wait=True)
+
+def run(primary, secondary, executor, delay_ms: float = 10000):
+    stats = HedgeStats()
+    start = time.monotonic()
+    result = hedged_call(("primary", primary), ("secondary", secondary), delay_ms=delay_ms, stats=stats,
+                         executor=executor)
+    return result, stats, time.monotonic() - start
+
+def test_primary_wins_before_the_delay(executor):
+    primary, secondary = Stub(VALID), Stub(VALID)
+    result, stats, _ = run(primary, secondary, executor)
+    assert result["debug"]["hedge"]["winner"] == "primary"
+    assert result["debug"]["hedge"]["hedged"] is False
+    assert secondary.calls == 0
+    assert stats.snapshot()["wins"] == {"primary": 1}
+
+def test_slow_primary_is_hedged_after_the_delay(executor):
+    primary, secondary = Stub(VALID, delay_s=1), Stub(VALID)
+    result, _, elapsed = run(primary, secondary, executor, delay_ms=50)
+    assert (result["debug"]["hedge"]["winner"], result["debug"]["hedge"]["hedged"]) == ("secondary", True)
+    assert elapsed < 1
+
+@pytest.mark.parametrize("invalid", [EMPTY, {"success": False, "error": "boom"}, RuntimeError("boom")])
+def test_invalid_primary_hedges_immediately(executor, invalid):
+    secondary = Stub(VALID)
+    result, _, elapsed = run(Stub(invalid), secondary, executor)
+    assert result["debug"]["hedge"]["winner"] == "secondary"
+    assert secondary.calls == 1
+    # Well before the 10s hedge delay
+    assert elapsed < 1
+
+def test_placeholder_never_beats_a_slower_valid_result(executor):
+    result, _, _ = run(Stub(PLACEHOLDER), Stub(VALID, delay_s=0.1), executor)
+    assert result["debug"]["hedge"]["winner"] == "secondary"
+    assert not result["debug"].get("fallback")
+
+def test_placeholders_on_both_legs_have_no_winner(executor):
+    result, stats, _ = run(Stub(PLACEHOLDER), Stub(PLACEHOLDER), executor)
+    assert result["debug"]["hedge"]["winner"] is None
+    assert stats.snapshot()["wins"] == {}
+
+def test_both_legs_fail(executor):
+    result, stats, _ = run(Stub({"success": False, "error": "primary down"}), Stub(RuntimeError("secondary down")),
+                           executor)
+    assert (result["success"], result["error"]) == (False, "primary down")
+    snapshot = stats.snapshot()
+    assert (snapshot["requests"], snapshot["hedged"], snapshot["wins"]) == (1, 1, {})
+
+def test_loser_still_running_does_not_block_the_winner(executor):
+    release = threading.Event()
+
+    def stuck():
+        release.wait(5)
+        return VALID
+
+    try:
+        result, _, elapsed = run(stuck, Stub(VALID), executor, delay_ms=20)
+        assert result["debug"]["hedge"]["winner"] == "secondary"
+        assert elapsed < 1
+    finally:
+        release.set()
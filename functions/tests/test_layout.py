@@ -0,0 +1,54 @@
+"""
+Bulk tool expansion: layouts stay on the canvas and bad model arguments only affect their own batch
+"""
+import pytest
+from layout import CANVAS_MAX, CANVAS_MIN, MAX_BATCH_SHAPES, expand_shape_batch, layout_positions
+from openai_service import tool_call_to_commands
+
+def bounds(shapes, width=100, height=100):
+    return (min(s["x"] for s in shapes), min(s["y"] for s in shapes),
+            max(s["x"] for s in shapes) + width, max(s["y"] for s in shapes) + height)
+
+def test_default_rectangle_grid_is_centred_and_on_the_canvas():
+    shapes = expand_shape_batch({"count": 1000, "width": 75, "height": 75, "layout": {"spacingX": 125, "spacingY": 125}})
+    x0, y0, x1, y1 = bounds(shapes, 75, 75)
+    assert CANVAS_MIN <= x0 and x1 <= CANVAS_MAX and CANVAS_MIN <= y0 and y1 <= CANVAS_MAX
+    assert x0 + x1 == pytest.approx(0)
+
+def test_default_circle_positions_are_centres():
+    assert layout_positions(3, {"pattern": "row"}, (100, 100), centred=True) == [(-150, 0), (0, 0), (150, 0)]
+    assert layout_positions(3, {"pattern": "row"}, (100, 100)) == [(-200, -50), (-50, -50), (100, -50)]
+
+@pytest.mark.parametrize("args", [
+    {"count": "ten"},
+    {"count": None, "columns": "x"},
+    {"count": float("nan")},
+    {"count": -3},
+])
+def test_unusable_counts_skip_the_batch(args):
+    assert expand_shape_batch(args) == []
+
+def test_numeric_strings_are_coerced():
+    shapes = expand_shape_batch({"count": "4", "width": "50", "layout": {"pattern": "row", "spacingX": "60"}})
+    assert [s["x"] for s in shapes] == [-115, -55, 5, 65]
+    assert all(s["width"] == 50 for s in shapes)
+
+def test_bad_layout_and_size_values_fall_back_to_defaults():
+    shapes = expand_shape_batch({"count": 4, "shapeType": "circle", "radius": "big", "colors": "red",
+                                 "layout": {"rows": "two", "spacingX": [1], "originX": None}})
+    assert len(shapes) == 4
+    assert "radius" not in shapes[0] and "fill" not in shapes[0]
+
+def test_shapes_with_bad_column_positions_are_skipped():
+    shapes = expand_shape_batch({"count": 3, "columns": {"x": [0, "left", 20], "y": [0, 10, {"y": 1}]}})
+    assert [(s["x"], s["y"]) for s in shapes] == [(0, 0)]
+
+def test_count_is_capped():
+    assert len(expand_shape_batch({"count": MAX_BATCH_SHAPES * 2, "width": 1, "height": 1})) == MAX_BATCH_SHAPES
+
+def test_bad_batch_does_not_affect_other_tool_calls():
+    calls = [("createShapes", {"count": "ten", "shapeType": "circle"}),
+             ("createShapes", {"count": 2, "shapeType": "circle", "radius": 10})]
+    commands = [command for name, args in calls for command in tool_call_to_commands(name, args)]
+    assert len(commands) == 2
+    assert all(command["radius"] == 10 for command in commands)
@@ -0,0 +1,153 @@
+"""
+Command post-processing: validation, clamping, color normalization and the bulk overlap pass
+"""
+import pytest
+from layout import CANVAS_MAX, CANVAS_MIN
+from postprocess import OVERLAP_MIN_SHAPES, normalize_color, postprocess_commands
+
+def circle(x, y, radius=50, **fields):
+    return {"action": "create", "type": "circle", "x": x, "y": y, "radius": radius, **fields}
+
+def rectangle(x, y, width=100, height=100, **fields):
+    return {"action": "create", "type": "rectangle", "x": x, "y": y, "width": width, "height": height, **fields}
+
+def boxes(commands):
+    for command in commands:
+        if command["type"] == "circle":
+            r = command["radius"]
+            yield command["type"], (command["x"] - r, command["y"] - r, command["x"] + r, command["y"] + r)
+        elif command["type"] == "rectangle":
+            yield command["type"], (command["x"], command["y"], command["x"] + command["width"], command["y"] + command["height"])
+
+def overlapping_pairs(commands) -> int:
+    placed = list(boxes(commands))
+    return sum(
+        1
+        for i, (type_a, a) in enumerate(placed)
+        for type_b, b in placed[i + 1:]
+        if type_a == type_b and a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+    )
+
+@pytest.mark.parametrize("value, expected", [
+    ("red", "#FF0000"),
+    (" Blue ", "#0000FF"),
+    ("#abc", "#AABBCC"),
+    ("00ff00", "#00FF00"),
+    ("rgb(255, 165, 0)", "#FFA500"),
+    ("rgba(300, 0, 0, 0.5)", "#FF0000"),
+    ("#FF000080", "#FF000080"),
+    ("#f008", "#FF000088"),
+    ("lightblue", "lightblue"),
+    ("Navy", "navy"),
+    ("transparent", "transparent"),
+    ("hsl(120, 50%, 50%)", "hsl(120, 50%, 50%)"),
+    ("not-a-color", None),
+    ("#12345", None),
+    (["red"], None),
+    ({"r": 255}, None),
+    (None, None),
+])
+def test_normalize_color(value, expected):
+    assert normalize_color(value) == expected
+
+def test_unhashable_and_invalid_colors_fall_back():
+    commands, stats = postprocess_commands([
+        rectangle(0, 0, fill=["red"], stroke={"r": 1}),
+        {"action": "edit", "shapeId": "a", "fill": "not-a-color", "x": 10},
+    ])
+    assert commands[0]["fill"] == "#000000"
+    assert "stroke" not in commands[0]
+    # An edit keeps the shape's current color rather than turning it black
+    assert commands[1] == {"action": "edit", "shapeId": "a", "x": 10}
+    assert stats["colors_fixed"] == 3
+
+def test_renderable_colors_pass_through_edits():
+    edits = [{"action": "edit", "shapeId": str(i), "fill": fill}
+             for i, fill in enumerate(["lightblue", "transparent", "navy", "#FF000080"])]
+    commands, stats = postprocess_commands(edits)
+    assert commands == edits
+    assert stats["colors_fixed"] == 0
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-Infinity", float("nan"), float("inf")])
+def test_non_finite_positions_are_dropped(value):
+    commands, stats = postprocess_commands([circle(value, 0), circle(0, value)])
+    assert commands == []
+    assert stats["dropped"] == 2
+
+@pytest.mark.parametrize("value", ["nan", float("inf"), "wide", None, True])
+def test_non_finite_or_missing_sizes_get_defaults(value):
+    commands, _ = postprocess_commands([rectangle(0, 0, width=value, height=value), circle(500, 0, radius=value)])
+    assert (commands[0]["width"], commands[0]["height"]) == (100, 100)
+    assert commands[1]["radius"] == 50
+
+def test_malformed_commands_are_dropped():
+    commands, stats = postprocess_commands([
+        "not a dict",
+        {"type": "circle", "x": 0, "y": 0},
+        {"action": "create", "type": "hexagon", "x": 0, "y": 0},
+        {"action": "create", "type": "circle", "x": "left", "y": 0},
+        circle("10", "20"),
+    ])
+    assert commands == [circle(10, 20, fill="#000000")]
+    assert stats["dropped"] == 4
+
+def test_positions_and_sizes_are_clamped():
+    commands, stats = postprocess_commands([rectangle(-99999, 99999, width=-5, height=10 ** 9)])
+    assert (commands[0]["x"], commands[0]["y"]) == (CANVAS_MIN, CANVAS_MAX)
+    assert (commands[0]["width"], commands[0]["height"]) == (1, CANVAS_MAX - CANVAS_MIN)
+    assert stats["clamped"] == 4
+
+def test_small_composed_drawing_keeps_its_positions():
+    # A snowman: three stacked circles that overlap on purpose
+    snowman = [circle(0, 0, 60), circle(0, 90, 80), circle(0, 200, 100)]
+    commands, stats = postprocess_commands(snowman)
+    assert [(c["x"], c["y"]) for c in commands] == [(0, 0), (0, 90), (0, 200)]
+    assert stats["moved"] == 0
+
+def test_forced_overlap_pass_moves_small_batches():
+    commands, stats = postprocess_commands([circle(0, 0), circle(0, 0)], fix_overlaps=True)
+    assert stats["moved"] == 1
+    assert overlapping_pairs(commands) == 0
+
+def test_bulk_batch_overlaps_are_resolved_by_default():
+    # A grid with every fifth cell stacked onto its neighbour
+    grid = [rectangle(-1800 + (i % 10) * 200 - (150 if i % 5 == 4 else 0), -1800 + (i // 10) * 200)
+            for i in range(OVERLAP_MIN_SHAPES * 2)]
+    assert overlapping_pairs(grid) > 0
+    commands, stats = postprocess_commands(grid)
+    assert stats["moved"] > 0
+    assert stats["unresolved"] == 0
+    assert overlapping_pairs(commands) == 0
+
+def test_disabled_overlap_pass_leaves_bulk_batches_alone():
+    grid = [rectangle(0, 0) for _ in range(OVERLAP_MIN_SHAPES)]
+    commands, stats = postprocess_commands(grid, fix_overlaps=False)
+    assert stats["moved"] == 0
+    assert overlapping_pairs(commands) == len(grid) * (len(grid) - 1) // 2
+
+def test_nested_and_mixed_type_shapes_are_not_moved():
+    commands, stats = postprocess_commands([
+        circle(0, 0, 200),
+        circle(-50, -30, 20),
+        circle(50, -30, 20),
+        rectangle(-100, -100, 200, 200),
+        {"action": "create", "type": "text", "x": 0, "y": 0, "text": "label"},
+    ], fix_overlaps=True)
+    assert stats["moved"] == 0
+    assert [(c["x"], c["y"]) for c in commands] == [(0, 0), (-50, -30), (50, -30), (-100, -100), (0, 0)]
+
+def test_shapes_at_the_canvas_edge_wrap_to_the_next_row():
+    edge = CANVAS_MAX - 100
+    commands, stats = postprocess_commands([rectangle(edge, 0), rectangle(edge, 0)], fix_overlaps=True)
+    assert stats["moved"] == 1
+    moved = commands[1]
+    assert moved["x"] == CANVAS_MIN
+    assert moved["y"] > 0
+    assert overlapping_pairs(commands) == 0
+
+def test_shapes_with_no_room_are_left_unresolved():
+    corner = CANVAS_MAX - 100
+    commands, stats = postprocess_commands([rectangle(corner, corner) for _ in range(3)], fix_overlaps=True)
+    assert stats["moved"] == 0
+    assert stats["unresolved"] == 2
+    assert len(commands) == 3
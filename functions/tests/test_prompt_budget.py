@@ -0,0 +1,36 @@
+"""
+Prompt budgets: the largest accepted selection fits the budget, and overflows surface as a client error
+"""
+import pytest
+from layout import MAX_SELECTION_SHAPES
+from openai_service import build_messages
+from prompt_budget import PROMPT_TOKEN_BUDGET, PromptBudgetExceeded, estimate_tokens
+from resilience import error_status
+
+def selection(count: int) -> list[dict]:
+    # Firestore-style ids and unrounded positions, as the client sends them
+    return [
+        {"id": f"Qm{i:05d}xYzAbCdEfGhIjK", "type": "rectangle" if i % 2 else "circle",
+         "x": -1999.123456 + i * 3.7, "y": 1500.987654 - i * 2.9, "width": 120.5 + i % 7, "height": 80.25,
+         "radius": 45.125, "fill": f"#{i * 2654435761 % 0xFFFFFF:06X}", "stroke": "#000000", "strokeWidth": 2,
+         "rotation": 15}
+        for i in range(count)
+    ]
+
+def test_largest_accepted_selection_fits_the_budget():
+    _, info = build_messages("make them all a little bigger and blue", selection(MAX_SELECTION_SHAPES))
+    assert info["estimated_prompt_tokens"] <= PROMPT_TOKEN_BUDGET
+
+def test_canvas_summary_is_dropped_before_failing():
+    summary = "CANVAS: " + "shape " * 30000
+    _, info = build_messages("create a red circle", None, summary)
+    assert info["dropped_canvas_context"] is True
+
+def test_oversized_prompt_is_a_client_error():
+    with pytest.raises(PromptBudgetExceeded) as raised:
+        build_messages("make them blue", selection(MAX_SELECTION_SHAPES * 3))
+    assert error_status(raised.value) == {"status": 413}
+
+@pytest.mark.parametrize("text, tokens", [("", 0), ("abcd", 1), ("abcde", 2), ("12345", 2), ("{}", 1)])
+def test_estimate_tokens(text, tokens):
+    assert estimate_tokens(text) == tokens
@@ -0,0 +1,164 @@
+"""
+Routing decisions against stub providers: outcomes are recorded straight into ModelStats on a fake clock
+"""
+import pytest
+from instrumentation import OTHER_MODEL, LatencyHistogram
+from prompt_budget import PromptCacheStats
+from router import ModelRouter, ModelStats, classify_prompt, parse_succeeded
+
+TIERS = {
+    "simple": ["nano", "mini"],
+    "standard": ["mini", "full"],
+    "complex": ["full", "mini"],
+}
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def router(clock):
+    return ModelRouter(tiers=TIERS, stats=ModelStats(window_s=600, clock=clock), min_success_rate=0.8, min_samples=5)
+
+def record(router, model: str, count: int, latency_ms: float = 1000, ok: bool = True):
+    for _ in range(count):
+        router.record("openai", model, latency_ms, ok)
+
+@pytest.mark.parametrize("prompt, selected, tier", [
+    ("create a red circle", None, "simple"),
+    ("make it blue", {"id": "a", "type": "circle"}, "simple"),
+    ("make them bigger", [{"id": str(i)} for i in range(3)], "simple"),
+    ("create 20 circles", None, "standard"),
+    ("create 4 squares in a grid", None, "standard"),
+    ("make them blue", [{"id": str(i)} for i in range(40)], "standard"),
+    ("create a navbar", None, "standard"),
+    ("create a login form with a header and a submit button", None, "complex"),
+    ("create 100 circles", None, "complex"),
+    (" ".join(["word"] * 45), None, "complex"),
+])
+def test_classify_prompt(prompt, selected, tier):
+    assert classify_prompt(prompt, selected)[0] == tier
+
+def test_classify_prompt_is_deterministic():
+    prompt = "arrange 12 blue squares in a row"
+    assert classify_prompt(prompt) == classify_prompt(prompt)
+
+def test_routes_to_preferred_model_without_samples(router):
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "nano"
+    assert decision["tier"] == "simple"
+    assert decision["reason"] == "preferred"
+
+def test_too_few_samples_do_not_move_traffic(router):
+    record(router, "nano", 4, ok=False)
+    assert router.route("openai", "create a red circle")[0] == "nano"
+
+def test_shifts_away_from_failing_model(router):
+    record(router, "nano", 5, ok=False)
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "mini"
+    assert decision["reason"] == "shifted"
+    assert decision["candidates"][0]["success_rate"] == 0
+
+def test_shifts_away_from_slow_model(router):
+    # Above the simple tier's 6s p95 SLO, though every call succeeded
+    record(router, "nano", 10, latency_ms=9000)
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "mini"
+    assert decision["reason"] == "shifted"
+
+def test_slow_model_still_serves_tier_with_looser_slo(router):
+    record(router, "full", 10, latency_ms=9000)
+    assert router.route("openai", "create a login form with a header and a submit button")[0] == "full"
+
+def test_statistics_are_per_provider(router):
+    record(router, "nano", 5, ok=False)
+    assert router.route("replicate", "create a red circle")[0] == "nano"
+
+def test_recovers_once_bad_samples_age_out(router, clock):
+    record(router, "nano", 5, ok=False)
+    assert router.route("openai", "create a red circle")[0] == "mini"
+    clock.now += 601
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "nano"
+    assert decision["reason"] == "preferred"
+
+def test_recent_good_samples_outweigh_old_failures(router, clock):
+    record(router, "nano", 5, ok=False)
+    clock.now += 300
+    record(router, "nano", 20)
+    assert router.route("openai", "create a red circle")[0] == "nano"
+
+def test_best_available_prefers_higher_success_rate(router):
+    record(router, "nano", 5, ok=False)
+    record(router, "mini", 3)
+    record(router, "mini", 2, ok=False)
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "mini"
+    assert decision["reason"] == "best_available"
+
+def test_best_available_breaks_ties_on_latency(router):
+    record(router, "nano", 5, latency_ms=20000)
+    record(router, "mini", 5, latency_ms=8000)
+    model, decision = router.route("openai", "create a red circle")
+    assert model == "mini"
+    assert decision["reason"] == "best_available"
+
+def test_record_result_counts_unparsed_output_as_failure(router):
+    fallback = {"success": True, "data": {"commands": [{"action": "create"}]},
+                "debug": {"fallback": True, "response_time_ms": 500}}
+    for _ in range(5):
+        router.record_result("openai", "nano", fallback, 999)
+    summary = router.stats.summary("openai:nano")
+    assert summary["success_rate"] == 0
+    assert router.route("openai", "create a red circle")[0] == "mini"
+
+def test_record_result_prefers_service_latency(router):
+    result = {"success": True, "data": {"commands": [{"action": "create"}]}, "debug": {"response_time_ms": 250}}
+    router.record_result("openai", "nano", result, 9999)
+    assert router.stats.summary("openai:nano")["p50_ms"] == 250
+
+def test_failures_before_the_upstream_call_are_not_recorded(router):
+    for result in ({"success": False, "error": "Prompt needs about 60000 tokens", "status": 413},
+                   {"success": False, "error": "OpenAI API key not configured", "upstream": False}):
+        for _ in range(5):
+            router.record_result("openai", "nano", result, 10)
+    assert router.stats.summary("openai:nano")["samples"] == 0
+    assert router.route("openai", "create a red circle")[0] == "nano"
+
+def test_upstream_failures_are_recorded(router):
+    for _ in range(5):
+        router.record_result("openai", "nano", {"success": False, "error": "boom", "upstream": True}, 10)
+    assert router.stats.summary("openai:nano")["success_rate"] == 0
+
+def test_unknown_models_share_one_window(router):
+    for i in range(50):
+        router.record("openai", f"made-up-{i}", 100, False)
+    assert set(router.stats.snapshot()) == {f"openai:{OTHER_MODEL}"}
+    assert router.stats.summary(f"openai:{OTHER_MODEL}")["samples"] == 50
+
+def test_per_model_diagnostics_are_bounded():
+    histogram = LatencyHistogram(max_models=2)
+    cache_stats = PromptCacheStats(max_models=2)
+    for model in ("a", "b", "c", "d"):
+        histogram.record(model, "total", 10)
+        cache_stats.record(model, 100, 50)
+    assert set(histogram.snapshot()) == {"a", "b", OTHER_MODEL}
+    assert set(cache_stats.snapshot()) == {"a", "b", OTHER_MODEL}
+    assert cache_stats.snapshot()[OTHER_MODEL]["requests"] == 2
+
+@pytest.mark.parametrize("result, ok", [
+    ({"success": True, "data": {"commands": [{"action": "create"}]}, "debug": {}}, True),
+    ({"success": True, "data": {"commands": []}, "debug": {}}, False),
+    ({"success": False, "error": "boom"}, False),
+    ({"success": True, "data": {"commands": [{"action": "create"}]}, "debug": {"fallback": True}}, False),
+])
+def test_parse_succeeded(result, ok):
+    assert parse_succeeded(result) is ok
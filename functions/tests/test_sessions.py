@@ -0,0 +1,82 @@
+"""
+Sessions: follow-up detection, canvas deltas and how each turn moves the focus
+"""
+import pytest
+from sessions import MAX_HISTORY_TURNS, Session, is_follow_up
+
+def shape(shape_id, **fields):
+    return {"id": shape_id, "type": "circle", "x": 0, "y": 0, "radius": 20, "fill": "#FF0000", **fields}
+
+def create(**fields):
+    return {"action": "create", "type": "circle", "x": 0, "y": 0, "radius": 20, **fields}
+
+@pytest.mark.parametrize("prompt", [
+    "shift the second row",
+    "make the squares bigger",
+    "make them blue",
+    "make that circle red",
+    "rotate everything 45 degrees",
+    "align to the left",
+])
+def test_prompts_without_create_verbs_are_follow_ups(prompt):
+    assert is_follow_up(prompt)
+
+@pytest.mark.parametrize("prompt", [
+    "create a rectangle that is blue",
+    "add text saying hello",
+    "draw another one",
+    "make a red circle",
+    "make 3 squares",
+    "generate some new shapes next to them",
+])
+def test_prompts_asking_for_new_shapes_are_not_follow_ups(prompt):
+    assert not is_follow_up(prompt)
+
+def test_delta_upserts_and_removes():
+    session = Session("s", "owner", shapes={"a": shape("a"), "b": shape("b")})
+    session.apply_delta({"upsert": [{"id": "a", "fill": "#0000FF"}, shape("c")], "remove": ["b", "missing"]})
+    assert set(session.shapes) == {"a", "c"}
+    assert session.shapes["a"]["fill"] == "#0000FF"
+    assert session.shapes["a"]["radius"] == 20
+    assert session.revision == 1
+
+def test_delta_without_snapshot_starts_a_partial_canvas():
+    session = Session("s", "owner")
+    session.apply_delta({"upsert": [shape("a")]})
+    assert session.canvas_state() == "partial"
+
+def test_uncommitted_creates_take_their_ids_from_the_next_delta():
+    session = Session("s", "owner", shapes={"a": shape("a")})
+    session.record_turn("create two circles", [create(), create(x=100)])
+    assert session.awaiting_ids
+    assert session.focus_shapes() == []
+    session.apply_delta({"upsert": [shape("a", x=5), shape("n1"), shape("n2", x=100)]})
+    assert not session.awaiting_ids
+    assert [s["id"] for s in session.focus_shapes()] == ["n1", "n2"]
+
+def test_committed_creates_become_the_focus():
+    session = Session("s", "owner", shapes={})
+    session.record_turn("create two circles", [create(), create(x=100)], ["n1", "n2"])
+    assert not session.awaiting_ids
+    assert [(s["id"], s["x"]) for s in session.focus_shapes()] == [("n1", 0), ("n2", 100)]
+
+def test_edits_update_the_canvas_and_the_focus():
+    session = Session("s", "owner", shapes={"a": shape("a"), "b": shape("b")}, focus=["a", "b"])
+    session.record_turn("make the first one blue", [{"action": "edit", "shapeId": "a", "fill": "#0000FF"}])
+    assert session.shapes["a"]["fill"] == "#0000FF"
+    assert session.focus == ["a"]
+    assert session.turns[-1] == {"prompt": "make the first one blue", "result": "edited 1 shapes (fill)"}
+
+def test_turns_without_changes_keep_the_focus():
+    session = Session("s", "owner", shapes={"a": shape("a")}, focus=["a"])
+    session.record_turn("what is this", [])
+    assert session.focus == ["a"]
+
+def test_history_is_bounded_and_newest_first_to_fit():
+    session = Session("s", "owner")
+    for i in range(MAX_HISTORY_TURNS + 3):
+        session.record_turn(f"turn {i}", [])
+    assert len(session.turns) == MAX_HISTORY_TURNS
+    text = session.history_text(budget=20)
+    assert f'"turn {MAX_HISTORY_TURNS + 2}"' in text
+    assert '"turn 3"' not in text
@@ -1,13 +1,14 @@
 
 import json
 from firebase_functions import https_fn
+from layout import MAX_SELECTION_SHAPES
 
 def handle_cors(req: https_fn.Request) -> https_fn.Response | None:
     """Handles CORS preflight requests."""
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Request-Timeout-Ms',
     }
     if req.method == 'OPTIONS':
         return https_fn.Response('', status=204, headers=headers)
@@ -46,6 +47,14 @@ def validate_request(req: https_fn.Request) -> tuple[dict | None, https_fn.Respo
                 headers={'Content-Type': 'application/json'}
             )
 
+        selected_content = request_data.get('selectedContent')
+        if isinstance(selected_content, list) and len(selected_content) > MAX_SELECTION_SHAPES:
+            return None, https_fn.Response(
+                json.dumps({'success': False, 'error': f'Too many selected shapes (max {MAX_SELECTION_SHAPES})'}),
+                status=400,
+                headers={'Content-Type': 'application/json'}
+            )
+
         return request_data, None
     except Exception as e:
         return None, https_fn.Response(
@@ -53,3 +62,28 @@ def validate_request(req: https_fn.Request) -> tuple[dict | None, https_fn.Respo
             status=400,
             headers={'Content-Type': 'application/json'}
         )
+
+def get_auth_uid(req: https_fn.Request) -> str | None:
+    """Returns the uid from a verified Firebase ID token in the Authorization header, if any."""
+    header = req.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    from firebase_admin import auth
+    try:
+        return auth.verify_id_token(header[len('Bearer '):])['uid']
+    except Exception:
+        return None
+
+def wants_event_stream(req: https_fn.Request, request_data: dict) -> bool:
+    """Returns True if the client asked for Server-Sent Events instead of NDJSON."""
+    stream_format = request_data.get('format')
+    if stream_format:
+        return stream_format == 'sse'
+    return 'text/event-stream' in req.headers.get('Accept', '')
+
+def format_stream_frame(event: dict, sse: bool) -> str:
+    """Serializes a stream event as an SSE event or a single NDJSON line."""
+    payload = json.dumps(event)
+    if sse:
+        return f"event: {event['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
@@ -173,6 +173,7 @@ const AIWidget: React.FC<AIWidgetProps> = ({
             className="w-full px-2 py-1 text-xs border border-gray-300 rounded-md shadow-sm focus:outline-none focus:ring-1 focus:ring-blue-500 focus:border-blue-500"
             disabled={loading}
           >
+            <option value="auto">Auto</option>
             <option value="gpt-5">GPT-5</option>
             <option value="gpt-5-mini">GPT-5 Mini</option>
             <option value="gpt-5-nano">GPT-5 Nano</option>
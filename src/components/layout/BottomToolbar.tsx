@@ -32,7 +32,7 @@ import ShapeCreationForm from './ShapeCreationForm'
 import TextToolbar from './TextToolbar'
 import { ShapeType, FontFamily, FontStyle, ContentType, ContentVersion } from '../../types'
 import type { Content } from '../../types'
-import { callAITest, type AIProvider, type GPT5Model } from '../../lib/aiApi'
+import { callAITest, toCanvasSnapshot, type AIProvider, type GPT5Model } from '../../lib/aiApi'
 import { buildGrid } from '../../lib/utils'
 import { useCanvasStore } from '../../store/canvasStore'
 
@@ -264,7 +264,10 @@ const BottomToolbar: React.FC<BottomToolbarProps> = ({
       })
 
       // Call AI backend with the user's prompt and optional selected content
-      const response = await callAITest(agentInput.trim(), aiProvider, aiModel, selectedContent)
+      // Placement only matters for new shapes; edits leave the snapshot out so their responses stay cacheable
+      const response = await callAITest(agentInput.trim(), aiProvider, aiModel, selectedContent, {
+        canvasSnapshot: !isEditing && content.length > 0 ? toCanvasSnapshot(content) : undefined,
+      })
 
       console.log('[Agent Toolbar] Received response:', response)
 
@@ -277,12 +280,14 @@ const BottomToolbar: React.FC<BottomToolbarProps> = ({
 
           if (command.action === 'edit') {
             // Handle edit action - update existing content
-            if (!selectedContent) {
+            // Batch edits name their target; single edits apply to the selection
+            const targetId = command.shapeId ?? selectedContent?.id
+            if (!targetId) {
               console.warn('[Agent Toolbar] Edit action but no content selected')
               continue
             }
 
-            console.log('[Agent Toolbar] Editing content:', selectedContent.id)
+            console.log('[Agent Toolbar] Editing content:', targetId)
             const updates: any = {}
 
             // Build updates object from command properties
@@ -300,7 +305,7 @@ const BottomToolbar: React.FC<BottomToolbarProps> = ({
             if (command.fontFamily !== undefined) updates.fontFamily = command.fontFamily
             if (command.fontStyle !== undefined) updates.fontStyle = command.fontStyle
 
-            await onUpdateContent!(selectedContent.id, updates as Partial<Content>)
+            await onUpdateContent!(targetId, updates as Partial<Content>)
             console.log('[Agent Toolbar] Content updated successfully')
 
           } else if (command.action === 'create') {
@@ -522,6 +527,7 @@ const BottomToolbar: React.FC<BottomToolbarProps> = ({
                 <SelectValue />
               </SelectTrigger>
               <SelectContent>
+                <SelectItem value="auto">Auto</SelectItem>
                 <SelectItem value="gpt-5">GPT-5</SelectItem>
                 <SelectItem value="gpt-5-mini">GPT-5 Mini</SelectItem>
                 <SelectItem value="gpt-5-nano">GPT-5 Nano</SelectItem>
@@ -0,0 +1,47 @@
+import { describe, it, expect } from 'vitest'
+import { decodeColumnarCommands, toCanvasSnapshot } from '../aiApi'
+
+describe('decodeColumnarCommands', () => {
+  it('should expand rows into commands using the shared key table', () => {
+    const commands = decodeColumnarCommands({
+      keys: ['action', 'type', 'x', 'y', 'fill', 'width', 'height', 'radius'],
+      rows: [
+        ['create', 'rectangle', 0, 10, '#FF0000', 100, 50, null],
+        ['create', 'circle', 200, 10, '#0000FF', null, null, 25],
+      ],
+    })
+
+    expect(commands).toEqual([
+      { action: 'create', type: 'rectangle', x: 0, y: 10, fill: '#FF0000', width: 100, height: 50 },
+      { action: 'create', type: 'circle', x: 200, y: 10, fill: '#0000FF', radius: 25 },
+    ])
+  })
+
+  it('should keep falsy values other than null', () => {
+    const [command] = decodeColumnarCommands({
+      keys: ['action', 'x', 'y', 'text'],
+      rows: [['create', 0, 0, '']],
+    })
+
+    expect(command).toEqual({ action: 'create', x: 0, y: 0, text: '' })
+  })
+
+  it('should return an empty list for an empty payload', () => {
+    expect(decodeColumnarCommands({ keys: [], rows: [] })).toEqual([])
+  })
+})
+
+describe('toCanvasSnapshot', () => {
+  it('should keep only the fields used for canvas context', () => {
+    const snapshot = toCanvasSnapshot([
+      {
+        id: 'shape-1', type: 'rectangle', x: 10, y: 20, width: 100, height: 50, fill: '#FF0000',
+        createdBy: 'user-1', version: 'v2', lockedBy: null,
+      } as { id: string },
+    ])
+
+    expect(snapshot).toEqual([
+      { id: 'shape-1', type: 'rectangle', x: 10, y: 20, width: 100, height: 50, fill: '#FF0000' },
+    ])
+  })
+})
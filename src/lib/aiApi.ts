@@ -1,23 +1,48 @@
 export type AIProvider = 'openai' | 'replicate';
 
-export type GPT5Model = 'gpt-5' | 'gpt-5-mini' | 'gpt-5-nano' | 'gpt-4o-mini' | 'gpt-4.1-nano' | 'meta/meta-llama-3-8b-instruct';
+export type GPT5Model = 'auto' | 'gpt-5' | 'gpt-5-mini' | 'gpt-5-nano' | 'gpt-4o-mini' | 'gpt-4.1-nano' | 'meta/meta-llama-3-8b-instruct';
+
+export type DebugLevel = 'none' | 'summary' | 'full';
+
+/**
+ * Compact command encoding: a shared key table plus one value row per command.
+ * A null value means the command does not have that key.
+ */
+export interface ColumnarCommands {
+  keys: (keyof CanvasCommand)[];
+  rows: unknown[][];
+}
 
 export interface AIResponse {
   success: boolean;
   data?: {
     commands: CanvasCommand[];
     message: string;
+    encoding?: 'columnar';
+    columns?: ColumnarCommands;
+    /** Session mode: id to send with the next turn, and how much of the canvas the server knows */
+    sessionId?: string;
+    turn?: number;
+    canvasState?: 'complete' | 'partial' | 'missing';
   };
   error?: string;
   debug?: {
     tokens_used?: number;
     prompt_tokens?: number;
     completion_tokens?: number;
+    cached_tokens?: number | null;
+    estimated_prompt_tokens?: number;
     model?: string;
     response_time_ms?: number;
     function_calls?: number;
     provider?: string;
     raw_response_length?: number;
+    path?: 'fast_path' | 'cache' | 'model';
+    route?: {
+      tier: 'simple' | 'standard' | 'complex';
+      model: string;
+      reason: 'preferred' | 'shifted' | 'best_available';
+    };
   };
 }
 
@@ -44,23 +69,101 @@ interface AITestRequest {
   prompt: string;
   provider?: AIProvider;
   model?: GPT5Model;
+  /** One selected shape, or a list of shapes (with ids) for a batch edit */
   selectedContent?: any;
+  compact?: boolean;
+  debug?: DebugLevel;
+  canvasSnapshot?: CanvasSnapshotShape[];
+  canvasRevision?: string;
+  sessionId?: string;
+  canvasDelta?: CanvasDelta;
+  followUp?: boolean;
+}
+
+/** Canvas changes since the previous turn of a session */
+export interface CanvasDelta {
+  upsert?: CanvasSnapshotShape[];
+  remove?: string[];
+}
+
+/** The subset of a content item the functions need to summarize the canvas */
+export type CanvasSnapshotShape = Record<string, unknown> & { id: string };
+
+const SNAPSHOT_FIELDS = ['id', 'type', 'x', 'y', 'width', 'height', 'radius', 'fill', 'text', 'fontSize'];
+
+/**
+ * Strips content items down to the fields used for canvas context
+ * @param content - Content items currently on the canvas
+ * @returns CanvasSnapshotShape[] - Compact shapes to send as canvasSnapshot
+ */
+export const toCanvasSnapshot = (content: { id: string }[]): CanvasSnapshotShape[] => {
+  return content.map((item) => {
+    const shape: Record<string, unknown> = {};
+    SNAPSHOT_FIELDS.forEach((field) => {
+      const value = (item as Record<string, unknown>)[field];
+      if (value !== undefined && value !== null) {
+        shape[field] = value;
+      }
+    });
+    return shape as CanvasSnapshotShape;
+  });
+};
+
+interface AIRequestOptions {
+  /** Ask for the columnar command encoding (decoded transparently) */
+  compact?: boolean;
+  /** How much debug information the function should return */
+  debug?: DebugLevel;
+  /** Shapes on the canvas, summarized server-side so placement avoids them */
+  canvasSnapshot?: CanvasSnapshotShape[];
+  /** Revision of the stored canvas (canvasContext); lets the function skip the Firestore read */
+  canvasRevision?: string;
+  /** Run as a session turn; history and canvas state stay on the server (OpenAI only) */
+  session?: boolean;
+  /** Session to continue; omit on the first turn */
+  sessionId?: string;
+  /** Canvas changes since the previous turn, sent instead of a full snapshot */
+  canvasDelta?: CanvasDelta;
+  /** Whether the prompt edits the previous turn's shapes; guessed from its wording when omitted */
+  followUp?: boolean;
 }
 
+/**
+ * Expands a columnar command payload back into command objects
+ * @param columns - The shared key table and value rows returned by the function
+ * @returns CanvasCommand[] - One command per row
+ */
+export const decodeColumnarCommands = (columns: ColumnarCommands): CanvasCommand[] => {
+  return columns.rows.map((row) => {
+    const command: Record<string, unknown> = {};
+    columns.keys.forEach((key, index) => {
+      if (row[index] !== null && row[index] !== undefined) {
+        command[key] = row[index];
+      }
+    });
+    return command as unknown as CanvasCommand;
+  });
+};
+
 /**
  * Calls the AI test Firebase function with a user prompt
  * @param prompt - The user's prompt to send to the AI
  * @param provider - The AI provider to use ('openai' or 'replicate')
- * @param model - The GPT-5 model to use ('gpt-5', 'gpt-5-mini', or 'gpt-5-nano')
+ * @param model - The GPT-5 model to use ('gpt-5', 'gpt-5-mini', or 'gpt-5-nano'), or 'auto' to route by prompt complexity
  * @param selectedContent - Optional selected content object for editing
+ * @param options - Response shaping options (compact encoding, debug level)
  * @returns Promise<AIResponse> - The AI's response or error
  */
 export const callAITest = async (
   prompt: string,
   provider: AIProvider = 'openai',
   model: GPT5Model = 'gpt-5-mini',
-  selectedContent?: any
+  selectedContent?: any,
+  options: AIRequestOptions = {}
 ): Promise<AIResponse> => {
+  const { compact = true, debug = 'summary', canvasSnapshot, canvasRevision, sessionId, canvasDelta, followUp } = options;
+  const useSession = Boolean(options.session || sessionId) && provider === 'openai';
+
   try {
     // Determine function URL based on provider and environment
     const isLocal = import.meta.env.DEV || window.location.hostname === 'localhost';
@@ -69,9 +172,13 @@ export const callAITest = async (
       ? (isLocal
           ? 'http://localhost:5001/collab-canvas-kenkel/us-central1/ai_text_to_canvas_replicate'
           : 'https://us-central1-collab-canvas-kenkel.cloudfunctions.net/ai_text_to_canvas_replicate')
-      : (isLocal
-          ? 'http://localhost:5001/collab-canvas-kenkel/us-central1/ai_text_to_canvas'
-          : 'https://us-central1-collab-canvas-kenkel.cloudfunctions.net/ai_text_to_canvas');
+      : useSession
+        ? (isLocal
+            ? 'http://localhost:5001/collab-canvas-kenkel/us-central1/ai_text_to_canvas_session'
+            : 'https://us-central1-collab-canvas-kenkel.cloudfunctions.net/ai_text_to_canvas_session')
+        : (isLocal
+            ? 'http://localhost:5001/collab-canvas-kenkel/us-central1/ai_text_to_canvas'
+            : 'https://us-central1-collab-canvas-kenkel.cloudfunctions.net/ai_text_to_canvas');
 
     console.log(`[AI API] Calling ${provider} with model: ${model}`, selectedContent ? 'with selected content' : '');
 
@@ -80,7 +187,10 @@ export const callAITest = async (
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ prompt, provider, model, selectedContent } as AITestRequest),
+      body: JSON.stringify({
+        prompt, provider, model, selectedContent, compact, debug, canvasSnapshot, canvasRevision,
+        ...(useSession ? { sessionId, canvasDelta, followUp } : {}),
+      } as AITestRequest),
     });
 
     if (!response.ok) {
@@ -89,7 +199,12 @@ export const callAITest = async (
       throw new Error(`HTTP error! status: ${response.status}, message: ${errorText}`);
     }
 
-    const data = await response.json();
+    const data: AIResponse = await response.json();
+    if (data.data?.encoding === 'columnar' && data.data.columns) {
+      data.data.commands = decodeColumnarCommands(data.data.columns);
+      delete data.data.columns;
+      delete data.data.encoding;
+    }
     console.log('[AI API] Response received:', {
       success: data.success,
       commandCount: data.data?.commands?.length || 0,